@@ -20,8 +20,13 @@ def main():
         raise SystemExit(0)
 
     from datetime import datetime
+    from multiprocessing import freeze_support
     from traceback import format_exc
 
+    # lets frozen builds run the worker processes
+    # used to scan and convert tags in parallel.
+    freeze_support()
+
     try:
         from mozzarilla.app_window import Mozzarilla
         main_window = Mozzarilla(debug=1)
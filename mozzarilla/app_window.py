@@ -45,6 +45,9 @@
 import mozzarilla
 
 from mozzarilla import editor_constants as e_c
+from mozzarilla import tag_ref_index
+from mozzarilla.tag_path_finder import TagPathIndex
+from mozzarilla.tags_dir_index import clear_tags_dir_indices
 from mozzarilla.widgets.field_widget_picker import def_halo_widget_picker
 from mozzarilla.widgets.directory_frame import DirectoryFrame
 from mozzarilla.windows.tag_window import HaloTagWindow, HaloConfigWindow
@@ -70,7 +73,7 @@
     '<F5>': "switch_tags_dir",
     '<F6>': "set_tags_dir",
     '<F7>': "add_tags_dir",
-    #'<F8>': "???",
+    '<F8>': "show_tag_finder",
 
     '<F9>': "bitmap_from_dds",
     '<F10>': "bitmap_from_bitmap_source",
@@ -149,6 +152,8 @@ class Mozzarilla(Binilla):
     config_window_class = HaloConfigWindow
 
     tool_windows = None
+    # index of the path of every tag in tags_dirs, used by the tag finder
+    tag_path_index = None
 
     window_panes = None
     directory_frame = None
@@ -279,6 +284,9 @@ def __init__(self, *args, **kwargs):
         self.tools_menu.add_command(
             label="Tag data extraction",
             command=self.show_data_extraction_window)
+        self.tools_menu.add_command(
+            label="Watch tags directory for broken references",
+            command=self.toggle_tags_dir_watcher)
         self.tools_menu.add_separator()
         self.tools_menu.add_cascade(
             label="Tag converters", menu=self.converters_menu)
@@ -339,6 +347,8 @@ def __init__(self, *args, **kwargs):
         if self.directory_frame is not None:
             self.directory_frame.highlight_tags_dir(self.tags_dir)
 
+        self.update_tag_path_index()
+
         try:
             if self.config_file.data.app_window.flags.load_last_workspace:
                 self.load_last_workspace()
@@ -528,6 +538,9 @@ def select_defs(self, menu_index=None, manual=True):
                     self.io_text.update_idletasks()
 
             self.set_active_handler(index=menu_index)
+            if self._mozzarilla_initialized:
+                self.update_tag_path_index()
+
             try:
                 self.config_file.data.mozzarilla.selected_handler.data = menu_index
             except AttributeError:
@@ -564,6 +577,7 @@ def add_tags_dir(self, e=None, tags_dir=None, manual=True):
 
         self.tags_dirs.append(tags_dir)
         self.switch_tags_dir(index=len(self.tags_dirs) - 1, manual=False)
+        self.update_tag_path_index()
 
         if self.directory_frame is not None:
             self.directory_frame.add_root_dir(tags_dir)
@@ -589,6 +603,9 @@ def remove_tags_dir(self, e=None, index=None, manual=True):
 
         tags_dir = self.tags_dirs[index]
         del self.tags_dirs[index]
+        # don't keep listing a directory that's no longer used
+        clear_tags_dir_indices(self.tags_dirs)
+        self.update_tag_path_index()
         if self.directory_frame is not None:
             self.directory_frame.del_root_dir(tags_dir)
 
@@ -617,7 +634,9 @@ def set_tags_dir(self, e=None, tags_dir=None, manual=True):
             self.directory_frame.highlight_tags_dir(self.tags_dir)
 
         self.tags_dir = tags_dir
+        clear_tags_dir_indices(self.tags_dirs)
         self.set_active_handler()
+        self.update_tag_path_index()
 
         if manual:
             self.last_load_dir = self.tags_dir
@@ -1195,6 +1214,63 @@ def show_tool_window(self, window_name, window_class,
         w.window_name = window_name
         self.place_window_relative(w, 30, 50); w.focus_set()
 
+    def update_tag_path_index(self, refresh=False):
+        '''
+        Adds any new tags directories to the tag path index and removes any
+        that are gone, in a background thread. Only the new directories are
+        walked, unless refresh is True, in which case the index of every
+        directory is updated to match what's on disk. Only the tags of
+        the active handler are indexed.
+        '''
+        if self.handler is None:
+            return
+
+        exts = frozenset(ext.lower() for ext in
+                         self.handler.id_ext_map.values())
+        if self.tag_path_index is None or self.tag_path_index.exts != exts:
+            # the tag set changed, so every directory is walked again
+            self.tag_path_index = TagPathIndex(exts)
+
+        Thread(target=self._update_tag_path_index, daemon=True,
+               args=(self.tag_path_index, tuple(self.tags_dirs), refresh)
+               ).start()
+
+    def _update_tag_path_index(self, tag_path_index, tags_dirs,
+                               refresh=False):
+        try:
+            tag_path_index.sync_dirs(tags_dirs)
+            if refresh:
+                for tags_dir in tags_dirs:
+                    tag_path_index.update_dir(tags_dir)
+        except Exception:
+            print(format_exc())
+            print("Could not update the tag path index.")
+
+    def show_tag_finder(self, e=None):
+        if self.directory_frame is not None:
+            self.directory_frame.tag_finder_frame.focus_query()
+
+    def toggle_tags_dir_watcher(self, e=None):
+        '''
+        Starts or stops watching the current tags directory and keeping
+        a live index of the references in its tags. While it's running,
+        the tag scanner and dependency viewer use the live index.
+        '''
+        handler = self.handler
+        if not hasattr(handler, 'tag_ref_cache'):
+            print("Change the current tag set.")
+            return
+
+        if tag_ref_index.get_live_index(handler, False) is not None:
+            tag_ref_index.stop_live_index(handler)
+            print("Stopped watching tags directory:\n    %s\n" %
+                  handler.tagsdir)
+            return
+
+        print("Watching tags directory:\n    %s\n" % handler.tagsdir)
+        tag_ref_index.start_live_index(
+            handler, index_dir=e_c.TAG_REF_INDEX_DIR)
+
     def show_chicago_shader_converter(self, e=None):
         self.show_tool_window("chicago_shader_converter", ChicagoShaderConverter)
     def show_object_converter(self, e=None):
@@ -0,0 +1,449 @@
+#!/usr/bin/env python3
+#
+# This file is part of Mozzarilla.
+#
+# For authors and copyright check AUTHORS.TXT
+#
+# Mozzarilla is free software under the GNU General Public License v3.0.
+# See LICENSE for more information.
+#
+'''
+Converts every bitmap in a tags directory without the gui, using the
+conversion settings of the first rule in a profile whose glob matches
+each bitmap's tags directory relative path. Profiles are json files:
+
+    {
+        "rules": [
+            {"glob": "ui/**", "format": "A8R8G8B8", "downres": 0},
+            {"glob": "effects/**", "format": "DXT5", "downres": 1}
+        ]
+    }
+
+Each rule can set any of the settings in PROFILE_SETTINGS. Settings not
+set by the matching rule are taken from the profile's "defaults", and
+otherwise left the same as the bitmap converter window defaults them to.
+Bitmaps that match no rule are left alone. Globs are case insensitive,
+"*" doesn't match across directories, and "**" does.
+
+Usage: python -m mozzarilla.batch_bitmap_converter TAGS_DIR PROFILE
+'''
+
+import argparse
+import json
+import os
+import re
+import sys
+
+from pathlib import Path
+from time import time
+
+from reclaimer.hek.defs.bitm import bitm_def
+
+from mozzarilla.bitmap_converting import BITMAP_PLATFORMS,\
+     MULTI_SWAP_OPTIONS, AY8_OPTIONS, EXTRACT_TO_OPTIONS, FORMAT_OPTIONS,\
+     PARAM_FORMAT_TO_FORMAT, ConversionFlags, BitmapTagInfo,\
+     ConversionReport, get_will_be_processed, time_bitmap_job,\
+     make_convert_pool, convert_bitmap_job, read_bitmap_tag_info
+from mozzarilla.bitmap_texture_cache import BitmapTextureCache,\
+     DEFAULT_MAX_TEXTURE_CACHE_SIZE
+from mozzarilla.tags_dir_index import get_tags_dir_index
+
+__all__ = (
+    "ConversionRule", "ConversionProfile", "glob_to_regex",
+    "BatchConversionSummary", "scan_bitmaps", "convert_bitmaps", "main",
+    )
+
+# maps the name of each setting a profile can set to the ConversionFlags
+# attribute it sets, and either the option names it can be set to, or the
+# range of numbers it can be set to. yes/no settings can be true or false.
+# the ranges match those of the bitmap converter window's spinboxes.
+PROFILE_SETTINGS = {
+    "platform":     ("platform", BITMAP_PLATFORMS),
+    "format":       ("new_format", FORMAT_OPTIONS),
+    "multi_swap":   ("multi_swap", MULTI_SWAP_OPTIONS),
+    "ay8_channel_source": ("mono_channel_to_keep", AY8_OPTIONS),
+    "extract_to":   ("extract_to", EXTRACT_TO_OPTIONS),
+    "downres":      ("downres", range(13)),
+    "alpha_bias":   ("alpha_bias", range(256)),
+    "prune_tiff":   ("prune_tiff", range(2)),
+    "swizzled":     ("swizzled", range(2)),
+    "swap_a8y8":    ("mono_swap", range(2)),
+    "ck_transparency": ("ck_trans", range(2)),
+    "generate_mipmaps": ("mip_gen", range(2)),
+    }
+
+
+def glob_to_regex(pattern):
+    '''
+    Returns a compiled case insensitive regex matching the same
+    forward slash separated paths the glob pattern does.
+    '''
+    parts = []
+    i = 0
+    while i < len(pattern):
+        if pattern.startswith("**/", i):
+            parts.append("(?:.*/)?")
+            i += 3
+        elif pattern.startswith("**", i):
+            parts.append(".*")
+            i += 2
+        elif pattern[i] == "*":
+            parts.append("[^/]*")
+            i += 1
+        elif pattern[i] == "?":
+            parts.append("[^/]")
+            i += 1
+        else:
+            parts.append(re.escape(pattern[i]))
+            i += 1
+
+    return re.compile("".join(parts) + r"\Z", re.IGNORECASE)
+
+
+def parse_setting(name, value):
+    '''
+    Returns the (ConversionFlags attribute name, value) to set for the
+    given profile setting. Raises ValueError if either is invalid.
+    '''
+    if name not in PROFILE_SETTINGS:
+        raise ValueError("Unknown bitmap conversion setting '%s'." % name)
+
+    attr_name, options = PROFILE_SETTINGS[name]
+    if isinstance(value, str) and not isinstance(options, range):
+        names = [option.lower() for option in options]
+        if value.lower() not in names:
+            raise ValueError("'%s' is not a valid %s. Expected one of: %s" %
+                             (value, name, ", ".join(options)))
+        return attr_name, names.index(value.lower())
+
+    if isinstance(value, bool):
+        value = int(value)
+    elif not isinstance(value, int):
+        raise ValueError("'%s' is not a valid %s." % (value, name))
+
+    if isinstance(options, range) and value not in options:
+        raise ValueError("%s is not a valid %s. Expected %s to %s." %
+                         (value, name, options[0], options[-1]))
+    elif not 0 <= value < len(options):
+        raise ValueError("%s is not a valid %s." % (value, name))
+
+    return attr_name, value
+
+
+class ConversionRule:
+    '''A glob and the conversion settings of the bitmaps it matches.'''
+    def __init__(self, glob, settings=None):
+        self.glob = glob
+        self.regex = glob_to_regex(glob)
+        # maps ConversionFlags attribute names to the values to set them to
+        self.settings = {}
+        for name, value in (settings or {}).items():
+            attr_name, value = parse_setting(name, value)
+            self.settings[attr_name] = value
+
+    def matches(self, rel_filepath):
+        return self.regex.match(
+            str(rel_filepath).replace("\\", "/")) is not None
+
+
+class ConversionProfile:
+    '''
+    Ordered rules deciding how each bitmap in a tags directory is
+    converted. The first rule whose glob matches a bitmap is used.
+    '''
+    def __init__(self, rules=(), defaults=None):
+        self.rules = list(rules)
+        self.defaults = ConversionRule("**", defaults)
+
+    @classmethod
+    def from_file(cls, filepath):
+        '''
+        Loads a profile from a json file. Raises ValueError if
+        the file isn't a valid bitmap conversion profile.
+        '''
+        with open(str(filepath), 'r') as f:
+            data = json.load(f)
+
+        if not isinstance(data, dict) or not isinstance(
+                data.get("rules"), list):
+            raise ValueError("'%s' is not a valid bitmap conversion "
+                             "profile." % filepath)
+
+        rules = []
+        for rule in data["rules"]:
+            if not isinstance(rule, dict) or "glob" not in rule:
+                raise ValueError("Every rule must be an object with a glob.")
+
+            settings = dict(rule)
+            rules.append(ConversionRule(settings.pop("glob"), settings))
+
+        return cls(rules, data.get("defaults"))
+
+    def get_rule(self, rel_filepath):
+        '''Returns the first rule matching the path, or None if none do.'''
+        for rule in self.rules:
+            if rule.matches(rel_filepath):
+                return rule
+        return None
+
+    def get_flags(self, rule, tag_info, extract_path=""):
+        '''
+        Returns the ConversionFlags for converting a bitmap with the rule.
+        The flags start out the way the bitmap converter window sets them
+        up when scanning, so unset settings leave the bitmap unchanged.
+        '''
+        flags = ConversionFlags()
+        flags.platform = tag_info.platform
+        flags.swizzled = tag_info.swizzled
+        flags.extract_path = extract_path
+        for settings in (self.defaults.settings, rule.settings):
+            for attr_name, value in settings.items():
+                setattr(flags, attr_name, value)
+
+        # same restrictions the window puts on picking a format
+        fmt = PARAM_FORMAT_TO_FORMAT[flags.new_format]
+        if ((tag_info.type == 1 and fmt in (14, 15, 16)) or
+                (tag_info.type == 2 and fmt == 17)):
+            flags.new_format = 0
+
+        return flags
+
+
+class BatchConversionSummary:
+    '''Totals of a batch conversion, for printing or saving as json.'''
+    def __init__(self, tags_dir, profile_path=""):
+        self.tags_dir = str(tags_dir)
+        self.profile_path = str(profile_path)
+        self.bitmap_count = 0
+        self.unreadable = []
+        self.unmatched_count = 0
+        self.unchanged_count = 0
+        self.processed = []
+        self.failed = []
+        # maps rule globs to how many bitmaps they matched
+        self.rule_counts = {}
+        self.scan_time = 0.0
+        self.convert_time = 0.0
+        self.report = ConversionReport()
+
+    def to_dict(self):
+        return dict(
+            tags_dir=self.tags_dir, profile=self.profile_path,
+            bitmap_count=self.bitmap_count,
+            unmatched_count=self.unmatched_count,
+            unchanged_count=self.unchanged_count,
+            processed_count=len(self.processed),
+            failed_count=len(self.failed) + len(self.unreadable),
+            rule_counts=self.rule_counts, processed=self.processed,
+            failed=self.failed, unreadable=self.unreadable,
+            scan_time=round(self.scan_time, 3),
+            convert_time=round(self.convert_time, 3),
+            peak_memory=self.report.peak_memory,
+            tag_times={fp: round(seconds, 3) for seconds, fp in
+                       self.report.tag_times})
+
+    def format(self):
+        lines = [
+            "Batch bitmap conversion of '%s'" % self.tags_dir,
+            "    %s bitmaps found" % self.bitmap_count,
+            "    %s matched no rule" % self.unmatched_count,
+            "    %s needed no changes" % self.unchanged_count,
+            "    %s processed" % len(self.processed),
+            "    %s failed" % len(self.failed),
+            "    %s could not be read" % len(self.unreadable),
+            "",
+            "Bitmaps matched by each rule:",
+            ]
+        lines.extend("    %8s  %s" % (count, glob) for glob, count in
+                     self.rule_counts.items())
+        if self.failed or self.unreadable:
+            lines.extend(("", "Failed:"))
+            lines.extend("    %s" % fp for fp in self.failed + self.unreadable)
+
+        lines.extend((
+            "",
+            self.report.format(),
+            "Scanned in %.1f seconds, converted in %.1f seconds." %
+            (self.scan_time, self.convert_time),
+            ""))
+        return "\n".join(lines)
+
+
+def scan_bitmaps(tags_dir, tag_def=bitm_def):
+    '''
+    Yields a (rel_filepath, BitmapTagInfo) pair for each bitmap tag in the
+    tags directory, in sorted order. The info is None for unreadable tags.
+    '''
+    tags_dir = Path(tags_dir)
+    tags_dir_index = get_tags_dir_index(tags_dir)
+    rel_filepaths = sorted(
+        os.path.relpath(str(tags_dir_index.root.joinpath(entry.rel_path)),
+                        str(tags_dir))
+        for entry in tags_dir_index.iter_files(tags_dir, (".bitmap", )))
+
+    for rel_filepath in rel_filepaths:
+        filepath = tags_dir.joinpath(rel_filepath)
+        tag_info = read_bitmap_tag_info(filepath, tag_def)
+        if tag_info is None:
+            try:
+                tag_info = BitmapTagInfo(tag_def.build(filepath=filepath))
+            except Exception:
+                tag_info = None
+
+        yield rel_filepath, tag_info
+
+
+def convert_bitmaps(tags_dir, profile, processes=None, data_dir="",
+                    use_stubbs_p8=False, backup=True, dry_run=False,
+                    summary=None, texture_cache_dir=None,
+                    max_texture_cache_size=DEFAULT_MAX_TEXTURE_CACHE_SIZE):
+    '''
+    Converts the bitmaps in tags_dir as the ConversionProfile says, in a
+    pool of worker processes unless processes is 1. Converted textures
+    are cached in texture_cache_dir if given, and the least recently used
+    are deleted afterward to keep the cache under max_texture_cache_size
+    bytes. Returns a filled in
+    BatchConversionSummary. Output of the conversions is printed in the
+    same order as a serial run, whatever the number of processes.
+    '''
+    if summary is None:
+        summary = BatchConversionSummary(tags_dir)
+
+    s_time = time()
+    jobs = []
+    for rel_filepath, tag_info in scan_bitmaps(tags_dir):
+        summary.bitmap_count += 1
+        if tag_info is None:
+            summary.unreadable.append(rel_filepath)
+            continue
+
+        rule = profile.get_rule(rel_filepath)
+        if rule is None:
+            summary.unmatched_count += 1
+            continue
+
+        summary.rule_counts[rule.glob] = summary.rule_counts.get(
+            rule.glob, 0) + 1
+
+        extract_path = ""
+        if data_dir:
+            extract_path = os.path.splitext(
+                os.path.join(str(data_dir), rel_filepath))[0]
+
+        flags = profile.get_flags(rule, tag_info, extract_path)
+        if not get_will_be_processed(flags, tag_info):
+            summary.unchanged_count += 1
+            continue
+
+        jobs.append((str(tags_dir), rel_filepath, flags, tag_info,
+                     use_stubbs_p8, backup, texture_cache_dir))
+
+    summary.scan_time = time() - s_time
+    if dry_run:
+        summary.processed.extend(job[1] for job in jobs)
+        return summary
+
+    s_time = time()
+    if processes == 1 or len(jobs) < 2:
+        results = (time_bitmap_job(job) for job in jobs)
+        pool = None
+    else:
+        pool = make_convert_pool(processes)
+        results = pool.imap(convert_bitmap_job, jobs)
+        summary.report.in_workers = True
+
+    try:
+        for job, result in zip(jobs, results):
+            if pool is None:
+                processed, seconds, peak_memory = result
+            else:
+                processed, output, seconds, peak_memory = result
+                if output:
+                    print(output, end='')
+
+            summary.report.add_tag(job[1], seconds, peak_memory)
+
+            if processed:
+                summary.processed.append(job[1])
+            else:
+                summary.failed.append(job[1])
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    summary.convert_time = time() - s_time
+    if texture_cache_dir:
+        BitmapTextureCache(texture_cache_dir).prune(max_texture_cache_size)
+
+    return summary
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m mozzarilla.batch_bitmap_converter",
+        description="Convert the bitmaps in a tags directory using the "
+        "rules in a bitmap conversion profile.")
+    parser.add_argument("tags_dir", help="Directory of bitmaps to convert.")
+    parser.add_argument("profile", help="Json bitmap conversion profile.")
+    parser.add_argument(
+        "-p", "--processes", type=int, default=None,
+        help="Number of processes to convert with. Defaults to one per cpu.")
+    parser.add_argument(
+        "-d", "--data-dir", default="",
+        help="Directory to extract bitmaps to for rules with extract_to.")
+    parser.add_argument(
+        "-s", "--summary", default="",
+        help="Filepath to save a json summary of the conversion to.")
+    parser.add_argument(
+        "-c", "--cache-dir", default="",
+        help="Directory to cache converted textures in. Identical bitmaps "
+        "converted the same way are copied from it instead of converted.")
+    parser.add_argument(
+        "--max-cache-size", type=int,
+        default=DEFAULT_MAX_TEXTURE_CACHE_SIZE // 1048576,
+        help="Megabytes the texture cache is pruned down to after "
+        "converting, deleting the least recently used textures first.")
+    parser.add_argument(
+        "--stubbs-p8", action="store_true",
+        help="Use Stubbs the Zombie's p8-bump palette instead of Halo's.")
+    parser.add_argument(
+        "--no-backup", action="store_true",
+        help="Don't back up bitmaps before saving them.")
+    parser.add_argument(
+        "--dry-run", action="store_true",
+        help="Only list the bitmaps that would be processed.")
+    args = parser.parse_args(args)
+
+    tags_dir = Path(args.tags_dir)
+    if not tags_dir.is_dir():
+        print("The tags directory '%s' does not exist." % tags_dir,
+              file=sys.stderr)
+        return 2
+
+    try:
+        profile = ConversionProfile.from_file(args.profile)
+    except (OSError, ValueError) as e:
+        print("Could not load profile: %s" % e, file=sys.stderr)
+        return 2
+
+    summary = convert_bitmaps(
+        tags_dir, profile, args.processes, args.data_dir, args.stubbs_p8,
+        not args.no_backup, args.dry_run,
+        BatchConversionSummary(tags_dir, args.profile), args.cache_dir or None,
+        args.max_cache_size*1048576)
+
+    if args.dry_run:
+        for rel_filepath in summary.processed:
+            print(rel_filepath)
+
+    print(summary.format())
+    if args.summary:
+        with open(args.summary, 'w') as f:
+            json.dump(summary.to_dict(), f, indent=1)
+
+    return 1 if summary.failed or summary.unreadable else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
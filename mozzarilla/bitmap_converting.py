@@ -0,0 +1,711 @@
+#
+# This file is part of Mozzarilla.
+#
+# For authors and copyright check AUTHORS.TXT
+#
+# Mozzarilla is free software under the GNU General Public License v3.0.
+# See LICENSE for more information.
+#
+
+import io
+import os
+import sys
+
+from contextlib import redirect_stdout
+from time import time
+from traceback import format_exc
+
+try:
+    import resource
+except ImportError:
+    # not available on windows
+    resource = None
+
+import arbytmap as ab
+
+from reclaimer.bitmaps.p8_palette import HALO_P8_PALETTE, STUBBS_P8_PALETTE
+from reclaimer.hek.defs.bitm import bitm_def
+from reclaimer.constants import TYPE_NAME_MAP, FORMAT_NAME_MAP,\
+     I_FORMAT_NAME_MAP
+
+from mozzarilla.bitmap_texture_cache import BitmapTextureCache
+from mozzarilla.process_pools import get_process_count, make_process_pool
+from mozzarilla.tag_header import TAG_HEADER_SIZE, read_tag_header
+
+if sys.platform == "win32":
+    import ctypes
+    from ctypes import wintypes
+
+    class _ProcessMemoryCounters(ctypes.Structure):
+        _fields_ = (
+            ("cb", wintypes.DWORD),
+            ("PageFaultCount", wintypes.DWORD),
+            ("PeakWorkingSetSize", ctypes.c_size_t),
+            ("WorkingSetSize", ctypes.c_size_t),
+            ("QuotaPeakPagedPoolUsage", ctypes.c_size_t),
+            ("QuotaPagedPoolUsage", ctypes.c_size_t),
+            ("QuotaPeakNonPagedPoolUsage", ctypes.c_size_t),
+            ("QuotaNonPagedPoolUsage", ctypes.c_size_t),
+            ("PagefileUsage", ctypes.c_size_t),
+            ("PeakPagefileUsage", ctypes.c_size_t),
+            )
+
+    try:
+        _get_current_process = ctypes.WinDLL("kernel32").GetCurrentProcess
+        _get_current_process.restype = wintypes.HANDLE
+        _get_process_memory_info = ctypes.WinDLL("psapi").GetProcessMemoryInfo
+        _get_process_memory_info.argtypes = (
+            wintypes.HANDLE, ctypes.POINTER(_ProcessMemoryCounters),
+            wintypes.DWORD)
+        _get_process_memory_info.restype = wintypes.BOOL
+    except (OSError, AttributeError):
+        _get_process_memory_info = None
+else:
+    _get_process_memory_info = None
+
+__all__ = (
+    "ConversionFlags", "BitmapInfo", "BitmapTagInfo",
+    "get_will_be_converted", "get_will_be_processed", "get_channel_mappings",
+    "convert_bitmap_tag", "process_bitmap_tag", "get_process_count",
+    "make_convert_pool", "convert_bitmap_job", "read_bitmap_tag_info",
+    "time_bitmap_job", "get_peak_memory", "ConversionReport",
+    )
+
+#                      (A, R, G, B)
+PC_ARGB_TO_XBOX_ARGB = (1, 3, 2, 0)
+XBOX_ARGB_TO_PC_ARGB = (3, 0, 2, 1)
+
+AL_COMBO_TO_AL   = (0, 0)
+AL_COMBO_TO_ARGB = (0, 0, 0, 0)
+
+
+BITMAP_PLATFORMS = ("PC", "XBOX")
+MULTI_SWAP_OPTIONS = ("", "PC to XBOX", "XBOX to PC")
+AY8_OPTIONS = ("Alpha", "Intensity")
+EXTRACT_TO_OPTIONS = ("", "DDS", "TGA", "PNG")
+NO_YES_OPTIONS = ("No", "Yes")
+BITMAP_TYPES = TYPE_NAME_MAP
+BITMAP_FORMATS = FORMAT_NAME_MAP
+DXT_ALPHA_FORMATS = (ab.FORMAT_DXT2, ab.FORMAT_DXT3,
+                     ab.FORMAT_DXT4, ab.FORMAT_DXT5)
+
+VALID_FORMAT_ENUMS = (0, 1, 2, 3, 6, 8, 9, 10, 11, 14, 15, 16, 17)
+PARAM_FORMAT_TO_FORMAT = (-1, ) + VALID_FORMAT_ENUMS
+FORMAT_OPTIONS = ("Unchanged", ) + tuple(BITMAP_FORMATS[i] for i in VALID_FORMAT_ENUMS)
+
+HALO_1_TYPE_COUNT   = 4
+HALO_1_FORMAT_COUNT = 18
+
+# base_address the first bitmap of xbox bitmap tags has
+XBOX_BITMAP_BASE_ADDRESS = 1073751810
+
+# maps id(tag_def) to (tag_def, layout) so layouts are only made once
+_bitm_layouts = {}
+
+
+class ConversionFlags:
+    platform = BITMAP_PLATFORMS.index("PC")
+    multi_swap = MULTI_SWAP_OPTIONS.index("")
+    mono_channel_to_keep = AY8_OPTIONS.index("Alpha")
+
+    extract_to = EXTRACT_TO_OPTIONS.index("")
+    downres = 0
+    alpha_bias = 127
+    new_format = 0
+
+    prune_tiff = 0
+    swizzled = 0
+    mono_swap = 0
+    ck_trans = 0
+    mip_gen = 0
+
+    extract_path = ""
+
+
+class BitmapInfo:
+    type = 0
+    format = 0
+    swizzled = False
+    width = 0
+    height = 0
+    depth = 0
+    mipmaps = 0
+
+    def __init__(self, bitmap_block=None):
+        if not bitmap_block:
+            return
+        self.type = bitmap_block.type.data
+        self.format = bitmap_block.format.data
+        self.swizzled = bool(bitmap_block.flags.swizzled)
+        self.width = bitmap_block.width
+        self.height = bitmap_block.height
+        self.depth = bitmap_block.depth
+        self.mipmaps = bitmap_block.mipmaps
+
+
+class BitmapTagInfo:
+    platform = 0
+    pixel_data_size = 0
+    tiff_data_size = 0
+    bitmap_infos = ()
+
+    def __init__(self, bitm_tag=None):
+        self.bitmap_infos = []
+        if not bitm_tag:
+            return
+
+        bitm_data = bitm_tag.data.tagdata
+        self.tiff_data_size = bitm_data.compressed_color_plate_data.size
+        self.pixel_data_size = bitm_data.processed_pixel_data.size
+        for bitmap in bitm_data.bitmaps.STEPTREE:
+            self.bitmap_infos.append(BitmapInfo(bitmap))
+
+        self.platform = bitm_tag.is_xbox_bitmap
+
+    @property
+    def type(self):
+        return 0 if not self.bitmap_infos else self.bitmap_infos[0].type
+    @property
+    def format(self):
+        return 0 if not self.bitmap_infos else self.bitmap_infos[0].format
+    @property
+    def swizzled(self):
+        return 0 if not self.bitmap_infos else self.bitmap_infos[0].swizzled
+
+
+def _get_field_reader(desc, name, base_off=0):
+    i = desc['NAME_MAP'][name]
+    f_type = desc[i]['TYPE']
+    return base_off + desc['ATTR_OFFS'][i], f_type.size, f_type.struct_unpacker
+
+
+def _read_field(data, field_reader, node_off=0):
+    off, size, unpacker = field_reader
+    off += node_off
+    return unpacker(data[off: off + size])[0]
+
+
+def _get_bitm_layout(tag_def):
+    '''
+    Returns the offsets and sizes needed to read a bitmap tag's metadata,
+    taken from its definition so they follow any changes to it.
+    '''
+    layout = _bitm_layouts.get(id(tag_def))
+    if layout is not None and layout[0] is tag_def:
+        return layout[1]
+
+    body_desc = tag_def.descriptor[1]
+    body_readers = {}
+    for name in ("compressed_color_plate_data", "processed_pixel_data",
+                 "sequences", "bitmaps"):
+        i = body_desc['NAME_MAP'][name]
+        body_readers[name] = _get_field_reader(
+            body_desc[i], 'size', body_desc['ATTR_OFFS'][i])
+
+    seqs_desc = body_desc[body_desc['NAME_MAP']['sequences']]['STEPTREE']
+    seq_desc = seqs_desc['SUB_STRUCT']
+    sprites_i = seq_desc['NAME_MAP']['sprites']
+    sprites_desc = seq_desc[sprites_i]['STEPTREE']
+
+    bitms_desc = body_desc[body_desc['NAME_MAP']['bitmaps']]['STEPTREE']
+    bitm_desc = bitms_desc['SUB_STRUCT']
+    flags_desc = bitm_desc[bitm_desc['NAME_MAP']['flags']]
+
+    layout = dict(
+        body_size=body_desc['SIZE'], body_readers=body_readers,
+        seq_size=seq_desc['SIZE'], max_seqs=seqs_desc.get('MAX', 0),
+        sprites_reader=_get_field_reader(
+            seq_desc[sprites_i], 'size', seq_desc['ATTR_OFFS'][sprites_i]),
+        sprite_size=sprites_desc['SUB_STRUCT']['SIZE'],
+        max_sprites=sprites_desc.get('MAX', 0),
+        bitm_size=bitm_desc['SIZE'], max_bitms=bitms_desc.get('MAX', 0),
+        swizzled_mask=flags_desc[flags_desc['NAME_MAP']['swizzled']]['VALUE'],
+        bitm_readers={name: _get_field_reader(bitm_desc, name) for name in (
+            "type", "format", "flags", "width", "height", "depth",
+            "mipmaps", "base_address")},
+        )
+    _bitm_layouts[id(tag_def)] = (tag_def, layout)
+    return layout
+
+
+def read_bitmap_tag_info(filepath, tag_def=bitm_def):
+    '''
+    Reads a BitmapTagInfo from the bitmap tag at filepath without loading
+    it. Only the tag's header, body and bitmap blocks are read, and the
+    pixel data and color plate are seeked past. Returns None if the file
+    isn't a bitmap tag laid out the way this expects, in which case the
+    tag should be fully loaded instead.
+    '''
+    header = read_tag_header(filepath)
+    if (header is None or header.tag_class != tag_def.def_id or
+            header.engine_id != "blam"):
+        return None
+
+    try:
+        layout = _get_bitm_layout(tag_def)
+        with open(str(filepath), 'rb') as f:
+            file_size = os.fstat(f.fileno()).st_size
+            f.seek(TAG_HEADER_SIZE)
+            body = f.read(layout["body_size"])
+            if len(body) < layout["body_size"]:
+                return None
+
+            readers = layout["body_readers"]
+            tiff_size = _read_field(body, readers["compressed_color_plate_data"])
+            pixels_size = _read_field(body, readers["processed_pixel_data"])
+            seq_count = _read_field(body, readers["sequences"])
+            bitm_count = _read_field(body, readers["bitmaps"])
+            if (min(tiff_size, pixels_size, seq_count, bitm_count) < 0 or
+                    seq_count > layout["max_seqs"] or
+                    bitm_count > layout["max_bitms"]):
+                return None
+
+            # steptrees follow the body in field order, with the sprites of
+            # each sequence following the sequences array.
+            offset = (TAG_HEADER_SIZE + layout["body_size"] +
+                      tiff_size + pixels_size)
+            if seq_count:
+                f.seek(offset)
+                seq_data = f.read(seq_count*layout["seq_size"])
+                if len(seq_data) < seq_count*layout["seq_size"]:
+                    return None
+
+                offset += len(seq_data)
+                for i in range(seq_count):
+                    sprite_count = _read_field(
+                        seq_data, layout["sprites_reader"],
+                        i*layout["seq_size"])
+                    if not 0 <= sprite_count <= layout["max_sprites"]:
+                        return None
+                    offset += sprite_count*layout["sprite_size"]
+
+            bitm_size = layout["bitm_size"]
+            if offset + bitm_count*bitm_size > file_size:
+                return None
+
+            f.seek(offset)
+            bitm_data = f.read(bitm_count*bitm_size)
+    except (OSError, KeyError, TypeError, ValueError):
+        return None
+
+    tag_info = BitmapTagInfo()
+    tag_info.tiff_data_size = tiff_size
+    tag_info.pixel_data_size = pixels_size
+
+    readers = layout["bitm_readers"]
+    for i in range(bitm_count):
+        off = i*bitm_size
+        info = BitmapInfo()
+        info.type = _read_field(bitm_data, readers["type"], off)
+        info.format = _read_field(bitm_data, readers["format"], off)
+        info.swizzled = bool(_read_field(bitm_data, readers["flags"], off) &
+                             layout["swizzled_mask"])
+        info.width = _read_field(bitm_data, readers["width"], off)
+        info.height = _read_field(bitm_data, readers["height"], off)
+        info.depth = _read_field(bitm_data, readers["depth"], off)
+        info.mipmaps = _read_field(bitm_data, readers["mipmaps"], off)
+        tag_info.bitmap_infos.append(info)
+
+    if bitm_count:
+        tag_info.platform = _read_field(
+            bitm_data, readers["base_address"]) == XBOX_BITMAP_BASE_ADDRESS
+
+    return tag_info
+
+
+def get_will_be_converted(flags, tag_info):
+    if flags.platform != tag_info.platform:
+        return True
+    elif (flags.swizzled != tag_info.swizzled and
+          tag_info.format not in (14, 15, 16)):
+        return True
+    elif (flags.mono_swap and (PARAM_FORMAT_TO_FORMAT[flags.new_format] == 3 or
+                               tag_info.format == 3)):
+        return True
+    elif flags.multi_swap and tag_info.format in (6, 8, 9, 10, 11, 14, 15, 16):
+        return True
+
+    for info in tag_info.bitmap_infos:
+        if PARAM_FORMAT_TO_FORMAT[flags.new_format] not in (-1, info.format):
+            return True
+        elif flags.downres and max(info.width, info.height, info.depth) > 4:
+            return True
+        elif flags.mip_gen and info.mipmaps == 0:
+            return True
+
+    return False
+
+
+def get_channel_mappings(conv_flags, bitmap_info):
+    mono_swap = conv_flags.mono_swap
+    fmt_s = FORMAT_NAME_MAP[bitmap_info.format]
+    fmt_t = PARAM_FORMAT_TO_FORMAT[conv_flags.new_format]
+    fmt_t = fmt_s if fmt_t < 0 else FORMAT_NAME_MAP[fmt_t]
+
+    multi_swap = conv_flags.multi_swap
+    chan_to_keep = conv_flags.mono_channel_to_keep
+
+    chan_ct_s = ab.CHANNEL_COUNTS[fmt_s]
+    chan_ct_t = ab.CHANNEL_COUNTS[fmt_t]
+    chan_map = None
+    chan_merge_map = None
+
+    if chan_ct_s == 4:
+        if chan_ct_t == 4:
+            # TAKES CARE OF ALL THE MULTIPURPOSE CHANNEL SWAPPING
+            if multi_swap == 1:
+                chan_map = PC_ARGB_TO_XBOX_ARGB
+            elif multi_swap == 2:
+                chan_map = XBOX_ARGB_TO_PC_ARGB
+
+        elif fmt_t == ab.FORMAT_A8L8:
+            chan_merge_map = ab.M_ARGB_TO_LA if mono_swap else ab.M_ARGB_TO_AL
+
+        elif fmt_t in (ab.FORMAT_A8, ab.FORMAT_L8, ab.FORMAT_AL8):
+            # CONVERTING FROM A 4 CHANNEL FORMAT TO MONOCHROME
+            if fmt_t == ab.FORMAT_L8:
+                chan_merge_map = ab.M_ARGB_TO_L
+            elif fmt_t == ab.FORMAT_A8 or chan_to_keep == 0:
+                chan_map = ab.ANYTHING_TO_A
+                chan_merge_map = ab.M_ARGB_TO_A
+            else:
+                chan_merge_map = ab.M_ARGB_TO_L
+
+    elif chan_ct_s == 2:
+        # CONVERTING FROM A 2 CHANNEL FORMAT TO OTHER FORMATS
+        if fmt_s == ab.FORMAT_AL8:
+            chan_map = AL_COMBO_TO_ARGB if chan_ct_t == 4 else AL_COMBO_TO_AL
+
+        elif fmt_s == ab.FORMAT_A8L8:
+            if chan_ct_t == 4:
+                if mono_swap:
+                    chan_map = ab.LA_TO_ARGB
+                else:
+                    chan_map = ab.AL_TO_ARGB
+            elif fmt_t == ab.FORMAT_A8 or (fmt_t == ab.FORMAT_AL8 and
+                                           not chan_to_keep):
+                chan_map = ab.ANYTHING_TO_A
+            elif fmt_t == ab.FORMAT_L8 or (fmt_t == ab.FORMAT_AL8 and
+                                           chan_to_keep):
+                chan_map = ab.AL_TO_L
+            elif mono_swap:
+                if fmt_t == ab.FORMAT_A8L8:
+                    chan_map = ab.AL_TO_LA
+                elif chan_ct_t == 4:
+                    chan_map = ab.LA_TO_ARGB
+
+    elif chan_ct_s == 1:
+        # CONVERTING FROM A 1 CHANNEL FORMAT TO OTHER FORMATS
+        if chan_ct_t == 4:
+            if fmt_s == ab.FORMAT_A8:
+                chan_map = ab.A_TO_ARGB
+            elif fmt_s == ab.FORMAT_L8:
+                chan_map = ab.L_TO_ARGB
+
+        elif chan_ct_t == 2:
+            if fmt_s == ab.FORMAT_A8:
+                chan_map = ab.A_TO_AL
+            elif fmt_s == ab.FORMAT_L8:
+                chan_map = ab.L_TO_AL
+
+    return chan_map, chan_merge_map
+
+
+def convert_bitmap_tag(tag, conv_flags, bitmap_info, use_stubbs_p8=False,
+                       texture_cache=None):
+    '''
+    Converts and extracts the bitmaps in the tag as the flags say.
+    If a BitmapTextureCache is given, bitmaps it has already converted
+    with the same settings are loaded from it rather than converted.
+    '''
+    for i in range(tag.bitmap_count()):
+        if not tag.is_power_of_2_bitmap(i):
+            return False
+
+    new_format = BITMAP_FORMATS[
+        PARAM_FORMAT_TO_FORMAT[conv_flags.new_format]]
+
+    extract_ext = EXTRACT_TO_OPTIONS[conv_flags.extract_to]
+    ck_trans = conv_flags.ck_trans
+
+    do_conversion = get_will_be_converted(conv_flags, bitmap_info)
+    if not do_conversion and not extract_ext:
+        return True
+
+    arb = ab.Arbytmap()
+    if tag.sanitize_mipmap_counts():
+        print("ERROR: Bad mipmap counts in:\n%s\t\n" % tag.filepath)
+        return False
+
+    tag.parse_bitmap_blocks()
+    pixel_data = tag.data.tagdata.processed_pixel_data.data
+
+    for i in range(tag.bitmap_count()):
+        typ   = BITMAP_TYPES[tag.bitmap_type(i)]
+        fmt_s = BITMAP_FORMATS[tag.bitmap_format(i)]
+        fmt_t = fmt_s if conv_flags.new_format <= 0 else new_format
+
+        # arbytmap makes its own list of the texture's arrays,
+        # so the tag's block can be handed to it as it is.
+        tex_block = pixel_data[i]
+        tex_info = tag.tex_infos[i]
+
+        if fmt_t == ab.FORMAT_P8_BUMP and typ in (ab.TYPE_CUBEMAP, ab.TYPE_3D):
+            print("Cannot convert cubemaps or 3d textures to P8.")
+            fmt_t = fmt_s
+        elif fmt_t in ab.DDS_FORMATS and typ == ab.TYPE_3D:
+            print("Cannot convert 3D textures to DXT formats.")
+            fmt_t = fmt_s
+
+        if (fmt_s in (ab.FORMAT_A8, ab.FORMAT_L8, ab.FORMAT_AL8) and
+            fmt_t in (ab.FORMAT_A8, ab.FORMAT_L8, ab.FORMAT_AL8)):
+            tex_info["format"] = fmt_s = fmt_t
+
+        chan_map, chan_merge_map = get_channel_mappings(conv_flags, bitmap_info)
+        palette_picker = None
+        palettize = (fmt_t == ab.FORMAT_P8_BUMP)
+
+        p8_palette = STUBBS_P8_PALETTE if use_stubbs_p8 else HALO_P8_PALETTE
+
+        if "palette" in tex_info:
+            tex_info["palette"] = [
+                p8_palette.p8_palette_32bit_packed] * len(tex_block)
+
+        # we want to preserve the color key transparency of
+        # the original image if converting to the same format
+        if fmt_s == fmt_t and fmt_t in (ab.FORMAT_P8_BUMP, ab.FORMAT_DXT1):
+            # also need to make sure channels aren't being swapped around
+            if not conv_flags.multi_swap:
+                ck_trans = True
+
+        if ab.CHANNEL_COUNTS[fmt_s] == 4:
+            if not ck_trans or fmt_s in (ab.FORMAT_X8R8G8B8, ab.FORMAT_R5G6B5):
+                palette_picker = p8_palette.argb_array_to_p8_array_best_fit
+            else:
+                palette_picker = p8_palette.argb_array_to_p8_array_best_fit_alpha
+
+        arb.load_new_texture(texture_block=tex_block, texture_info=tex_info)
+
+        # build the initial conversion settings list from the above settings
+        conv_settings = dict(
+            swizzle_mode=conv_flags.swizzled, palettize=palettize,
+            one_bit_bias=conv_flags.alpha_bias, palette_picker=palette_picker,
+            downres_amount=conv_flags.downres, target_format=fmt_t,
+            color_key_transparency=ck_trans, mipmap_gen=conv_flags.mip_gen,
+            channel_mapping=chan_map, channel_merge_mapping=chan_merge_map)
+
+        arb.load_new_conversion_settings(**conv_settings)
+
+        if extract_ext and conv_flags.extract_path:
+            path = conv_flags.extract_path
+            if tag.bitmap_count() > 1:
+                path = os.path.join(path, str(i))
+            arb.save_to_file(output_path=path, ext=extract_ext)
+
+        cache_key = cached_texture = None
+        if do_conversion and texture_cache is not None:
+            key_settings = dict(conv_settings, palette_picker=getattr(
+                palette_picker, "__name__", None))
+            cache_key = texture_cache.get_key(tex_block, (
+                sorted((k, v) for k, v in tex_info.items() if k != "palette"),
+                tag.is_xbox_bitmap, sorted(key_settings.items()),
+                "stubbs" if use_stubbs_p8 else "halo",
+                getattr(ab, "__version__", None)))
+            cached_texture = texture_cache.get_texture(cache_key)
+            if (cached_texture is not None and
+                    cached_texture[3] not in I_FORMAT_NAME_MAP):
+                cached_texture = None
+
+        if cached_texture is not None:
+            # an identical texture was already converted the same way
+            texture_block, tag.tex_infos[i], swizzled, fmt = cached_texture
+            tex_block.parse(initdata=texture_block,
+                            clear=False, init_attrs=False)
+            tag.swizzled(i, swizzled)
+            tag.bitmap_format(i, I_FORMAT_NAME_MAP[fmt])
+        elif do_conversion:
+            success = arb.convert_texture()
+            tag.tex_infos[i] = arb.texture_info  # tex_info may have changed
+
+            if success:
+                if cache_key is not None:
+                    texture_cache.set_texture(
+                        cache_key, arb.texture_block, arb.texture_info,
+                        arb.swizzled, arb.format)
+
+                tex_block.parse(initdata=arb.texture_block,
+                                clear=False, init_attrs=False)
+                tag.swizzled(i, arb.swizzled)
+
+                #change the bitmap format to the new format
+                tag.bitmap_format(i, I_FORMAT_NAME_MAP[arb.format])
+            else:
+                print("Error occurred while converting:\n\t%s\n" % tag.filepath)
+                return False
+
+        # arbytmap references itself, so it won't be freed until the garbage
+        # collector runs. drop its pixels now so only one bitmap's worth of
+        # converted and unconverted pixels is ever held at once.
+        arb.texture_block = arb.texture_info = arb.palette = None
+        tex_block = None
+
+    if do_conversion:
+        tag.sanitize_bitmaps()
+        tag.set_platform(conv_flags.platform)
+        tag.add_bitmap_padding(conv_flags.platform)
+        tag.fix_top_format()
+
+    return True
+
+
+def get_will_be_processed(flags, tag_info):
+    '''
+    Returns whether the bitmap tag will be edited or extracted
+    when converted with the given flags.
+    '''
+    return bool(flags.prune_tiff or flags.extract_to != 0 or
+                get_will_be_converted(flags, tag_info))
+
+
+def process_bitmap_tag(tags_dir, filepath, conv_flags, bitmap_info,
+                       use_stubbs_p8=False, backup=True,
+                       texture_cache_dir=None, tag_def=bitm_def):
+    '''
+    Loads the bitmap tag at the tags_dir relative filepath, then prunes,
+    converts and extracts it as the flags say and saves it if it changed.
+    Converted textures are cached in texture_cache_dir if it is given.
+    Returns whether or not the tag was processed. Exceptions are printed
+    rather than raised, so a batch can carry on past a bad tag.
+    '''
+    tag = None
+    try:
+        pruning = conv_flags.prune_tiff
+        extracting = conv_flags.extract_to != 0
+        converting = get_will_be_converted(conv_flags, bitmap_info)
+        if not(pruning or converting or extracting):
+            return False
+
+        tag = tag_def.build(filepath=os.path.join(tags_dir, filepath))
+        if pruning:
+            tag.data.tagdata.compressed_color_plate_data.data = bytearray()
+
+        if converting or extracting:
+            texture_cache = None
+            if texture_cache_dir:
+                texture_cache = BitmapTextureCache(texture_cache_dir)
+
+            if not convert_bitmap_tag(tag, conv_flags, bitmap_info,
+                                      use_stubbs_p8=use_stubbs_p8,
+                                      texture_cache=texture_cache):
+                # don't save a tag that may be only partly converted
+                print("Could not convert: %s" % filepath)
+                return False
+
+        if converting or pruning:
+            tag.serialize(temp=False, calc_pointers=False, backup=backup)
+
+        return True
+    except Exception:
+        print(format_exc())
+        print("Could not convert: %s" % filepath)
+    finally:
+        # tags are full of reference cycles, so rather than running a full
+        # garbage collection after every tag, free the pixel data (which
+        # is nearly all of a bitmap's memory) and let the rest be collected
+        # whenever the collector next gets to it.
+        if tag is not None:
+            tag.data.tagdata.processed_pixel_data.data = bytearray()
+            tag.tex_infos = []
+            tag = None
+
+    return False
+
+
+def make_convert_pool(max_processes=None):
+    '''Returns a process pool for running convert_bitmap_job in.'''
+    return make_process_pool(max_processes)
+
+
+def get_peak_memory():
+    '''
+    Returns the most memory in bytes this whole process has used at once,
+    or 0 if the os can't say. On windows this is the peak working set.
+    '''
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # linux reports kilobytes, while mac reports bytes
+        return peak if sys.platform == "darwin" else peak*1024
+    elif _get_process_memory_info is not None:
+        counters = _ProcessMemoryCounters()
+        counters.cb = ctypes.sizeof(counters)
+        if _get_process_memory_info(_get_current_process(),
+                                    ctypes.byref(counters), counters.cb):
+            return counters.PeakWorkingSetSize
+    return 0
+
+
+def time_bitmap_job(job):
+    '''
+    Runs process_bitmap_tag with the arguments in job. Returns whether
+    the tag was processed, how many seconds it took, and the peak memory
+    use of this process afterward.
+    '''
+    s_time = time()
+    processed = process_bitmap_tag(*job)
+    return processed, time() - s_time, get_peak_memory()
+
+
+def convert_bitmap_job(job):
+    '''
+    Runs time_bitmap_job with job inside a worker process. Returns the
+    same as it, with everything printed while processing the tag added
+    after whether it was processed, so the caller can print it in the
+    same order a serial conversion would have.
+    '''
+    output = io.StringIO()
+    with redirect_stdout(output):
+        processed, seconds, peak_memory = time_bitmap_job(job)
+    return processed, output.getvalue(), seconds, peak_memory
+
+
+class ConversionReport:
+    '''
+    How long each bitmap tag took to convert, and the peak memory use
+    of the processes that converted them. If they were converted in
+    this process rather than in workers, the peak is of everything
+    this process holds, not just what converting used.
+    '''
+    def __init__(self, in_workers=False):
+        # list of (seconds, filepath) of every tag converted
+        self.tag_times = []
+        self.total_time = 0.0
+        self.peak_memory = 0
+        self.in_workers = in_workers
+
+    def add_tag(self, filepath, seconds, peak_memory=0):
+        self.tag_times.append((seconds, str(filepath)))
+        self.total_time += seconds
+        self.peak_memory = max(self.peak_memory, peak_memory)
+
+    def format(self, top_count=10):
+        '''Returns the text of the report, listing the slowest tags.'''
+        if self.peak_memory:
+            peak = "%.1f MB" % (self.peak_memory / 1048576)
+        else:
+            peak = "unknown"
+
+        lines = [
+            "%s bitmaps took %.1f seconds to process." %
+            (len(self.tag_times), self.total_time),
+            "Peak memory use of %s: %s" % (
+                "a worker process" if self.in_workers else "this process",
+                peak),
+            ]
+        if self.tag_times:
+            lines.append("Slowest bitmaps:")
+            for seconds, filepath in sorted(self.tag_times,
+                                            reverse=True)[: top_count]:
+                lines.append("    %8.2fs  %s" % (seconds, filepath))
+
+        lines.append("")
+        return "\n".join(lines)
@@ -0,0 +1,146 @@
+#
+# This file is part of Mozzarilla.
+#
+# For authors and copyright check AUTHORS.TXT
+#
+# Mozzarilla is free software under the GNU General Public License v3.0.
+# See LICENSE for more information.
+#
+
+import json
+import os
+
+from pathlib import Path
+from threading import RLock
+
+from mozzarilla.bitmap_converting import BitmapInfo, BitmapTagInfo
+
+__all__ = (
+    "BitmapInfoCache", "pack_bitmap_tag_info", "unpack_bitmap_tag_info",
+    )
+
+
+def pack_bitmap_tag_info(tag_info):
+    '''Returns the BitmapTagInfo as a list that json can serialize.'''
+    return [
+        int(tag_info.platform), tag_info.pixel_data_size,
+        tag_info.tiff_data_size,
+        [[info.type, info.format, int(info.swizzled), info.width,
+          info.height, info.depth, info.mipmaps]
+         for info in tag_info.bitmap_infos]
+        ]
+
+
+def unpack_bitmap_tag_info(packed):
+    '''Returns a BitmapTagInfo made from a list from pack_bitmap_tag_info.'''
+    tag_info = BitmapTagInfo()
+    platform, tag_info.pixel_data_size, tag_info.tiff_data_size, infos = packed
+    tag_info.platform = bool(platform)
+    for typ, fmt, swizzled, width, height, depth, mipmaps in infos:
+        info = BitmapInfo()
+        info.type, info.format, info.swizzled = typ, fmt, bool(swizzled)
+        info.width, info.height, info.depth = width, height, depth
+        info.mipmaps = mipmaps
+        tag_info.bitmap_infos.append(info)
+
+    return tag_info
+
+
+class BitmapInfoCache:
+    '''
+    Persistent record of the BitmapTagInfo of every bitmap tag the bitmap
+    converter has scanned, keyed by the tag's resolved absolute path.
+    A cached info is only used while the tag's size and mtime are the
+    same as when it was scanned, so rescanning a directory only has to
+    read the tags which changed since then.
+    '''
+    version = 1
+
+    def __init__(self, filepath=None):
+        self.filepath = None if filepath is None else Path(filepath)
+        # maps resolved filepaths to [size, mtime, packed tag info]
+        self.entries = {}
+        self._changed = False
+        self._lock = RLock()
+
+    def load(self):
+        '''
+        Loads the cache from its filepath. If it doesn't exist or
+        can't be read, the cache is emptied and False is returned.
+        '''
+        with self._lock:
+            self.entries = {}
+            self._changed = False
+
+        if self.filepath is None:
+            return False
+
+        try:
+            with self.filepath.open('r') as f:
+                data = json.load(f)
+        except Exception:
+            return False
+
+        if not isinstance(data, dict) or data.get("version") != self.version:
+            return False
+
+        with self._lock:
+            self.entries = dict(data.get("tags", {}))
+        return True
+
+    def save(self):
+        '''Saves the cache to its filepath if it changed since loading.'''
+        if self.filepath is None or not self._changed:
+            return
+
+        with self._lock:
+            data = dict(version=self.version, tags=self.entries)
+            # write to a temp file first so an interrupted save
+            # can't leave a half written cache behind.
+            self.filepath.parent.mkdir(parents=True, exist_ok=True)
+            temppath = self.filepath.with_name(self.filepath.name + ".temp")
+            with temppath.open('w') as f:
+                json.dump(data, f)
+
+            os.replace(str(temppath), str(self.filepath))
+            self._changed = False
+
+    def get_stat(self, filepath):
+        st = os.stat(str(filepath))
+        return [st.st_size, st.st_mtime_ns]
+
+    def get_info(self, filepath, stat):
+        '''
+        Returns the cached BitmapTagInfo of the tag at the resolved
+        filepath, or None if it isn't cached or the tag has changed.
+        '''
+        with self._lock:
+            entry = self.entries.get(str(filepath))
+
+        if entry is None or entry[:2] != stat:
+            return None
+
+        try:
+            return unpack_bitmap_tag_info(entry[2])
+        except (TypeError, ValueError):
+            # malformed entry. just rescan the tag
+            return None
+
+    def set_info(self, filepath, stat, tag_info):
+        with self._lock:
+            self.entries[str(filepath)] = (
+                list(stat) + [pack_bitmap_tag_info(tag_info)])
+            self._changed = True
+
+    def prune(self, dirpath, seen_filepaths):
+        '''
+        Removes the entries of the tags in the resolved dirpath
+        which aren't in seen_filepaths, since they no longer exist.
+        '''
+        prefix = os.path.join(str(dirpath), "")
+        seen_filepaths = set(str(filepath) for filepath in seen_filepaths)
+        with self._lock:
+            for key in list(self.entries):
+                if key.startswith(prefix) and key not in seen_filepaths:
+                    del self.entries[key]
+                    self._changed = True
@@ -0,0 +1,202 @@
+#
+# This file is part of Mozzarilla.
+#
+# For authors and copyright check AUTHORS.TXT
+#
+# Mozzarilla is free software under the GNU General Public License v3.0.
+# See LICENSE for more information.
+#
+
+import hashlib
+import json
+import os
+import sys
+
+from array import array
+from pathlib import Path
+
+__all__ = ("BitmapTextureCache", "DEFAULT_MAX_TEXTURE_CACHE_SIZE", )
+
+# the least recently used textures are deleted when pruning
+# a cache which is larger than this many bytes.
+DEFAULT_MAX_TEXTURE_CACHE_SIZE = 1024**3
+
+# longest the json header of a cached texture can be
+MAX_HEADER_SIZE = 1 << 16
+
+_integer_typecodes = frozenset("bBhHiIlLqQ")
+_json_types = (str, int, float, bool, type(None))
+
+
+def _get_array_layout(arrays):
+    layout = []
+    for pixels in arrays:
+        if not(isinstance(pixels, array) and
+               pixels.typecode in _integer_typecodes):
+            raise TypeError("Can only cache arrays of integers.")
+        layout.append([pixels.typecode, pixels.itemsize,
+                       pixels.itemsize*len(pixels)])
+    return layout
+
+
+def _read_arrays(f, layout):
+    arrays = []
+    for typecode, itemsize, size in layout:
+        if typecode not in _integer_typecodes:
+            raise ValueError("Cached arrays must be of integers.")
+
+        pixels = array(typecode)
+        # item sizes vary by platform, so the arrays may not be readable here
+        if pixels.itemsize != itemsize or size % itemsize:
+            raise ValueError("Cached array has the wrong item size.")
+
+        data = f.read(size)
+        if len(data) != size:
+            raise ValueError("Cached texture is truncated.")
+
+        pixels.frombytes(data)
+        arrays.append(pixels)
+    return arrays
+
+
+class BitmapTextureCache:
+    '''
+    On disk cache of the textures arbytmap converted bitmaps into, keyed
+    by a hash of the unconverted texture's pixels and everything affecting
+    how it's converted. Tag sets tend to have many copies of the same
+    bitmap, and each one after the first just loads the converted texture
+    instead of encoding it again. Entries are written to a temp file
+    first, so any number of processes can share the same cache directory.
+
+    Each entry is a line of json describing the texture, followed by the
+    raw bytes of its pixel arrays. Nothing in an entry is ever executed,
+    so a shared cache directory can't be used to run code.
+    '''
+    version = 2
+    ext = ".texture"
+
+    def __init__(self, dirpath):
+        self.dirpath = Path(dirpath)
+
+    def get_key(self, texture_block, settings):
+        '''
+        Returns the key of the texture converted with the given settings.
+        settings must be a tuple whose repr is the same every run.
+        '''
+        key_hash = hashlib.sha1(repr((self.version, settings)).encode())
+        for pixels in texture_block:
+            key_hash.update(b"%d:" % len(pixels))
+            key_hash.update(pixels)
+        return key_hash.hexdigest()
+
+    def get_filepath(self, key):
+        return self.dirpath.joinpath(key[: 2], key + self.ext)
+
+    def get_texture(self, key):
+        '''
+        Returns the (texture_block, texture_info, swizzled, format) the
+        texture with the key was converted into, or None if not cached.
+        '''
+        filepath = self.get_filepath(key)
+        try:
+            with filepath.open('rb') as f:
+                header = json.loads(
+                    f.readline(MAX_HEADER_SIZE).decode("utf-8"))
+                if (header.get("version") != self.version or
+                        header.get("byteorder") != sys.byteorder):
+                    raise ValueError("Cached texture is from another version.")
+
+                texture_info = dict(header["texture_info"])
+                if not all(isinstance(v, _json_types)
+                           for v in texture_info.values()):
+                    raise ValueError("Malformed cached texture info.")
+
+                texture_block = _read_arrays(f, header["arrays"])
+                if header.get("palette") is not None:
+                    texture_info["palette"] = _read_arrays(
+                        f, header["palette"])
+
+                if f.read(1):
+                    raise ValueError("Cached texture has trailing data.")
+
+            texture = (texture_block, texture_info,
+                       bool(header["swizzled"]), str(header["format"]))
+        except FileNotFoundError:
+            return None
+        except Exception:
+            # corrupt or from an incompatible version. convert it again
+            try:
+                filepath.unlink()
+            except OSError:
+                pass
+            return None
+
+        try:
+            # touch it so pruning removes least recently used textures first
+            os.utime(str(filepath))
+        except OSError:
+            pass
+
+        return texture
+
+    def set_texture(self, key, texture_block, texture_info, swizzled, fmt):
+        filepath = self.get_filepath(key)
+        temppath = filepath.with_name(
+            "%s.%s.temp" % (filepath.name, os.getpid()))
+        try:
+            texture_info = dict(texture_info)
+            palette = texture_info.pop("palette", None)
+            if not all(isinstance(v, _json_types)
+                       for v in texture_info.values()):
+                raise TypeError("Can only cache json serializable infos.")
+
+            if palette is not None:
+                palette = [
+                    array('B', entry) if isinstance(entry, (bytes, bytearray))
+                    else entry for entry in palette]
+
+            header = dict(
+                version=self.version, byteorder=sys.byteorder,
+                format=fmt, swizzled=bool(swizzled), texture_info=texture_info,
+                arrays=_get_array_layout(texture_block),
+                palette=None if palette is None else _get_array_layout(palette))
+
+            filepath.parent.mkdir(parents=True, exist_ok=True)
+            with temppath.open('wb') as f:
+                f.write(json.dumps(header).encode("utf-8") + b"\n")
+                for pixels in texture_block:
+                    f.write(pixels)
+                for entry in palette or ():
+                    f.write(entry)
+
+            os.replace(str(temppath), str(filepath))
+        except Exception:
+            # caching is only an optimization, so failing to isn't an error
+            try:
+                temppath.unlink()
+            except OSError:
+                pass
+
+    def prune(self, max_size=DEFAULT_MAX_TEXTURE_CACHE_SIZE):
+        '''
+        Deletes the least recently used textures until the
+        cache takes up no more than max_size bytes.
+        '''
+        entries = []
+        total_size = 0
+        for filepath in self.dirpath.glob("*/*" + self.ext):
+            try:
+                st = filepath.stat()
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, filepath))
+            total_size += st.st_size
+
+        for mtime, size, filepath in sorted(entries):
+            if total_size <= max_size:
+                break
+            try:
+                filepath.unlink()
+                total_size -= size
+            except OSError:
+                pass
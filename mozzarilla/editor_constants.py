@@ -55,6 +55,10 @@
 else:
     SETTINGS_DIR = Path(Path.home(), ".local", "share", "mek")
 
+TAG_REF_INDEX_DIR = Path(SETTINGS_DIR, "tag_ref_indices")
+BITMAP_INFO_CACHE_PATH = Path(SETTINGS_DIR, "bitmap_info_cache.json")
+BITMAP_TEXTURE_CACHE_DIR = Path(SETTINGS_DIR, "bitmap_texture_cache")
+
 MOZZ_ICON_PATH = Path(MOZZLIB_DIR, "mozzarilla.ico")
 if not MOZZ_ICON_PATH.is_file():
     MOZZ_ICON_PATH = Path(MOZZLIB_DIR, "icons", "mozzarilla.ico")
@@ -0,0 +1,32 @@
+#
+# This file is part of Mozzarilla.
+#
+# For authors and copyright check AUTHORS.TXT
+#
+# Mozzarilla is free software under the GNU General Public License v3.0.
+# See LICENSE for more information.
+#
+
+import multiprocessing
+import os
+
+__all__ = ("get_process_count", "make_process_pool", )
+
+
+def get_process_count(max_processes=None):
+    '''Returns one process per cpu, or max_processes if that's lower.'''
+    process_count = os.cpu_count() or 1
+    if max_processes:
+        process_count = min(process_count, max_processes)
+    return process_count
+
+
+def make_process_pool(max_processes=None, initializer=None, initargs=()):
+    '''
+    Returns a process pool with one process per cpu, or max_processes
+    if that's lower, whose workers each call initializer(*initargs).
+    '''
+    # spawn rather than fork, since forking a process that is
+    # running tkinter and other threads is asking for trouble.
+    return multiprocessing.get_context("spawn").Pool(
+        get_process_count(max_processes), initializer, initargs)
@@ -10,8 +10,13 @@
 
 # Legacy run module, used by older MEKs
 
+import multiprocessing
+
 from .__main__ import main
-if main():
+
+# worker processes started with spawn import the launching module again
+# as __mp_main__, so only open a window in the process that launched us.
+if multiprocessing.current_process().name == "MainProcess" and main():
     # Input was how the terminal window was kept open on Windows to show the
     # error.
     input()
@@ -0,0 +1,249 @@
+#
+# This file is part of Mozzarilla.
+#
+# For authors and copyright check AUTHORS.TXT
+#
+# Mozzarilla is free software under the GNU General Public License v3.0.
+# See LICENSE for more information.
+#
+
+from itertools import repeat
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+__all__ = (
+    "TagCheck", "register_tag_check", "get_tag_checks", "has_tag_checks",
+    "run_tag_checks", "get_field_column",
+    "SoundOggBufferCheck", "CollisionMaterialCheck", "EffectDamageRefCheck",
+    )
+
+# maps def_ids to a list of the TagCheck classes registered for them
+_tag_checks = {}
+# maps def_ids to the node path tree walked to run their checks
+_walk_trees = {}
+
+
+class TagCheck:
+    '''
+    Base class for tag specific checks run by run_tag_checks.
+    A new instance is made for every tag checked, so checks
+    are free to store state on themselves while visiting.
+    '''
+    # tuple of (node_path, method_name) pairs. node_path is relative to
+    # the tagdata, and ending a name in "[]" steps into each entry of
+    # that reflexive. The method is called with the node at the end of
+    # the path and a tuple of the indices of each entry stepped into.
+    # Every check on a tag is driven by the same traversal, so adding
+    # checks doesn't add any extra walks of the tag.
+    visitors = ()
+
+    def __init__(self, tag):
+        self.tag = tag
+
+    def finish(self):
+        '''Returns a string describing the errors found, if any.'''
+        return ""
+
+
+def register_tag_check(def_id, check_class):
+    '''Registers a TagCheck subclass to be run on tags of type def_id.'''
+    _tag_checks.setdefault(def_id, []).append(check_class)
+    _walk_trees.pop(def_id, None)
+    return check_class
+
+
+def get_tag_checks(def_id):
+    return tuple(_tag_checks.get(def_id, ()))
+
+
+def has_tag_checks(def_id):
+    return bool(_tag_checks.get(def_id))
+
+
+def run_tag_checks(tag, def_id=None):
+    '''
+    Runs all checks registered for the tag's type on it in a single
+    traversal. Returns the concatenated error strings of the checks.
+    '''
+    if def_id is None:
+        def_id = tag.def_id
+
+    check_classes = _tag_checks.get(def_id)
+    if not check_classes:
+        return ""
+
+    walk_tree = _walk_trees.get(def_id)
+    if walk_tree is None:
+        walk_tree = _walk_trees[def_id] = _make_walk_tree(check_classes)
+
+    checks = [cls(tag) for cls in check_classes]
+    _walk(tag.data.tagdata, walk_tree, (), checks)
+
+    return "".join(check.finish() for check in checks)
+
+
+def _make_walk_tree(check_classes):
+    # each tree node is a (visitors, children) tuple, where visitors is a
+    # list of (check_index, method_name) and children maps a field name
+    # and whether to step into its entries to the tree node beneath it.
+    walk_tree = ([], {})
+    for check_index, check_class in enumerate(check_classes):
+        for node_path, method_name in check_class.visitors:
+            tree_node = walk_tree
+            for name in node_path.split("."):
+                key = (name[:-2], True) if name.endswith("[]") else (name, False)
+                tree_node = tree_node[1].setdefault(key, ([], {}))
+
+            tree_node[0].append((check_index, method_name))
+
+    return walk_tree
+
+
+def _walk(node, tree_node, indices, checks):
+    visitors, children = tree_node
+    for check_index, method_name in visitors:
+        getattr(checks[check_index], method_name)(node, indices)
+
+    for (name, step_into), sub_tree_node in children.items():
+        child = node[name]
+        if not step_into:
+            _walk(child, sub_tree_node, indices, checks)
+            continue
+
+        i = 0
+        for entry in child.STEPTREE:
+            _walk(entry, sub_tree_node, indices + (i, ), checks)
+            i += 1
+
+
+def get_field_column(array, field_name):
+    '''
+    Returns a list of the value of field_name in each entry of the array.
+    The values are pulled out without going through each entry's
+    attribute lookup, which matters a lot for large arrays.
+    '''
+    if not len(array):
+        return []
+
+    field_index = array.desc['SUB_STRUCT']['NAME_MAP'][field_name]
+    return list(map(list.__getitem__, array, repeat(field_index)))
+
+
+class SoundOggBufferCheck(TagCheck):
+    visitors = (("pitch_ranges[].permutations[]", "visit_permutation"), )
+
+    def __init__(self, tag):
+        TagCheck.__init__(self, tag)
+        self.bad_ogg = []
+
+    def visit_permutation(self, perm, indices):
+        if perm.compression.enum_name != "ogg":
+            return
+        elif perm.ogg_sample_count == 0 and perm.samples.data:
+            self.bad_ogg.append(indices)
+
+    def finish(self):
+        if self.bad_ogg:
+            return ("    Bad PCM buffer size. " +
+                    "Fix by recompiling this sound.")
+        return ""
+
+
+class CollisionMaterialCheck(TagCheck):
+    visitors = (
+        ("nodes[].bsps[].surfaces", "visit_surfaces"),
+        )
+
+    def __init__(self, tag):
+        TagCheck.__init__(self, tag)
+        self.mat_ct = len(tag.data.tagdata.materials.STEPTREE)
+        self.highest_mat_num = self.lowest_mat_num = 0
+        self.bad_nodes = {}
+
+    def visit_surfaces(self, surfaces, indices):
+        mat_ct = self.mat_ct
+        materials = get_field_column(surfaces.STEPTREE, "material")
+        if not materials:
+            return
+
+        if numpy is not None:
+            materials = numpy.array(materials)
+            bad_surfaces = numpy.flatnonzero(
+                (materials < 0) | (materials >= mat_ct))
+            if not len(bad_surfaces):
+                return
+
+            bad_materials = materials[bad_surfaces]
+            highest_mat_num = int(bad_materials.max())
+            lowest_mat_num  = int(bad_materials.min())
+            bad_surfaces = bad_surfaces.tolist()
+        else:
+            bad_surfaces = [k for k, mat in enumerate(materials)
+                            if not (mat > -1 and mat < mat_ct)]
+            if not bad_surfaces:
+                return
+
+            bad_materials = [materials[k] for k in bad_surfaces]
+            highest_mat_num = max(bad_materials)
+            lowest_mat_num  = min(bad_materials)
+
+        self.highest_mat_num = max(self.highest_mat_num, highest_mat_num)
+        self.lowest_mat_num  = min(self.lowest_mat_num, lowest_mat_num)
+        i, j = indices
+        self.bad_nodes.setdefault(i, {})[j] = bad_surfaces
+
+    def finish(self):
+        if not self.bad_nodes:
+            return ""
+
+        mat_ct = self.mat_ct
+        nodes = self.tag.data.tagdata.nodes.STEPTREE
+        err = "    Bad collision material numbers.\n"
+        if self.lowest_mat_num > -1:
+            # none of the material numbers are below zero, so
+            # it's possible to fix this by adding more materials.
+            err += (("    Change the material numbers of these " +
+                     "surfaces to be <= %s or add %s materials.\n")
+                    % (mat_ct - 1, (self.highest_mat_num + 1) - mat_ct))
+        else:
+            err += (("    Change the material numbers of these " +
+                     "surfaces to be >= 0 and <= %s\n") % (mat_ct - 1))
+
+        for i in sorted(self.bad_nodes.keys()):
+            bad_bsps = self.bad_nodes[i]
+            err += "    %s(node #%s)\n" % (nodes[i].name, i)
+            for j in sorted(bad_bsps.keys()):
+                err += "        bsp #%s\n" % j
+                err += "            surfaces = %s\n" % bad_bsps[j]
+            err += "\n"
+
+        return err[:-1]
+
+
+class EffectDamageRefCheck(TagCheck):
+    visitors = (("events[].parts[]", "visit_part"), )
+
+    def __init__(self, tag):
+        TagCheck.__init__(self, tag)
+        self.errors = []
+
+    def visit_part(self, part, indices):
+        # tool exceptions if any parts reference a damage effect
+        # tag type, but have an empty filepath for the reference
+        if (part.type.tag_class.enum_name == "damage_effect" and
+            not part.type.filepath):
+            i, j = indices
+            self.errors.append(
+                "     Missing filepath in damage_effect "
+                "reference in part %s of event %s\n." % (j, i))
+
+    def finish(self):
+        return "".join(self.errors)
+
+
+register_tag_check("snd!", SoundOggBufferCheck)
+register_tag_check("coll", CollisionMaterialCheck)
+register_tag_check("effe", EffectDamageRefCheck)
@@ -0,0 +1,226 @@
+#
+# This file is part of Mozzarilla.
+#
+# For authors and copyright check AUTHORS.TXT
+#
+# Mozzarilla is free software under the GNU General Public License v3.0.
+# See LICENSE for more information.
+#
+
+import os
+
+from itertools import chain
+from pathlib import Path, PureWindowsPath
+
+from supyr_struct.util import tagpath_to_fullpath
+
+from mozzarilla import tag_scanning
+
+__all__ = (
+    "TagClosureReport", "resolve_tag_ref", "get_closure_jobs",
+    "iter_closure_results", "format_closure_report",
+    )
+
+
+class TagClosureReport:
+    '''
+    Totals of the dependency closure of a tag, made by adding
+    the TagScanResult of each tag in the closure to it.
+    '''
+    def __init__(self, root_filepath):
+        self.root_filepath = str(root_filepath)
+        self.tag_count = 0
+        self.total_size = 0
+        # maps tag extensions to [tag count, total bytes]
+        self.ext_totals = {}
+        # list of (size, filepath) of every tag in the closure
+        self.tag_sizes = []
+        # list of (filepath, block_path, missing_path)
+        self.missing = []
+        # list of (filepath, specific_error)
+        self.specific_errors = []
+        # list of filepaths of tags that couldn't be read
+        self.unreadable = []
+
+    def add_result(self, rel_filepath, result, size=None):
+        rel_filepath = str(rel_filepath)
+        if not result.loaded:
+            self.unreadable.append(rel_filepath)
+            return
+
+        if size is None:
+            try:
+                size = os.stat(result.tag_filepath).st_size
+            except OSError:
+                size = 0
+
+        ext = os.path.splitext(rel_filepath)[-1].lower()
+        ext_total = self.ext_totals.setdefault(ext, [0, 0])
+        ext_total[0] += 1
+        ext_total[1] += size
+
+        self.tag_count += 1
+        self.total_size += size
+        self.tag_sizes.append((size, rel_filepath))
+        for name, missing_path, block_path in result.broken_refs:
+            self.missing.append((rel_filepath, block_path, missing_path))
+
+        if result.specific_error:
+            self.specific_errors.append(
+                (rel_filepath, result.specific_error))
+
+
+def resolve_tag_ref(handler, ref_filepath, ext):
+    '''
+    Returns the tags directory relative path of the tag referenced by the
+    given filepath and extension, or None if it doesn't exist. Resolves
+    the same way tag_scanning.tag_ref_exists checks for existence.
+    '''
+    filepath = tagpath_to_fullpath(
+        handler.tagsdir, PureWindowsPath(ref_filepath), extension=ext)
+
+    if filepath is None and (getattr(handler, "treat_mode_as_mod2", False)
+                             and ext == '.model'):
+        filepath = tagpath_to_fullpath(
+            handler.tagsdir, PureWindowsPath(ref_filepath),
+            extension='.gbxmodel')
+
+    if filepath is None:
+        return None
+
+    try:
+        return Path(filepath).relative_to(handler.tagsdir)
+    except ValueError:
+        return None
+
+
+def get_closure_jobs(frontier, chunk_size=32):
+    '''
+    Splits the (def_id, rel_filepath) pairs in the frontier
+    into (def_id, filepaths) jobs for the worker processes.
+    Jobs are yielded in the order the pairs are in.
+    '''
+    chunk_size = max(1, chunk_size)
+    def_id = chunk = None
+    for tag_def_id, rel_filepath in frontier:
+        if chunk and (tag_def_id != def_id or len(chunk) >= chunk_size):
+            yield def_id, chunk
+            chunk = None
+
+        if not chunk:
+            def_id, chunk = tag_def_id, []
+        chunk.append(rel_filepath)
+
+    if chunk:
+        yield def_id, chunk
+
+
+def iter_closure_results(handler, rel_filepath, pool=None, chunk_size=32,
+                         ref_index=None):
+    '''
+    Walks the dependency closure of the tag at the tags directory relative
+    rel_filepath breadth first, yielding a (rel_filepath, TagScanResult)
+    pair for every tag in it, starting with the root tag. Each tag is only
+    read once, with its references and tag specific checks coming from
+    the same scan. If a process pool from tag_scanning.make_worker_pool
+    is given, each breadth of tags is scanned by it in parallel.
+
+    Tags loaded in the editor are always scanned in this process since
+    they may have unsaved edits. If a TagRefIndex is given, the results
+    of the tags it has up to date results for are used instead.
+    '''
+    seen_tags = set()
+    tags_to_scan = [Path(rel_filepath)]
+    while tags_to_scan:
+        frontier = []
+        local_tags = {}
+        for rel_filepath in tags_to_scan:
+            key = str(rel_filepath)
+            if not handler.case_sensitive:
+                key = key.lower()
+            if key in seen_tags:
+                continue
+
+            seen_tags.add(key)
+            tag_path = handler.tagsdir.joinpath(rel_filepath)
+            def_id = handler.get_def_id(tag_path)
+            result = None
+            if ref_index is not None:
+                try:
+                    st = os.stat(str(tag_path))
+                    result = ref_index.get_result(
+                        tag_path, [st.st_size, st.st_mtime_ns])
+                except OSError:
+                    pass
+
+            tag = tag_scanning.get_loaded_tag(handler, def_id, tag_path)
+            if tag is not None:
+                result = None
+
+            if result is not None or tag is not None or pool is None:
+                local_tags[rel_filepath] = (result, tag)
+            frontier.append((def_id, rel_filepath))
+
+        pool_results = chain.from_iterable(pool.imap(
+            tag_scanning.scan_tag_paths, get_closure_jobs(
+                [(def_id, rel_filepath) for def_id, rel_filepath in frontier
+                 if rel_filepath not in local_tags], chunk_size)
+            )) if pool is not None else ()
+
+        tags_to_scan = []
+        for def_id, rel_filepath in frontier:
+            if rel_filepath not in local_tags:
+                result = next(pool_results)
+            else:
+                result, tag = local_tags[rel_filepath]
+                if result is None:
+                    result = tag_scanning.scan_tag_path(
+                        handler, def_id, rel_filepath, tag)
+
+            for name, ref_filepath, ext, exists, block_path in result.refs:
+                if exists:
+                    ref_rel_filepath = resolve_tag_ref(
+                        handler, ref_filepath, ext)
+                    if ref_rel_filepath is not None:
+                        tags_to_scan.append(ref_rel_filepath)
+
+            yield rel_filepath, result
+
+
+def format_closure_report(report, top_count=20):
+    '''Returns the text of a preflight report of the dependency closure.'''
+    lines = [
+        "Preflight report for '%s'" % report.root_filepath,
+        "",
+        "%s tags totaling %s bytes" % (report.tag_count, report.total_size),
+        "",
+        "Bytes by tag type:",
+        ]
+
+    for ext, (count, size) in sorted(report.ext_totals.items(),
+                                     key=lambda item: -item[1][1]):
+        lines.append("    %-24s %8s tags %14s bytes" % (ext[1:], count, size))
+
+    lines.extend(("", "Largest tags:"))
+    for size, rel_filepath in sorted(report.tag_sizes,
+                                     reverse=True)[: top_count]:
+        lines.append("    %14s  %s" % (size, rel_filepath))
+
+    lines.extend(("", "%s missing references:" % len(report.missing)))
+    for rel_filepath, block_path, missing_path in sorted(report.missing):
+        lines.append("    %s\n        %s\n        %s" %
+                     (rel_filepath, block_path, missing_path))
+
+    if report.unreadable:
+        lines.extend(("", "%s tags could not be read:" %
+                      len(report.unreadable)))
+        lines.extend("    %s" % rel_filepath
+                     for rel_filepath in sorted(report.unreadable))
+
+    if report.specific_errors:
+        lines.extend(("", "Tag specific errors:"))
+        for rel_filepath, err in sorted(report.specific_errors):
+            lines.append(err.rstrip("\n"))
+
+    lines.append("")
+    return "\n".join(lines)
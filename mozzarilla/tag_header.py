@@ -0,0 +1,76 @@
+#
+# This file is part of Mozzarilla.
+#
+# For authors and copyright check AUTHORS.TXT
+#
+# Mozzarilla is free software under the GNU General Public License v3.0.
+# See LICENSE for more information.
+#
+
+__all__ = (
+    "TAG_HEADER_SIZE", "TagHeader", "read_tag_header",
+    "get_tag_class", "get_handler_tag_class",
+    )
+
+# layout of the parts of the blam tag header we care about
+TAG_HEADER_SIZE = 64
+TAG_CLASS_OFFSET = 36
+VERSION_OFFSET = 56
+ENGINE_ID_OFFSET = 60
+
+
+class TagHeader:
+    '''The fields of a blam tag header needed to classify a file.'''
+    __slots__ = ("tag_class", "version", "engine_id")
+
+    def __init__(self, tag_class, version, engine_id):
+        self.tag_class = tag_class
+        self.version = version
+        self.engine_id = engine_id
+
+
+def read_tag_header(filepath):
+    '''
+    Reads only the header at the start of the file at filepath and
+    returns it as a TagHeader. Returns None if the file can't be read
+    or is too small to be a tag.
+    '''
+    try:
+        with open(str(filepath), 'rb') as f:
+            data = f.read(TAG_HEADER_SIZE)
+    except OSError:
+        return None
+
+    if len(data) < TAG_HEADER_SIZE:
+        return None
+
+    return TagHeader(
+        data[TAG_CLASS_OFFSET: TAG_CLASS_OFFSET + 4].decode('latin-1'),
+        int.from_bytes(data[VERSION_OFFSET: VERSION_OFFSET + 2], 'big'),
+        data[ENGINE_ID_OFFSET: ENGINE_ID_OFFSET + 4].decode('latin-1'))
+
+
+def get_tag_class(filepath, tag_classes=None, engine_id="blam"):
+    '''
+    Returns the four character tag class of the tag at filepath, as
+    read from its header. Returns None if the file isn't a tag for
+    the given engine, or if tag_classes is provided and the tag
+    class isn't in it.
+    '''
+    header = read_tag_header(filepath)
+    if header is None or header.engine_id != engine_id:
+        return None
+    elif tag_classes is not None and header.tag_class not in tag_classes:
+        return None
+
+    return header.tag_class
+
+
+def get_handler_tag_class(handler, filepath):
+    '''
+    Returns the tag class of the tag at filepath if it is a tag
+    the handler has a definition for, otherwise returns None.
+    '''
+    return get_tag_class(
+        filepath, handler.defs,
+        getattr(handler, "tag_header_engine_id", "blam"))
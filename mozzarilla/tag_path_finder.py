@@ -0,0 +1,298 @@
+#
+# This file is part of Mozzarilla.
+#
+# For authors and copyright check AUTHORS.TXT
+#
+# Mozzarilla is free software under the GNU General Public License v3.0.
+# See LICENSE for more information.
+#
+
+import heapq
+import os
+import re
+
+from collections import Counter
+from pathlib import Path
+from threading import Lock, RLock
+
+from mozzarilla.tags_dir_index import get_tags_dir_index
+
+__all__ = ("TagPathIndex", "split_query", )
+
+# terms that don't exactly match any path component are matched to
+# components sharing at least this fraction of their trigrams.
+FUZZY_MIN_GRAM_RATIO = 0.5
+
+_query_split = re.compile(r"[\s/\\]+")
+
+
+def split_query(query):
+    '''Splits a search query into its lowercase terms.'''
+    return [term for term in _query_split.split(query.lower()) if term]
+
+
+def _get_grams(text):
+    return set(text[i: i + 3] for i in range(len(text) - 2))
+
+
+class TagPathIndex:
+    '''
+    In memory index of the path of every tag in a set of tags directories,
+    for finding tags by typing parts of their path. Paths are split into
+    their directory names and filename, and each unique component is
+    indexed by its trigrams. Components are shared by many paths, so
+    this is much smaller and faster than indexing every path's trigrams.
+
+    Each term of a query has to match a component of a path, either as a
+    substring or, if it matches nothing that way, by sharing most of its
+    trigrams with the component or containing its characters in order.
+    Matches in the filename rank higher.
+    '''
+    # how many paths are added or removed at a time while updating a
+    # directory. the lock is released between batches so searches
+    # aren't blocked until a large directory is fully indexed.
+    update_batch_size = 2000
+
+    def __init__(self, exts=None):
+        # if not None, only files with these lowercase extensions are indexed
+        self.exts = None if exts is None else frozenset(exts)
+
+        # maps path ids to (tags_dir, rel_path, component ids) tuples.
+        # removed paths are None and their ids are reused.
+        self._paths = []
+        self._free_ids = []
+        # maps each indexed tags directory to a dict of its rel_paths to ids
+        self._dir_paths = {}
+
+        # maps lowercase components to component ids
+        self._comp_ids = {}
+        # maps component ids to their lowercase text, and the sets of the
+        # ids of the paths with the component as a directory or filename.
+        self._comp_texts = []
+        self._comp_dir_paths = []
+        self._comp_file_paths = []
+        # maps trigrams to the set of ids of components containing them
+        self._grams = {}
+
+        self._lock = RLock()
+        # held while walking a directory, so updates of it don't overlap
+        self._update_lock = Lock()
+
+    @property
+    def path_count(self):
+        return len(self._paths) - len(self._free_ids)
+
+    @property
+    def tags_dirs(self):
+        with self._lock:
+            return tuple(self._dir_paths)
+
+    def update_dir(self, tags_dir):
+        '''
+        Adds the tags directory to the index, or if it is already indexed,
+        adds and removes paths so it matches what is in the directory.
+        Directories are walked with the shared TagsDirIndex, so only
+        directories which have changed are listed again. Searches made
+        while the directory is being updated see it partially updated.
+        '''
+        tags_dir = Path(tags_dir)
+        with self._update_lock:
+            tags_dir_index = get_tags_dir_index(tags_dir)
+            # the index may be of a directory the tags directory is in
+            prefix_len = len(tags_dir_index.get_rel_dir(tags_dir))
+            if prefix_len:
+                prefix_len += len(os.sep)
+
+            rel_paths = set(
+                entry.rel_path[prefix_len:] for entry in
+                tags_dir_index.iter_files(tags_dir, self.exts))
+
+            with self._lock:
+                dir_paths = self._dir_paths.setdefault(tags_dir, {})
+                removed = list(set(dir_paths).difference(rel_paths))
+                added = sorted(rel_paths.difference(dir_paths))
+
+            batch_size = max(1, self.update_batch_size)
+            for i in range(0, len(removed), batch_size):
+                with self._lock:
+                    for rel_path in removed[i: i + batch_size]:
+                        self._remove_path(dir_paths.pop(rel_path))
+
+            for i in range(0, len(added), batch_size):
+                with self._lock:
+                    if self._dir_paths.get(tags_dir) is not dir_paths:
+                        # removed from the index while being updated
+                        break
+
+                    for rel_path in added[i: i + batch_size]:
+                        dir_paths[rel_path] = self._add_path(
+                            tags_dir, rel_path)
+
+    def remove_dir(self, tags_dir):
+        with self._lock:
+            dir_paths = self._dir_paths.pop(Path(tags_dir), None)
+            if dir_paths is None:
+                return
+
+            for path_id in dir_paths.values():
+                self._remove_path(path_id)
+
+    def sync_dirs(self, tags_dirs):
+        '''
+        Makes the indexed directories match tags_dirs, only walking
+        directories which aren't already indexed.
+        '''
+        tags_dirs = [Path(tags_dir) for tags_dir in tags_dirs]
+        for tags_dir in set(self.tags_dirs).difference(tags_dirs):
+            self.remove_dir(tags_dir)
+
+        for tags_dir in tags_dirs:
+            if tags_dir not in self._dir_paths:
+                self.update_dir(tags_dir)
+
+    def search(self, query, limit=50):
+        '''
+        Returns a list of (tags_dir, rel_path) tuples of the tags best
+        matching the query, with the best match first. Tags in every
+        indexed tags directory are searched.
+        '''
+        terms = split_query(query)
+        if not terms:
+            return []
+
+        with self._lock:
+            candidates = None
+            term_scores = []
+            # match the most selective terms first to keep candidates small
+            for term in sorted(terms, key=len, reverse=True):
+                path_scores = self._get_path_scores(self._match_term(term))
+                if candidates is None:
+                    candidates = set(path_scores)
+                else:
+                    candidates.intersection_update(path_scores)
+
+                if not candidates:
+                    return []
+
+                term_scores.append(path_scores)
+
+            # prefer shallower and shorter paths when
+            # matches are otherwise equally good.
+            paths = self._paths
+            best = heapq.nlargest(
+                limit, candidates, key=lambda path_id: sum(
+                    path_scores[path_id] for path_scores in term_scores
+                    ) - len(paths[path_id][2])*0.01 -
+                len(paths[path_id][1])*0.0001)
+
+            return [paths[path_id][: 2] for path_id in best]
+
+    def _get_path_scores(self, comp_scores):
+        '''
+        Returns a dict mapping the ids of paths with any of the scored
+        components to the best score of their components. Matches in the
+        filename count for twice as much as matches in directory names.
+        '''
+        postings = [(score, self._comp_dir_paths[comp_id])
+                    for comp_id, score in comp_scores.items()]
+        postings.extend((score*2, self._comp_file_paths[comp_id])
+                        for comp_id, score in comp_scores.items())
+
+        # higher scores are applied last, so they
+        # replace any lower scores of the same paths.
+        path_scores = {}
+        for score, path_ids in sorted(postings, key=lambda item: item[0]):
+            path_scores.update(dict.fromkeys(path_ids, score))
+
+        return path_scores
+
+    def _match_term(self, term):
+        '''
+        Returns a dict mapping the ids of the components that match
+        the term to how well they match it.
+        '''
+        comp_texts = self._comp_texts
+        grams = _get_grams(term)
+        if grams:
+            postings = sorted((self._grams.get(gram, ()) for gram in grams),
+                              key=len)
+            comp_ids = set(postings[0]).intersection(*postings[1:])
+        else:
+            # too short for trigrams. check every component instead
+            comp_ids = range(len(comp_texts))
+
+        comp_scores = {}
+        for comp_id in comp_ids:
+            text = comp_texts[comp_id]
+            if text == term or os.path.splitext(text)[0] == term:
+                comp_scores[comp_id] = 4.0
+            elif text.startswith(term):
+                comp_scores[comp_id] = 3.0
+            elif term in text:
+                comp_scores[comp_id] = 2.0
+
+        if comp_scores or not grams:
+            return comp_scores
+
+        # nothing contains the term, so it's probably misspelled.
+        # fall back to components sharing most of its trigrams.
+        gram_counts = Counter()
+        for gram in grams:
+            gram_counts.update(self._grams.get(gram, ()))
+
+        min_count = max(1, len(grams)*FUZZY_MIN_GRAM_RATIO)
+        for comp_id, count in gram_counts.items():
+            if count >= min_count:
+                comp_scores[comp_id] = count / len(grams)
+
+        if comp_scores:
+            return comp_scores
+
+        # last resort is components containing the term's
+        # characters in order, like "wrthg" for "warthog".
+        for comp_id, text in enumerate(comp_texts):
+            chars = iter(text)
+            if all(char in chars for char in term):
+                comp_scores[comp_id] = 0.5
+
+        return comp_scores
+
+    def _add_path(self, tags_dir, rel_path):
+        comp_ids = tuple(self._get_comp_id(comp) for comp in
+                         Path(rel_path.lower()).parts)
+
+        if self._free_ids:
+            path_id = self._free_ids.pop()
+            self._paths[path_id] = (tags_dir, rel_path, comp_ids)
+        else:
+            path_id = len(self._paths)
+            self._paths.append((tags_dir, rel_path, comp_ids))
+
+        for comp_id in comp_ids[: -1]:
+            self._comp_dir_paths[comp_id].add(path_id)
+        self._comp_file_paths[comp_ids[-1]].add(path_id)
+
+        return path_id
+
+    def _remove_path(self, path_id):
+        comp_ids = self._paths[path_id][2]
+        for comp_id in comp_ids[: -1]:
+            self._comp_dir_paths[comp_id].discard(path_id)
+        self._comp_file_paths[comp_ids[-1]].discard(path_id)
+
+        self._paths[path_id] = None
+        self._free_ids.append(path_id)
+
+    def _get_comp_id(self, comp):
+        comp_id = self._comp_ids.get(comp)
+        if comp_id is not None:
+            return comp_id
+
+        comp_id = self._comp_ids[comp] = len(self._comp_texts)
+        self._comp_texts.append(comp)
+        self._comp_dir_paths.append(set())
+        self._comp_file_paths.append(set())
+        for gram in _get_grams(comp):
+            self._grams.setdefault(gram, set()).add(comp_id)
+
+        return comp_id
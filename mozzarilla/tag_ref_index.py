@@ -0,0 +1,645 @@
+#
+# This file is part of Mozzarilla.
+#
+# For authors and copyright check AUTHORS.TXT
+#
+# Mozzarilla is free software under the GNU General Public License v3.0.
+# See LICENSE for more information.
+#
+
+import hashlib
+import json
+import os
+
+from pathlib import Path, PureWindowsPath
+from threading import Event, Lock, RLock, Thread
+from traceback import format_exc
+
+from mozzarilla import tag_header, tag_scanning
+from mozzarilla.tag_refs import TagRefInfo
+from mozzarilla.tags_dir_index import get_tags_dir_index
+from mozzarilla.tags_dir_watcher import make_tags_dir_watcher
+
+__all__ = (
+    "TagRefIndex", "LiveTagRefIndex", "get_path_key", "get_ref_key",
+    "make_index_handler", "get_index_path", "get_ref_index",
+    "start_live_index", "stop_live_index", "get_live_index",
+    )
+
+# maps (handler class name, tags dir) to the LiveTagRefIndex running for it
+_live_indices = {}
+_live_indices_lock = Lock()
+# maps (handler class name, tags dir) to the TagRefIndex loaded for it
+_ref_indices = {}
+_ref_indices_lock = Lock()
+
+
+def get_path_key(rel_path):
+    '''
+    Returns the key used to match the tags directory relative path of a
+    tag to the references to it. Tag references are case insensitive
+    and use backslashes, so the key is made to match that.
+    '''
+    return str(PureWindowsPath(rel_path)).lower()
+
+
+def get_ref_key(ref_filepath, ext):
+    '''Returns the key of the tag referenced by the given path and extension.'''
+    return get_path_key(ref_filepath + ext)
+
+
+def make_index_handler(handler):
+    '''
+    Returns a new handler of the same type and for the same tags directory
+    as the given one. Indices use their own handler so they never see the
+    unsaved edits of tags loaded in the editor.
+    '''
+    own_handler = type(handler)(
+        case_sensitive=getattr(handler, "case_sensitive", False))
+    own_handler.tagsdir = Path(handler.tagsdir)
+    return own_handler
+
+
+def get_index_path(handler, index_dir):
+    '''
+    Returns the path in index_dir that the TagRefIndex for the
+    handler's type and tags directory is saved to.
+    '''
+    tags_dir_hash = hashlib.sha1(
+        str(handler.tagsdir).encode("utf-8")).hexdigest()[:16]
+    return Path(index_dir, "%s_%s.json" % (
+        type(handler).__name__, tags_dir_hash))
+
+
+class TagRefIndex:
+    '''
+    Index of the references in every tag in a tags directory.
+    Keeps the scan result of each tag(see tag_scanning.TagScanResult),
+    which serves as the forward index, and a reverse index of which
+    tags reference each tag path. When tags change, only they are
+    rescanned, and the tags referencing them only have the existence
+    of their references rechecked.
+
+    If given a filepath, the index can be saved to and loaded from it,
+    so only the tags which changed since it was saved need rescanning.
+    '''
+    version = 1
+
+    def __init__(self, handler, filepath=None):
+        self.handler = handler
+        self.handler_name = type(handler).__name__
+        self.tags_dir = Path(handler.tagsdir)
+        self.filepath = None if filepath is None else Path(filepath)
+        # maps tags directory relative paths to (def_id, stat, result)
+        self.entries = {}
+        # maps ref keys to the set of relative paths of tags referencing them
+        self.referrers = {}
+        # maps relative paths of files which aren't tags to their stat,
+        # so they aren't read again until they change
+        self.non_tags = {}
+        # maps the tags directory relative path of each directory to its
+        # mtime when last refreshed, or None if it's never been refreshed
+        self._dir_mtimes = None
+        self._lock = RLock()
+        self._refresh_lock = Lock()
+
+    def get_rel_path(self, filepath):
+        filepath = Path(filepath)
+        if filepath.is_absolute():
+            filepath = filepath.relative_to(self.tags_dir)
+        return str(filepath)
+
+    def get_result(self, filepath, stat=None):
+        '''
+        Returns the TagScanResult of the tag at filepath, or None if it
+        isn't indexed. If stat is provided, the result is only returned
+        if it was made while the tag had that [size, mtime] stat.
+        '''
+        with self._lock:
+            entry = self.entries.get(self.get_rel_path(filepath))
+
+        if entry is None or (stat is not None and entry[1] != stat):
+            return None
+        return entry[2]
+
+    def get_tag_refs(self, filepath):
+        '''
+        Returns a list of TagRefInfos for the references in the tag at
+        filepath, or None if it isn't indexed or couldn't be scanned.
+        '''
+        result = self.get_result(filepath)
+        if result is None or not result.loaded or result.scan_error:
+            return None
+
+        return [TagRefInfo(name, ref_filepath, ext[1:], block_path)
+                for name, ref_filepath, ext, exists, block_path in result.refs]
+
+    def get_referrers(self, filepath):
+        '''
+        Returns a sorted list of the relative paths of every indexed
+        tag that references the tag at filepath.
+        '''
+        key = get_path_key(self.get_rel_path(filepath))
+        keys = [key]
+        if (key.endswith(".gbxmodel") and
+                getattr(self.handler, "treat_mode_as_mod2", False)):
+            # model references are satisfied by gbxmodels
+            keys.append(key[:-len(".gbxmodel")] + ".model")
+
+        with self._lock:
+            referrers = set()
+            for key in keys:
+                referrers.update(self.referrers.get(key, ()))
+
+        return sorted(referrers)
+
+    def iter_broken_results(self):
+        '''Yields the TagScanResult of every tag with broken references.'''
+        with self._lock:
+            entries = sorted(self.entries.items())
+
+        for rel_path, (def_id, stat, result) in entries:
+            if result.broken_refs:
+                yield result
+
+    def get_ref_block_paths(self, referrer, filepath):
+        '''
+        Returns the block paths of the references in the indexed tag at
+        referrer which reference the tag at filepath.
+        '''
+        result = self.get_result(referrer)
+        if result is None:
+            return []
+
+        key = get_path_key(self.get_rel_path(filepath))
+        keys = (key, key[:-len(".gbxmodel")] + ".model"
+                if key.endswith(".gbxmodel") else key)
+        return [block_path for name, ref_filepath, ext, exists, block_path
+                in result.refs if get_ref_key(ref_filepath, ext) in keys]
+
+    def load(self):
+        '''
+        Loads the index from its filepath. If it doesn't exist, can't be
+        read, or was made for a different handler or tags directory,
+        the index is left empty and False is returned.
+        '''
+        with self._lock:
+            self.entries = {}
+            self.referrers = {}
+            self.non_tags = {}
+
+        if self.filepath is None:
+            return False
+
+        try:
+            with self.filepath.open('r') as f:
+                data = json.load(f)
+        except Exception:
+            return False
+
+        if not isinstance(data, dict) or (
+                data.get("version")  != self.version or
+                data.get("handler")  != self.handler_name or
+                data.get("tags_dir") != str(self.tags_dir)):
+            return False
+
+        try:
+            with self._lock:
+                for rel_path, entry in data.get("tags", {}).items():
+                    self._set_entry(rel_path, entry["def_id"], entry["stat"],
+                                    self._make_result(rel_path, entry))
+
+                for rel_path, stat in data.get("non_tags", {}).items():
+                    self.non_tags[rel_path] = [int(stat[0]), int(stat[1])]
+        except Exception:
+            # malformed index. start over
+            with self._lock:
+                self.entries = {}
+                self.referrers = {}
+                self.non_tags = {}
+            return False
+
+        return True
+
+    def save(self):
+        if self.filepath is None:
+            return
+
+        tags = {}
+        with self._lock:
+            for rel_path, (def_id, stat, result) in self.entries.items():
+                if result.scan_error:
+                    # not saved, so the tag is rescanned next time
+                    continue
+
+                tags[rel_path] = dict(
+                    def_id=def_id, stat=stat, loaded=result.loaded,
+                    specific_error=result.specific_error,
+                    refs=[list(ref) for ref in result.refs])
+
+            non_tags = dict(self.non_tags)
+
+        data = dict(version=self.version, handler=self.handler_name,
+                    tags_dir=str(self.tags_dir), tags=tags, non_tags=non_tags)
+
+        # write to a temp file first so an interrupted save
+        # can't leave a half written index behind.
+        self.filepath.parent.mkdir(parents=True, exist_ok=True)
+        temppath = self.filepath.with_name(self.filepath.name + ".temp")
+        with temppath.open('w') as f:
+            json.dump(data, f)
+
+        os.replace(str(temppath), str(self.filepath))
+
+    def refresh(self, stop_event=None, changed_dirs_only=False):
+        '''
+        Brings the index up to date with the tags directory. Only tags
+        whose size or mtime changed, or which were created or deleted,
+        are rescanned. Returns a sorted list of the relative paths of
+        the tags whose scan results changed, or None if stop_event is
+        provided and gets set before the refresh finishes.
+
+        If changed_dirs_only is True, the tags in directories which
+        haven't changed since the last refresh aren't checked. Tags are
+        saved to a temp file which is renamed over the old one, so
+        saving a tag changes its directory.
+        '''
+        with self._refresh_lock:
+            return self._refresh(stop_event, changed_dirs_only)
+
+    def _refresh(self, stop_event, changed_dirs_only):
+        tags_dir_index = get_tags_dir_index(self.tags_dir)
+        tags_dir = str(self.tags_dir)
+        # the shared index may be rooted above the tags directory
+        prefix_len = len(os.path.join(
+            tags_dir_index.get_rel_dir(self.tags_dir), ""))
+        with self._lock:
+            removed = set(self.entries)
+            removed.update(self.non_tags)
+
+        old_dir_mtimes = self._dir_mtimes
+        if old_dir_mtimes is None or not changed_dirs_only:
+            old_dir_mtimes = {}
+
+        dir_mtimes = {}
+        changed = []
+        for rel_dir, mtime, entries in tags_dir_index.iter_dirs(
+                self.tags_dir):
+            rel_dir = os.path.join(rel_dir, "")[prefix_len:]
+            dir_mtimes[rel_dir] = mtime
+            unchanged_dir = old_dir_mtimes.get(rel_dir) == mtime
+            for entry in entries:
+                if stop_event is not None and stop_event.is_set():
+                    return None
+
+                rel_path = entry.rel_path[prefix_len:]
+                removed.discard(rel_path)
+                if unchanged_dir:
+                    continue
+
+                try:
+                    st = os.stat(os.path.join(tags_dir, rel_path))
+                except OSError:
+                    continue
+
+                with self._lock:
+                    index_entry = self.entries.get(rel_path)
+                    if index_entry is None:
+                        stat = self.non_tags.get(rel_path)
+                    else:
+                        stat = index_entry[1]
+
+                if stat != [st.st_size, st.st_mtime_ns]:
+                    changed.append(rel_path)
+
+        changed.extend(removed)
+        changed = self.update_paths(changed, stop_event)
+        if changed is not None:
+            self._dir_mtimes = dir_mtimes
+        return changed
+
+    def update_tag(self, filepath):
+        '''
+        Rescans the tag at filepath and updates the index with it, or
+        removes it from the index if it's been deleted or isn't a tag.
+        Returns the TagScanResult, or None if it was removed.
+        '''
+        rel_path = self.get_rel_path(filepath)
+        full_path = self.tags_dir.joinpath(rel_path)
+        def_id = tag_header.get_handler_tag_class(self.handler, full_path)
+        try:
+            st = os.stat(str(full_path))
+        except OSError:
+            st = def_id = None
+
+        if def_id is None:
+            self.remove_tag(rel_path)
+            if st is not None:
+                with self._lock:
+                    self.non_tags[rel_path] = [st.st_size, st.st_mtime_ns]
+            return None
+
+        result = tag_scanning.scan_tag_path(
+            self.handler, def_id, Path(rel_path))
+        with self._lock:
+            self._set_entry(
+                rel_path, def_id, [st.st_size, st.st_mtime_ns], result)
+
+        return result
+
+    def remove_tag(self, filepath):
+        rel_path = self.get_rel_path(filepath)
+        with self._lock:
+            self._remove_referrers(rel_path)
+            self.entries.pop(rel_path, None)
+            self.non_tags.pop(rel_path, None)
+
+    def recheck_refs(self, rel_path):
+        '''
+        Rechecks whether the tags referenced by the indexed tag still
+        exist, without rescanning the tag. Returns whether anything
+        about the tag's broken references changed.
+        '''
+        with self._lock:
+            entry = self.entries.get(rel_path)
+            if entry is None:
+                return False
+
+            def_id, stat, old_result = entry
+            result = tag_scanning.TagScanResult(old_result.filepath)
+            result.loaded = old_result.loaded
+            result.tag_filepath = old_result.tag_filepath
+            result.def_id = old_result.def_id
+            result.specific_error = old_result.specific_error
+            for name, ref_filepath, ext, exists, block_path in old_result.refs:
+                exists = tag_scanning.tag_ref_exists(
+                    self.handler, ref_filepath, ext)
+                result.refs.append(
+                    (name, ref_filepath, ext, exists, block_path))
+                if not exists:
+                    result.broken_refs.append(
+                        (name, ref_filepath + ext, block_path))
+
+            self.entries[rel_path] = (def_id, stat, result)
+            return result.broken_refs != old_result.broken_refs
+
+    def update_paths(self, rel_paths, stop_event=None):
+        '''
+        Updates the index after the given tags directory relative paths
+        were created, modified or deleted. A path may be a directory, in
+        which case every tag under it is updated. If rel_paths is None,
+        every tag in the index is updated. Returns a sorted list of the
+        relative paths of the tags whose scan results changed, or None
+        if stop_event is provided and gets set before the update finishes.
+        '''
+        if rel_paths is None:
+            with self._lock:
+                rel_paths = set(self.entries)
+
+            tags_dir_index = get_tags_dir_index(self.tags_dir)
+            root = tags_dir_index.root
+            rel_paths.update(
+                str(root.joinpath(entry.rel_path).relative_to(self.tags_dir))
+                for entry in tags_dir_index.iter_files(self.tags_dir))
+
+        tag_paths = set()
+        for rel_path in rel_paths:
+            full_path = self.tags_dir.joinpath(rel_path)
+            if full_path.is_dir() or not full_path.exists():
+                # the directory was deleted or created, so everything
+                # indexed under it, or on disk under it, is affected
+                prefix = os.path.join(str(rel_path), "")
+                with self._lock:
+                    tag_paths.update(path for path in self.entries
+                                     if path.startswith(prefix))
+                    tag_paths.update(path for path in self.non_tags
+                                     if path.startswith(prefix))
+
+                if full_path.is_dir():
+                    tags_dir_index = get_tags_dir_index(self.tags_dir)
+                    root = tags_dir_index.root
+                    tag_paths.update(
+                        str(root.joinpath(entry.rel_path)
+                            .relative_to(self.tags_dir))
+                        for entry in tags_dir_index.iter_files(full_path))
+
+            if not full_path.is_dir():
+                tag_paths.add(str(rel_path))
+
+        changed = set()
+        referrers = set()
+        for rel_path in tag_paths:
+            if stop_event is not None and stop_event.is_set():
+                return None
+
+            was_indexed = rel_path in self.entries
+            if self.update_tag(rel_path) is not None or was_indexed:
+                changed.add(rel_path)
+                referrers.update(self.get_referrers(rel_path))
+
+        # the tags referencing the changed tags only need the existence
+        # of their references rechecked, rather than being rescanned
+        for rel_path in referrers.difference(changed):
+            if stop_event is not None and stop_event.is_set():
+                return None
+
+            if self.recheck_refs(rel_path):
+                changed.add(rel_path)
+
+        return sorted(changed)
+
+    def _make_result(self, rel_path, entry):
+        result = tag_scanning.TagScanResult(rel_path)
+        result.loaded = entry["loaded"]
+        result.tag_filepath = str(self.tags_dir.joinpath(rel_path))
+        result.specific_error = entry["specific_error"]
+        if result.specific_error:
+            result.def_id = entry["def_id"]
+
+        for name, ref_filepath, ext, exists, block_path in entry["refs"]:
+            result.refs.append((name, ref_filepath, ext, exists, block_path))
+            if not exists:
+                result.broken_refs.append(
+                    (name, ref_filepath + ext, block_path))
+
+        return result
+
+    def _set_entry(self, rel_path, def_id, stat, result):
+        self._remove_referrers(rel_path)
+        self.non_tags.pop(rel_path, None)
+        self.entries[rel_path] = (def_id, stat, result)
+        for name, ref_filepath, ext, exists, block_path in result.refs:
+            self.referrers.setdefault(
+                get_ref_key(ref_filepath, ext), set()).add(rel_path)
+
+    def _remove_referrers(self, rel_path):
+        entry = self.entries.get(rel_path)
+        if entry is None:
+            return
+
+        for name, ref_filepath, ext, exists, block_path in entry[2].refs:
+            key = get_ref_key(ref_filepath, ext)
+            referrers = self.referrers.get(key)
+            if referrers is None:
+                continue
+
+            referrers.discard(rel_path)
+            if not referrers:
+                del self.referrers[key]
+
+
+class LiveTagRefIndex(TagRefIndex):
+    '''
+    A TagRefIndex which is loaded and refreshed in a background thread,
+    and then kept current by a watcher on the tags directory. It is
+    saved when stopped, if it was given a filepath.
+    Functions in listeners are called with the sorted list of relative
+    paths of the tags whose results changed, from the watcher thread.
+    '''
+    def __init__(self, handler, use_polling=False, filepath=None):
+        TagRefIndex.__init__(self, make_index_handler(handler), filepath)
+        self.use_polling = use_polling
+        self.listeners = []
+        self.ready = Event()
+        self._stop_event = Event()
+        self._watcher = None
+        self._build_thread = None
+
+    def start(self):
+        self._stop_event.clear()
+        self._build_thread = Thread(target=self._build)
+        self._build_thread.daemon = True
+        self._build_thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        # the build makes the watcher, so it has to finish first
+        if self._build_thread is not None:
+            self._build_thread.join()
+            self._build_thread = None
+
+        if self._watcher is not None:
+            self._watcher.stop()
+            self._watcher = None
+
+        if self.ready.is_set():
+            try:
+                self.save()
+            except Exception:
+                print(format_exc())
+                print("Could not save tag reference index.")
+
+    def _build(self):
+        print("Indexing tag references in '%s'..." % self.tags_dir)
+        try:
+            # the watcher is made here since setting it up walks the
+            # tags directory. it's started before refreshing so changes
+            # made while building aren't missed. they're applied afterward.
+            self._watcher = make_tags_dir_watcher(
+                self.tags_dir, self._tags_dir_changed, self.use_polling)
+            if self._stop_event.is_set():
+                return
+
+            self.load()
+            if self.refresh(self._stop_event) is not None:
+                self.ready.set()
+                self.save()
+                print("Finished indexing tag references in '%s'." %
+                      self.tags_dir)
+        except Exception:
+            print(format_exc())
+            print("Could not index tag references in '%s'." % self.tags_dir)
+
+    def _tags_dir_changed(self, rel_paths):
+        if not self.ready.is_set():
+            # the tags are still being indexed, so the changes will be
+            # picked up by the build unless it's already passed them.
+            self._build_thread.join()
+
+        changed = self.update_paths(rel_paths, self._stop_event)
+        if not changed:
+            return
+
+        for listener in tuple(self.listeners):
+            try:
+                listener(changed)
+            except Exception:
+                print(format_exc())
+
+
+def _get_live_key(handler):
+    return (type(handler).__name__, str(handler.tagsdir))
+
+
+def get_ref_index(handler, index_dir=None):
+    '''
+    Returns an up to date TagRefIndex for the handler's tags directory.
+    If a LiveTagRefIndex is running for it, that is returned. Otherwise
+    the index kept for this session is refreshed and returned, being
+    loaded from index_dir the first time if index_dir is provided.
+    Only tags which changed since the index was last saved are rescanned,
+    and after the first refresh this session, only the directories which
+    changed since the last refresh are checked.
+    '''
+    live_index = get_live_index(handler)
+    if live_index is not None:
+        return live_index
+
+    key = _get_live_key(handler)
+    with _ref_indices_lock:
+        ref_index = _ref_indices.get(key)
+        if ref_index is None:
+            ref_index = TagRefIndex(
+                make_index_handler(handler), None if index_dir is None else
+                get_index_path(handler, index_dir))
+            ref_index.load()
+            _ref_indices[key] = ref_index
+
+    changed = ref_index.refresh(changed_dirs_only=True)
+    if changed or (ref_index.filepath is not None and
+                   not ref_index.filepath.is_file()):
+        try:
+            ref_index.save()
+        except Exception:
+            print(format_exc())
+            print("Could not save tag reference index.")
+
+    return ref_index
+
+
+def start_live_index(handler, use_polling=False, index_dir=None):
+    '''
+    Starts a LiveTagRefIndex for the handler's tags directory,
+    unless one is already running, and returns it. If index_dir is
+    provided, the index is loaded from and saved to it.
+    '''
+    key = _get_live_key(handler)
+    with _live_indices_lock:
+        live_index = _live_indices.get(key)
+        if live_index is None:
+            live_index = _live_indices[key] = LiveTagRefIndex(
+                handler, use_polling, None if index_dir is None else
+                get_index_path(handler, index_dir))
+            live_index.start()
+
+    return live_index
+
+
+def stop_live_index(handler):
+    with _live_indices_lock:
+        live_index = _live_indices.pop(_get_live_key(handler), None)
+
+    if live_index is not None:
+        live_index.stop()
+
+
+def get_live_index(handler, ready_only=True):
+    '''
+    Returns the LiveTagRefIndex running for the handler's tags directory,
+    or None if there isn't one. If ready_only is True, None is also
+    returned if the index is still being built.
+    '''
+    live_index = _live_indices.get(_get_live_key(handler))
+    if live_index is None or (ready_only and not live_index.ready.is_set()):
+        return None
+    return live_index
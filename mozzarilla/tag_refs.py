@@ -0,0 +1,478 @@
+#
+# This file is part of Mozzarilla.
+#
+# For authors and copyright check AUTHORS.TXT
+#
+# Mozzarilla is free software under the GNU General Public License v3.0.
+# See LICENSE for more information.
+#
+
+import mmap
+import os
+
+from pathlib import Path
+from threading import Lock
+
+from reclaimer.constants import SANE_MAX_REFLEXIVE_COUNT
+
+__all__ = (
+    "TagRefInfo", "TagRefsCache", "get_block_path", "get_tag_refs",
+    "read_tag_refs", "load_tag_refs", "get_cached_tag_refs",
+    "tag_refs_cache",
+    )
+
+# kinds of steptrees the reference-only reader knows how to step over
+_REFLEXIVE = 1
+_RAWDATA = 2
+_TAGREF = 3
+
+# maps id(desc) to (desc, plan) so plans are only made once per descriptor.
+# the desc is kept in the value so its id can't be reused by another.
+_plan_cache = {}
+_has_steptrees_cache = {}
+
+
+class _UnreadableLayout(Exception):
+    '''
+    Raised when a tag's layout or data is something the reference-only
+    reader doesn't handle. The caller falls back to a full parse.
+    '''
+
+
+class TagRefInfo:
+    '''
+    Lightweight copy of the parts of a tag reference block that the
+    scanner and dependency tools need. Unlike a block, it keeps no
+    references to the tag it came from.
+    '''
+    __slots__ = ("NAME", "filepath", "tag_class_name", "block_path")
+
+    def __init__(self, name, filepath, tag_class_name, block_path=""):
+        self.NAME = name
+        self.filepath = filepath
+        self.tag_class_name = tag_class_name
+        self.block_path = block_path
+
+    @classmethod
+    def from_block(cls, block):
+        return cls(block.NAME, block.filepath,
+                   block.tag_class.enum_name, get_block_path(block))
+
+
+def get_block_path(block):
+    '''
+    Returns the path to the block from the root of its tag, in the
+    form "tagdata.regions[0].permutations[1].gbxmodel"
+    '''
+    block_path = ""
+    node = block
+    parent = node.parent
+    while parent is not None and hasattr(parent, 'NAME'):
+        if parent.TYPE.is_array:
+            block_path = '[%s]%s' % (parent.index_by_id(node), block_path)
+        elif node.TYPE.is_array and getattr(parent, 'STEPTREE', None) is node:
+            # a reflexive's array is indexed as if it were the reflexive
+            pass
+        else:
+            block_path = '.%s%s' % (node.NAME, block_path)
+        node = parent
+        parent = node.parent
+
+    return block_path.lstrip('.')
+
+
+def get_tag_refs(handler, tag, def_id=None):
+    '''
+    Returns a list of TagRefInfos for every non-empty tag
+    reference in the given fully parsed tag.
+    '''
+    if def_id is None:
+        def_id = tag.def_id
+
+    tag_ref_paths = handler.tag_ref_cache.get(def_id)
+    if not tag_ref_paths:
+        return []
+
+    return [TagRefInfo.from_block(block) for block in
+            handler.get_nodes_by_paths(tag_ref_paths, tag.data)
+            if block.filepath]
+
+
+def read_tag_refs(handler, filepath, def_id=None):
+    '''
+    Reads the non-empty tag references out of the tag file at filepath
+    without fully parsing it. Only the reflexives needed to reach the
+    references are walked. Raw data, like lightmap vertices or pixel
+    data, is stepped over without being read.
+
+    Returns a list of TagRefInfos in the same order get_tag_refs would
+    return them, or None if the tag's layout or data can't be handled
+    this way, in which case the tag should be fully parsed instead.
+    '''
+    filepath = Path(filepath)
+    if not filepath.is_absolute():
+        filepath = handler.tagsdir.joinpath(filepath)
+
+    if def_id is None:
+        def_id = handler.get_def_id(filepath)
+
+    tagdef = handler.defs.get(def_id)
+    if tagdef is None:
+        return None
+
+    try:
+        root_plan = _get_root_plan(tagdef.descriptor)
+        with filepath.open('rb') as f:
+            try:
+                # map the file rather than reading it so that the
+                # pages holding raw data are never touched.
+                rawdata = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except (OSError, ValueError):
+                rawdata = f.read()
+
+        try:
+            return [ref for ref in _read_refs(root_plan, rawdata)
+                    if ref.filepath]
+        finally:
+            if isinstance(rawdata, mmap.mmap):
+                rawdata.close()
+    except (_UnreadableLayout, OSError):
+        return None
+
+
+def load_tag_refs(handler, filepath, get_tag=None, ref_index=None):
+    '''
+    Returns the TagRefInfos for the tag at the tagsdir relative filepath.
+    If the tag is loaded its references are taken from it, since it may
+    have unsaved edits. Otherwise they're taken from ref_index if it's
+    provided and has them(see tag_ref_index.TagRefIndex), or read with
+    read_tag_refs, and if that can't handle the tag, get_tag(filepath)
+    is called to fully load it instead. Returns None if the tag can't
+    be read.
+    '''
+    def_id = handler.get_def_id(filepath)
+    tag = _get_loaded_tag(handler, filepath, def_id)
+    if tag is None and ref_index is not None:
+        refs = ref_index.get_tag_refs(filepath)
+        if refs is not None:
+            return refs
+
+    if tag is None:
+        refs = read_tag_refs(handler, filepath, def_id)
+        if refs is not None:
+            return refs
+        elif get_tag is not None:
+            tag = get_tag(filepath)
+
+    if tag is None:
+        return None
+
+    return get_tag_refs(handler, tag)
+
+
+class TagRefsCache:
+    '''
+    Memoizes the TagRefInfos of tags by their filepath for as long as
+    their size and mtime stay the same, so a tag that appears many times
+    in a dependency tree is only read once. Tags loaded in the editor
+    are never cached, since they may have unsaved edits.
+    '''
+    def __init__(self):
+        # maps (handler class name, filepath) to ((size, mtime), refs)
+        self._cache = {}
+        self._lock = Lock()
+
+    def get_tag_refs(self, handler, filepath, get_tag=None, ref_index=None):
+        '''
+        Returns the same thing load_tag_refs would, taking it from the
+        cache if the tag hasn't changed since it was cached.
+        '''
+        refs = self.get_cached(handler, filepath)
+        if refs is None:
+            refs = load_tag_refs(handler, filepath, get_tag, ref_index)
+            self.set_cached(handler, filepath, refs)
+        return refs
+
+    def get_cached(self, handler, filepath):
+        '''
+        Returns the cached TagRefInfos of the tag at filepath, or None if
+        they aren't cached, the tag changed, or the tag is loaded.
+        '''
+        key, stat = self._get_key_and_stat(handler, filepath)
+        if key is None:
+            return None
+
+        with self._lock:
+            cached = self._cache.get(key)
+
+        if cached is None or cached[0] != stat:
+            return None
+        return list(cached[1])
+
+    def set_cached(self, handler, filepath, refs):
+        '''Caches the TagRefInfos read from the tag at filepath.'''
+        if refs is None:
+            return
+
+        key, stat = self._get_key_and_stat(handler, filepath)
+        if key is not None:
+            with self._lock:
+                self._cache[key] = (stat, tuple(refs))
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+
+    def _get_key_and_stat(self, handler, filepath):
+        full_path = Path(filepath)
+        if not full_path.is_absolute():
+            full_path = handler.tagsdir.joinpath(full_path)
+
+        if _get_loaded_tag(handler, filepath) is not None:
+            return None, None
+
+        try:
+            st = os.stat(str(full_path))
+        except OSError:
+            return None, None
+
+        return ((type(handler).__name__, str(full_path)),
+                (st.st_size, st.st_mtime_ns))
+
+
+# the cache shared by the dependency viewer, its tree, and the zipper
+tag_refs_cache = TagRefsCache()
+
+
+def get_cached_tag_refs(handler, filepath, get_tag=None, ref_index=None):
+    '''
+    Returns the TagRefInfos for the tag at the tagsdir relative filepath,
+    same as load_tag_refs, but memoized in tag_refs_cache.
+    '''
+    return tag_refs_cache.get_tag_refs(handler, filepath, get_tag, ref_index)
+
+
+def _get_loaded_tag(handler, filepath, def_id=None):
+    if def_id is None:
+        def_id = handler.get_def_id(filepath)
+
+    try:
+        return handler.get_tag(filepath, def_id)
+    except (KeyError, LookupError):
+        return None
+
+
+def _has_steptrees(desc):
+    key = id(desc)
+    cached = _has_steptrees_cache.get(key)
+    if cached is not None and cached[0] is desc:
+        return cached[1]
+
+    has_steptrees = 'STEPTREE' in desc
+    for val in desc.values():
+        if has_steptrees:
+            break
+        elif not isinstance(val, dict):
+            continue
+        elif 'TYPE' in val:
+            has_steptrees = _has_steptrees(val)
+        else:
+            # things like a switch's CASES are dicts of descriptors
+            has_steptrees = any(_has_steptrees(sub_desc)
+                                for sub_desc in val.values()
+                                if isinstance(sub_desc, dict))
+
+    _has_steptrees_cache[key] = (desc, has_steptrees)
+    return has_steptrees
+
+
+def _get_root_plan(desc):
+    key = id(desc)
+    cached = _plan_cache.get(key)
+    if cached is None or cached[0] is not desc:
+        try:
+            plan = _make_root_plan(desc)
+        except _UnreadableLayout as e:
+            plan = e
+        cached = _plan_cache[key] = (desc, plan)
+
+    if isinstance(cached[1], _UnreadableLayout):
+        raise cached[1]
+    return cached[1]
+
+
+def _make_root_plan(desc):
+    # the root of a tag is parsed field by field, one after another,
+    # with the steptrees of every field parsed after all the fields.
+    if not desc['TYPE'].is_container:
+        raise _UnreadableLayout()
+
+    root_plan = []
+    for i in range(desc['ENTRIES']):
+        f_desc = desc[i]
+        size = f_desc.get('SIZE')
+        if not isinstance(size, int) or 'POINTER' in f_desc:
+            raise _UnreadableLayout()
+
+        root_plan.append((size, f_desc['NAME'], _get_struct_plan(f_desc)))
+
+    return tuple(root_plan)
+
+
+def _get_struct_plan(desc):
+    '''
+    Returns None if the struct contains no steptrees. Otherwise returns a
+    (steptree_plan, children) tuple describing where the struct and its
+    nested structs have steptrees, and how to step over each of them.
+    '''
+    if not _has_steptrees(desc):
+        return None
+
+    key = id(desc)
+    cached = _plan_cache.get(key)
+    if cached is not None and cached[0] is desc:
+        return cached[1]
+
+    f_type = desc['TYPE']
+    if (not f_type.is_struct or 'ATTR_OFFS' not in desc or
+            'POINTER' in desc or 'ALIGN' in desc):
+        raise _UnreadableLayout()
+
+    steptree_plan = None
+    if 'STEPTREE' in desc:
+        steptree_plan = _make_steptree_plan(desc)
+
+    children = []
+    for i, attr_off in enumerate(desc['ATTR_OFFS']):
+        sub_plan = _get_struct_plan(desc[i])
+        if sub_plan is not None:
+            children.append((attr_off, desc[i]['NAME'], sub_plan))
+
+    plan = (steptree_plan, tuple(children))
+    _plan_cache[key] = (desc, plan)
+    return plan
+
+
+def _get_field_reader(desc, name):
+    i = desc['NAME_MAP'][name]
+    f_type = desc[i]['TYPE']
+    return desc['ATTR_OFFS'][i], f_type.size, f_type.struct_unpacker
+
+
+def _make_steptree_plan(desc):
+    type_name = desc['TYPE'].name
+    s_desc = desc['STEPTREE']
+    s_type = s_desc['TYPE']
+    try:
+        if type_name in ("Reflexive", "RawReflexive"):
+            sub_desc = s_desc['SUB_STRUCT']
+            sub_size = sub_desc['SIZE']
+            if (not s_type.is_array or s_desc.get('SIZE') != ".size" or
+                    not isinstance(sub_size, int)):
+                raise _UnreadableLayout()
+
+            return (_REFLEXIVE, _get_field_reader(desc, 'size'), sub_size,
+                    _get_struct_plan(sub_desc),
+                    max(SANE_MAX_REFLEXIVE_COUNT, s_desc.get('MAX', 0)))
+        elif type_name == "RawdataRef":
+            if s_type.is_block or s_desc.get('SIZE') != ".size":
+                raise _UnreadableLayout()
+
+            return (_RAWDATA, _get_field_reader(desc, 'size'))
+        elif type_name == "TagRef":
+            if s_type.name != "StrTagRef":
+                raise _UnreadableLayout()
+
+            class_desc = desc[desc['NAME_MAP']['tag_class']]
+            return (_TAGREF, _get_field_reader(desc, 'tag_class'),
+                    _get_field_reader(desc, 'path_length'),
+                    class_desc, desc['NAME'])
+    except (KeyError, TypeError):
+        pass
+
+    raise _UnreadableLayout()
+
+
+def _read_field(rawdata, node_off, field_reader):
+    off, size, unpacker = field_reader
+    off += node_off
+    return unpacker(rawdata[off: off + size])[0]
+
+
+def _collect_steptrees(plan, offset, block_path, parents):
+    steptree_plan, children = plan
+    if steptree_plan is not None:
+        parents.append((steptree_plan, offset, block_path))
+
+    for attr_off, name, sub_plan in children:
+        _collect_steptrees(sub_plan, offset + attr_off,
+                           '%s.%s' % (block_path, name), parents)
+
+
+def _read_refs(root_plan, rawdata):
+    refs = []
+    parents = []
+    offset = 0
+    for size, name, plan in root_plan:
+        if plan is not None:
+            _collect_steptrees(plan, offset, name, parents)
+        offset += size
+
+    if offset > len(rawdata):
+        raise _UnreadableLayout()
+
+    _read_steptrees(parents, rawdata, offset, refs)
+    return refs
+
+
+def _read_steptrees(parents, rawdata, offset, refs):
+    # anything out of the ordinary is left for the full parse to decide
+    # how to handle, so its behavior doesn't have to be duplicated here.
+    data_len = len(rawdata)
+    for steptree_plan, node_off, block_path in parents:
+        kind = steptree_plan[0]
+        if kind == _TAGREF:
+            class_reader, length_reader, class_desc, name = steptree_plan[1:]
+            length = _read_field(rawdata, node_off, length_reader)
+            end = offset + length + bool(length)
+            if length < 0 or end > data_len:
+                raise _UnreadableLayout()
+
+            class_name = class_desc.get(
+                class_desc['VALUE_MAP'].get(
+                    _read_field(rawdata, node_off, class_reader)),
+                {'NAME': '<INVALID>'})['NAME']
+            filepath = rawdata[offset: end].decode(
+                encoding='latin-1').split('\x00')[0]
+
+            refs.append(TagRefInfo(name, filepath, class_name, block_path))
+            offset = end
+        elif kind == _RAWDATA:
+            size = _read_field(rawdata, node_off, steptree_plan[1])
+            if size < 0 or offset + size > data_len:
+                raise _UnreadableLayout()
+
+            offset += size
+        elif kind == _REFLEXIVE:
+            count_reader, sub_size, sub_plan, max_count = steptree_plan[1:]
+            count = _read_field(rawdata, node_off, count_reader)
+            if count == 0:
+                continue
+            elif (count < 0 or count > max_count or
+                  offset + count*sub_size > data_len):
+                raise _UnreadableLayout()
+
+            array_off = offset
+            offset += count*sub_size
+            if sub_plan is None:
+                # nothing in this array has steptrees, so skip it entirely
+                continue
+
+            sub_parents = []
+            for i in range(count):
+                _collect_steptrees(sub_plan, array_off + i*sub_size,
+                                   '%s[%s]' % (block_path, i), sub_parents)
+
+            offset = _read_steptrees(sub_parents, rawdata, offset, refs)
+
+    return offset
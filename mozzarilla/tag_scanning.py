@@ -0,0 +1,384 @@
+#
+# This file is part of Mozzarilla.
+#
+# For authors and copyright check AUTHORS.TXT
+#
+# Mozzarilla is free software under the GNU General Public License v3.0.
+# See LICENSE for more information.
+#
+
+import json
+import os
+
+from pathlib import Path, PureWindowsPath
+from traceback import format_exc
+
+from supyr_struct.util import tagpath_to_fullpath
+
+from mozzarilla.process_pools import make_process_pool
+from mozzarilla.tag_checks import has_tag_checks, run_tag_checks
+from mozzarilla.tag_refs import get_block_path, get_tag_refs, read_tag_refs,\
+     load_tag_refs
+
+__all__ = (
+    "TagScanResult", "TagScanManifest", "get_tag", "get_loaded_tag",
+    "get_manifest_path", "get_jsonl_path", "get_block_path",
+    "tag_ref_exists", "check_tag_refs", "scan_tag", "scan_tag_path",
+    "tag_specific_scan", "format_broken_refs", "format_broken_refs_jsonl",
+    "init_scan_worker", "make_worker_pool", "scan_tag_paths",
+    "load_tag_refs_paths",
+    )
+
+# the handler used by scan_tag_paths when running inside a worker process
+_worker_handler = None
+
+
+class TagScanResult:
+    '''Picklable summary of the errors found while scanning one tag.'''
+    filepath = ""
+    tag_filepath = ""
+    loaded = False
+    def_id = None
+
+    # list of (block_name, missing_tag_path, block_path) tuples
+    broken_refs = ()
+    # list of (block_name, ref_filepath, ext, exists, block_path) tuples for
+    # every non-empty reference. used to tell when a cached result
+    # is stale because a dependency appeared or disappeared.
+    refs = ()
+    # the tag specific error string for this tag(already formatted)
+    specific_error = ""
+    # traceback of any exception raised while checking the references
+    scan_error = ""
+
+    def __init__(self, filepath):
+        self.filepath = str(filepath)
+        self.broken_refs = []
+        self.refs = []
+
+
+class TagScanManifest:
+    '''
+    Persistent record of the results of previous scans, keyed by the
+    tagsdir relative filepath of each tag. A cached result is reused
+    only while the tag's size and mtime are unchanged and none of
+    the tags it references have appeared or disappeared.
+    '''
+    version = 2
+
+    def __init__(self, filepath, handler):
+        self.filepath = Path(filepath)
+        self.handler = handler
+        self.handler_name = type(handler).__name__
+        self.tags_dir = str(handler.tagsdir)
+        self.entries = {}
+        self._ref_exists_cache = {}
+
+    def load(self):
+        '''
+        Loads the manifest from its filepath. If it doesn't exist, can't
+        be read, or was made for a different handler or tags directory,
+        the manifest is emptied and False is returned.
+        '''
+        self.entries = {}
+        try:
+            with self.filepath.open('r') as f:
+                data = json.load(f)
+        except Exception:
+            return False
+
+        if not isinstance(data, dict) or (
+                data.get("version")  != self.version or
+                data.get("handler")  != self.handler_name or
+                data.get("tags_dir") != self.tags_dir):
+            return False
+
+        self.entries = dict(data.get("tags", {}))
+        return True
+
+    def save(self):
+        data = dict(version=self.version, handler=self.handler_name,
+                    tags_dir=self.tags_dir, tags=self.entries)
+
+        # write to a temp file first so an interrupted save
+        # can't leave a half written manifest behind.
+        temppath = self.filepath.with_name(self.filepath.name + ".temp")
+        with temppath.open('w') as f:
+            json.dump(data, f, sort_keys=True)
+
+        os.replace(str(temppath), str(self.filepath))
+
+    def prune(self):
+        '''Removes the entries of any tags which no longer exist.'''
+        tagsdir = self.handler.tagsdir
+        for key in list(self.entries.keys()):
+            if not tagsdir.joinpath(key).is_file():
+                del self.entries[key]
+
+    def get_tag_stat(self, filepath):
+        st = os.stat(str(self.handler.tagsdir.joinpath(filepath)))
+        return [st.st_size, st.st_mtime_ns]
+
+    def ref_exists(self, ref_filepath, ext):
+        key = (ref_filepath, ext)
+        exists = self._ref_exists_cache.get(key)
+        if exists is None:
+            exists = self._ref_exists_cache[key] = tag_ref_exists(
+                self.handler, ref_filepath, ext)
+        return exists
+
+    def get_result(self, filepath, stat):
+        '''
+        Returns a TagScanResult made from the cached entry for the tag at
+        filepath, or None if there is no entry or the entry is stale.
+        '''
+        entry = self.entries.get(str(filepath))
+        if entry is None or [entry.get("size"), entry.get("mtime")] != stat:
+            return None
+
+        try:
+            for name, ref_filepath, ext, exists, block_path in entry["refs"]:
+                if self.ref_exists(ref_filepath, ext) != exists:
+                    return None
+
+            result = TagScanResult(filepath)
+            result.loaded = True
+            result.tag_filepath = str(self.handler.tagsdir.joinpath(filepath))
+            result.def_id = entry.get("def_id")
+            result.specific_error = entry.get("specific_error", "")
+            for name, ref_filepath, ext, exists, block_path in entry["refs"]:
+                result.refs.append(
+                    (name, ref_filepath, ext, exists, block_path))
+                if not exists:
+                    result.broken_refs.append(
+                        (name, ref_filepath + ext, block_path))
+        except Exception:
+            # malformed entry. just rescan the tag
+            return None
+
+        return result
+
+    def set_result(self, filepath, stat, result):
+        '''
+        Stores the result of scanning the tag at filepath. Results
+        for tags that couldn't be loaded or scanned aren't stored,
+        so those tags will always be rescanned.
+        '''
+        key = str(filepath)
+        if not result.loaded or result.scan_error:
+            self.entries.pop(key, None)
+            return
+
+        self.entries[key] = dict(
+            size=stat[0], mtime=stat[1], def_id=result.def_id,
+            specific_error=result.specific_error,
+            refs=[list(ref) for ref in result.refs])
+
+
+def get_loaded_tag(handler, def_id, filepath):
+    '''
+    Returns the tag at filepath if it is currently loaded in the
+    handler(and therefore possibly edited in memory), or None.
+    '''
+    try:
+        return handler.tags.get(def_id, {}).get(filepath)
+    except Exception:
+        return None
+
+
+def get_manifest_path(logpath):
+    '''Returns the path of the scan manifest kept beside the given log.'''
+    logpath = Path(logpath)
+    return logpath.with_name(logpath.stem + "_manifest.json")
+
+
+def get_jsonl_path(logpath):
+    '''Returns the path of the JSON Lines report kept beside the given log.'''
+    return Path(logpath).with_suffix(".jsonl")
+
+
+def tag_ref_exists(handler, ref_filepath, ext):
+    '''
+    Returns whether or not the tag referenced by the given filepath and
+    extension exists. Mirrors the handlers get_tagref_exists, but works
+    without needing the reference block itself.
+    '''
+    filepath = tagpath_to_fullpath(
+        handler.tagsdir, PureWindowsPath(ref_filepath), extension=ext)
+
+    if filepath is None and (getattr(handler, "treat_mode_as_mod2", False)
+                             and ext == '.model'):
+        filepath = tagpath_to_fullpath(
+            handler.tagsdir, PureWindowsPath(ref_filepath),
+            extension='.gbxmodel')
+
+    return filepath is not None
+
+
+def get_tag(handler, filepath):
+    def_id = handler.get_def_id(filepath)
+
+    try:
+        tag = handler.get_tag(filepath, def_id)
+    except (KeyError, LookupError):
+        tag = None
+    try:
+        if tag is None:
+            return handler.build_tag(
+                filepath=handler.tagsdir.joinpath(filepath))
+    except Exception:
+        pass
+    return tag
+
+
+def tag_specific_scan(tag):
+    '''
+    Checks the tag for errors specific to its tag type.
+    Returns a string describing the errors, or an empty string if none.
+    The checks run are the ones registered in mozzarilla.tag_checks.
+    '''
+    return run_tag_checks(tag)
+
+
+def scan_tag(handler, tag, def_id, filepath):
+    '''
+    Runs the tag specific checks and the broken reference checks on
+    the given tag, returning the findings as a TagScanResult.
+    def_id is the tag type the tag was located as, and determines
+    which dependency paths in the handlers tag_ref_cache are checked.
+    '''
+    result = TagScanResult(filepath)
+    result.loaded = True
+    result.tag_filepath = str(tag.filepath)
+
+    # find tag specific errors
+    err = tag_specific_scan(tag)
+    if err:
+        rel_tag_path = str(tag.filepath.relative_to(handler.tagsdir))
+        result.def_id = tag.def_id
+        result.specific_error = "\n%s\n%s\n" % (rel_tag_path, err)
+
+    try:
+        check_tag_refs(handler, result, get_tag_refs(handler, tag, def_id))
+    except Exception:
+        result.scan_error = format_exc()
+
+    return result
+
+
+def check_tag_refs(handler, result, refs):
+    '''
+    Records every reference in the given list of TagRefInfos in the
+    result, along with whether or not it's broken, so cached results
+    can be checked for staleness later.
+    '''
+    for ref in refs:
+        ext = '.' + ref.tag_class_name
+        exists = tag_ref_exists(handler, ref.filepath, ext)
+        result.refs.append(
+            (ref.NAME, ref.filepath, ext, exists, ref.block_path))
+        if not exists:
+            result.broken_refs.append(
+                (ref.NAME, ref.filepath + ext, ref.block_path))
+
+
+def scan_tag_path(handler, def_id, filepath, tag=None, refs_only=True):
+    '''
+    Loads the tag at the tagsdir relative filepath(unless a tag is
+    provided) and scans it. If the tag cannot be loaded, the returned
+    TagScanResult will have its loaded attribute set to False.
+
+    If refs_only is True and there are no tag specific checks registered
+    for this type of tag, only the tag's references are read from it.
+    If they can't be read that way the tag is fully loaded instead.
+    '''
+    if tag is None and refs_only and not has_tag_checks(def_id):
+        refs = read_tag_refs(handler, filepath, def_id)
+        if refs is not None:
+            result = TagScanResult(filepath)
+            result.loaded = True
+            result.tag_filepath = str(handler.tagsdir.joinpath(filepath))
+            try:
+                check_tag_refs(handler, result, refs)
+            except Exception:
+                result.scan_error = format_exc()
+            return result
+
+    if tag is None:
+        tag = get_tag(handler, handler.tagsdir.joinpath(filepath))
+
+    if tag is None:
+        return TagScanResult(filepath)
+
+    return scan_tag(handler, tag, def_id, filepath)
+
+
+def format_broken_refs(result):
+    '''Returns the log text describing the broken references of a tag.'''
+    if not result.broken_refs:
+        return ""
+
+    lines = ["\n\n%s" % result.filepath]
+    block_name = None
+    for name, missing_path, block_path in result.broken_refs:
+        if name != block_name:
+            lines.append('%s%s' % (' '*4, name))
+            block_name = name
+        lines.append('%s%s' % (' '*8, missing_path))
+
+    lines.append("")
+    return "\n".join(lines)
+
+
+def format_broken_refs_jsonl(result):
+    '''
+    Returns the JSON Lines records describing the broken references
+    of a tag, with one record per broken reference.
+    '''
+    return "".join(
+        json.dumps(dict(tag=result.filepath, block_path=block_path,
+                        missing_path=missing_path)) + "\n"
+        for name, missing_path, block_path in result.broken_refs)
+
+
+def init_scan_worker(handler_class, tags_dir, case_sensitive=False):
+    '''
+    Initializer for tag scanning worker processes. Each worker
+    builds its own handler since handlers cannot be shared.
+    '''
+    global _worker_handler
+    _worker_handler = handler_class(case_sensitive=case_sensitive)
+    _worker_handler.tagsdir = Path(tags_dir)
+
+
+def make_worker_pool(handler, max_processes=None):
+    '''
+    Returns a process pool whose workers each have their own handler
+    of the same type and for the same tags directory as handler.
+    '''
+    return make_process_pool(
+        max_processes, init_scan_worker,
+        (type(handler), handler.tagsdir, handler.case_sensitive))
+
+
+def scan_tag_paths(job):
+    '''
+    Scans a (def_id, filepaths) job inside a worker process,
+    returning a list of TagScanResults in the same order.
+    '''
+    def_id, filepaths = job
+    return [scan_tag_path(_worker_handler, def_id, filepath)
+            for filepath in filepaths]
+
+
+def load_tag_refs_paths(filepaths):
+    '''
+    Reads the references of each tag in filepaths inside a worker process,
+    returning a list of the TagRefInfos of each in the same order. None
+    is returned in place of the references of tags that can't be read.
+    '''
+    handler = _worker_handler
+    get_worker_tag = lambda filepath: get_tag(
+        handler, handler.tagsdir.joinpath(filepath))
+    return [load_tag_refs(handler, filepath, get_worker_tag)
+            for filepath in filepaths]
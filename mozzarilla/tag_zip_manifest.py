@@ -0,0 +1,130 @@
+#
+# This file is part of Mozzarilla.
+#
+# For authors and copyright check AUTHORS.TXT
+#
+# Mozzarilla is free software under the GNU General Public License v3.0.
+# See LICENSE for more information.
+#
+
+import hashlib
+import json
+import os
+import sys
+import zipfile
+import zlib
+
+from pathlib import Path
+
+__all__ = (
+    "TagZipManifest", "get_zip_manifest_path", "hash_tag_data",
+    "is_compressible", "write_tag_data",
+    "ZIP_COMPRESSION_NAMES", "ZIP_COMPRESSION_LEVELS",
+    )
+
+# names and deflate levels of the compression settings the zipper offers.
+# a level of None means tags are stored without being compressed.
+ZIP_COMPRESSION_NAMES = (
+    "Store only", "Deflate (fastest)", "Deflate (default)",
+    "Deflate (smallest)",
+    )
+ZIP_COMPRESSION_LEVELS = (None, 1, 6, 9)
+
+# how much of a tag is test compressed to decide if it's worth compressing
+COMPRESSIBLE_SAMPLE_SIZE = 64*1024
+# tags which don't compress to less than this much of their size are stored
+COMPRESSIBLE_MAX_RATIO = 0.9
+
+# zipfile only accepts a compression level in python 3.7 and up
+_has_compresslevel = sys.version_info >= (3, 7)
+
+
+class TagZipManifest:
+    '''
+    Record of the size and sha1 of every tag in the dependency closure
+    a tag zip was made from, keyed by the tag's path in the zipfile.
+    Passing the manifest of a previous zip to the zipper makes it only
+    write the tags which are new or have changed since then.
+    '''
+    version = 1
+
+    def __init__(self, filepath=None):
+        self.filepath = None if filepath is None else Path(filepath)
+        # maps arcnames to [size, sha1 hexdigest]
+        self.entries = {}
+
+    def load(self):
+        '''
+        Loads the manifest from its filepath. Raises ValueError
+        if the file isn't a manifest this version can read.
+        '''
+        with self.filepath.open('r') as f:
+            data = json.load(f)
+
+        if not isinstance(data, dict) or data.get("version") != self.version:
+            raise ValueError("'%s' is not a valid tag zip manifest." %
+                             self.filepath)
+
+        self.entries = {
+            str(arcname): [int(size), str(sha1)]
+            for arcname, (size, sha1) in data.get("tags", {}).items()}
+
+    def save(self):
+        data = dict(version=self.version, tags=self.entries)
+
+        temppath = self.filepath.with_name(self.filepath.name + ".temp")
+        with temppath.open('w') as f:
+            json.dump(data, f, sort_keys=True, indent=1)
+
+        os.replace(str(temppath), str(self.filepath))
+
+    def is_unchanged(self, arcname, size, sha1):
+        return self.entries.get(arcname) == [size, sha1]
+
+    def set_entry(self, arcname, size, sha1):
+        self.entries[arcname] = [size, sha1]
+
+
+def get_zip_manifest_path(zip_path):
+    '''
+    Returns the path of the manifest kept beside the given zipfile.
+    It's kept outside the zip so it isn't extracted into a tags directory.
+    '''
+    zip_path = Path(zip_path)
+    return zip_path.with_name(zip_path.stem + "_manifest.json")
+
+
+def hash_tag_data(data):
+    '''Returns the size and sha1 hexdigest of the given tag data.'''
+    return len(data), hashlib.sha1(data).hexdigest()
+
+
+def is_compressible(data):
+    '''
+    Returns whether a quick compression of the start of the data shrinks
+    it enough to be worth deflating. Tags holding already compressed
+    data, like ogg sounds or dxt bitmaps, usually aren't.
+    '''
+    sample = data[: COMPRESSIBLE_SAMPLE_SIZE]
+    if not sample:
+        return False
+    return len(zlib.compress(sample, 1)) < len(sample)*COMPRESSIBLE_MAX_RATIO
+
+
+def write_tag_data(tagzip, arcname, data, date_time, level=None):
+    '''
+    Writes the data to the zipfile under arcname. It's deflated at the
+    given level if it's compressible, and stored if level is None or
+    it isn't compressible. Returns whether or not it was compressed.
+    '''
+    compress = level is not None and is_compressible(data)
+    zinfo = zipfile.ZipInfo(arcname, date_time)
+    zinfo.external_attr = 0o644 << 16
+    if not compress:
+        tagzip.writestr(zinfo, data, zipfile.ZIP_STORED)
+    elif _has_compresslevel:
+        tagzip.writestr(zinfo, data, zipfile.ZIP_DEFLATED, level)
+    else:
+        tagzip.writestr(zinfo, data, zipfile.ZIP_DEFLATED)
+
+    return compress
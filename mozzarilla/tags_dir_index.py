@@ -0,0 +1,362 @@
+#
+# This file is part of Mozzarilla.
+#
+# For authors and copyright check AUTHORS.TXT
+#
+# Mozzarilla is free software under the GNU General Public License v3.0.
+# See LICENSE for more information.
+#
+
+import os
+import stat
+
+from pathlib import Path
+from threading import Lock, RLock
+
+__all__ = (
+    "TagsDirEntry", "TagsDirIndex",
+    "get_tags_dir_index", "clear_tags_dir_indices",
+    )
+
+# maps the normalized path of each indexed directory to its TagsDirIndex
+_indices = {}
+_indices_lock = Lock()
+
+
+class TagsDirEntry:
+    '''
+    A file found in an indexed directory. The size and mtime are as
+    of when the directory holding the file was last listed, or when
+    the file was last passed to TagsDirIndex.update_path.
+    '''
+    __slots__ = ("rel_path", "ext", "size", "mtime")
+
+    def __init__(self, rel_path, ext, size, mtime):
+        self.rel_path = rel_path
+        self.ext = ext
+        self.size = size
+        self.mtime = mtime
+
+    @property
+    def rel_filepath(self):
+        return Path(self.rel_path)
+
+
+class _DirListing:
+    __slots__ = ("mtime", "files", "subdirs")
+
+    def __init__(self, mtime, files, subdirs):
+        self.mtime = mtime
+        # maps filenames to their TagsDirEntry
+        self.files = files
+        # sorted list of the names of the subdirectories
+        self.subdirs = subdirs
+
+
+class TagsDirIndex:
+    '''
+    Index of every file in a directory tree, built with os.scandir.
+    Each directory's listing is kept along with the directory's mtime,
+    so refreshing the index only lists the directories whose entries
+    have been added, removed or renamed since they were last listed.
+
+    Since modifying a file in place doesn't change its directory's mtime,
+    the size and mtime of the entries can be stale for those files.
+    Anything which needs them to be exact should stat the file itself,
+    or call update_path after modifying it.
+    '''
+    def __init__(self, root):
+        self.root = Path(root)
+        self._root_str = str(self.root)
+        # maps the root relative path of each directory to its _DirListing.
+        # the root directory itself is keyed by an empty string.
+        self._dirs = {}
+        self._lock = RLock()
+
+    def get_rel_dir(self, dirpath=None):
+        '''
+        Returns the path of dirpath relative to the root of the index.
+        Raises ValueError if dirpath isn't inside the root.
+        '''
+        if dirpath is None:
+            return ""
+
+        dirpath = str(dirpath)
+        if not os.path.isabs(dirpath):
+            dirpath = os.path.join(self._root_str, dirpath)
+
+        try:
+            rel_dir = os.path.relpath(dirpath, self._root_str)
+        except ValueError:
+            # on a different drive than the root
+            rel_dir = os.pardir
+
+        if rel_dir == os.curdir:
+            return ""
+        elif rel_dir == os.pardir or rel_dir.startswith(os.pardir + os.sep):
+            raise ValueError("'%s' is not located inside '%s'" %
+                             (dirpath, self.root))
+        return rel_dir
+
+    def refresh(self, dirpath=None):
+        '''
+        Brings the index of the directory tree under dirpath(or the whole
+        index if dirpath is None) up to date with what is on disk.
+        '''
+        for _ in self.iter_files(dirpath):
+            pass
+
+    def iter_files(self, dirpath=None, exts=None):
+        '''
+        Yields a TagsDirEntry for each file in the directory tree under
+        dirpath, or under the root of the index if dirpath is None.
+        Directories are refreshed as they're reached, so this never
+        yields files which were deleted before their directory was.
+        If exts is provided, only files with those lowercase
+        extensions(including the period) are yielded.
+        '''
+        for rel_dir, mtime, entries in self.iter_dirs(dirpath):
+            for entry in entries:
+                if exts is None or entry.ext in exts:
+                    yield entry
+
+    def iter_dirs(self, dirpath=None):
+        '''
+        Yields a (rel_dir, mtime_ns, entries) tuple for each directory in
+        the tree under dirpath, or under the root of the index if dirpath
+        is None, where entries is a list of the TagsDirEntry of each file
+        in it. Directories are refreshed as they're reached.
+        '''
+        rel_dirs = [self.get_rel_dir(dirpath)]
+        while rel_dirs:
+            rel_dir = rel_dirs.pop()
+            with self._lock:
+                listing = self._get_listing(rel_dir)
+                if listing is None:
+                    continue
+                entries = list(listing.files.values())
+                subdirs = listing.subdirs
+
+            yield rel_dir, listing.mtime, entries
+
+            # reversed so the directories are walked in sorted order
+            rel_dirs.extend(os.path.join(rel_dir, name)
+                            for name in reversed(subdirs))
+
+    def list_dir(self, dirpath=None):
+        '''
+        Returns a (subdirs, entries) tuple of the sorted names of the
+        directory's subdirectories and the TagsDirEntry of each of its
+        files, sorted by filename, or None if it doesn't exist.
+        The directory is only relisted if it has changed.
+        '''
+        rel_dir = self.get_rel_dir(dirpath)
+        with self._lock:
+            return self._make_dir_list(self._get_listing(rel_dir))
+
+    def get_cached_dir_list(self, dirpath=None):
+        '''
+        Same as list_dir, but without touching the disk. Returns None if
+        the directory was never listed, and the listing may be stale.
+        '''
+        rel_dir = self.get_rel_dir(dirpath)
+        with self._lock:
+            return self._make_dir_list(self._dirs.get(rel_dir))
+
+    def get_entry(self, filepath):
+        '''
+        Returns the TagsDirEntry for the file at filepath, or None if
+        it isn't in the index. This doesn't touch the disk unless the
+        directory holding the file has never been listed.
+        '''
+        rel_path = self.get_rel_dir(filepath)
+        rel_dir, filename = os.path.split(rel_path)
+        with self._lock:
+            listing = self._dirs.get(rel_dir)
+            if listing is None:
+                listing = self._get_listing(rel_dir)
+            return None if listing is None else listing.files.get(filename)
+
+    def update_path(self, filepath):
+        '''
+        Updates the entry for the file at filepath after it has been
+        created, modified or deleted. Returns the new TagsDirEntry,
+        or None if the file no longer exists.
+        '''
+        rel_path = self.get_rel_dir(filepath)
+        rel_dir, filename = os.path.split(rel_path)
+        with self._lock:
+            listing = self._dirs.get(rel_dir)
+            if listing is None:
+                # the directory was never listed, so list it now
+                listing = self._get_listing(rel_dir)
+                return (None if listing is None else
+                        listing.files.get(filename))
+
+            try:
+                st = os.stat(os.path.join(self._root_str, rel_path))
+            except OSError:
+                listing.files.pop(filename, None)
+                return None
+
+            if stat.S_ISDIR(st.st_mode):
+                # leave it to the next refresh to list the directory
+                listing.mtime = None
+                return None
+
+            entry = listing.files[filename] = TagsDirEntry(
+                rel_path, os.path.splitext(filename)[-1].lower(),
+                st.st_size, st.st_mtime_ns)
+            return entry
+
+    def clear(self):
+        with self._lock:
+            self._dirs.clear()
+
+    def _adopt(self, index, rel_dir):
+        '''
+        Takes the listings of an index whose root is rel_dir in this
+        one, so the directories in it don't need listing again.
+        '''
+        with index._lock, self._lock:
+            for child_rel_dir, listing in index._dirs.items():
+                new_rel_dir = os.path.join(rel_dir, child_rel_dir).rstrip(
+                    os.sep)
+                if new_rel_dir in self._dirs:
+                    continue
+
+                files = {
+                    name: TagsDirEntry(
+                        os.path.join(rel_dir, entry.rel_path),
+                        entry.ext, entry.size, entry.mtime)
+                    for name, entry in listing.files.items()}
+                self._dirs[new_rel_dir] = _DirListing(
+                    listing.mtime, files, listing.subdirs)
+
+    def _get_listing(self, rel_dir):
+        full_dir = os.path.join(self._root_str, rel_dir)
+        try:
+            mtime = os.stat(full_dir).st_mtime_ns
+        except OSError:
+            self._forget(rel_dir)
+            return None
+
+        listing = self._dirs.get(rel_dir)
+        if listing is not None and listing.mtime == mtime:
+            return listing
+
+        old_files = {} if listing is None else listing.files
+        files = {}
+        subdirs = []
+        try:
+            for dir_entry in os.scandir(full_dir):
+                name = dir_entry.name
+                try:
+                    if dir_entry.is_dir():
+                        subdirs.append(name)
+                        continue
+                    elif not dir_entry.is_file():
+                        continue
+
+                    # on windows this stat comes free with the listing
+                    st = dir_entry.stat()
+                except OSError:
+                    continue
+
+                entry = old_files.get(name)
+                if (entry is None or entry.size != st.st_size or
+                        entry.mtime != st.st_mtime_ns):
+                    entry = TagsDirEntry(
+                        os.path.join(rel_dir, name),
+                        os.path.splitext(name)[-1].lower(),
+                        st.st_size, st.st_mtime_ns)
+                files[name] = entry
+        except OSError:
+            self._forget(rel_dir)
+            return None
+
+        subdirs.sort()
+        if listing is not None:
+            # forget any subdirectories which no longer exist
+            for name in set(listing.subdirs).difference(subdirs):
+                self._forget(os.path.join(rel_dir, name))
+
+        listing = self._dirs[rel_dir] = _DirListing(mtime, files, subdirs)
+        return listing
+
+    def _make_dir_list(self, listing):
+        if listing is None:
+            return None
+
+        return (sorted(listing.subdirs, key=str.casefold),
+                [listing.files[name] for name in
+                 sorted(listing.files, key=str.casefold)])
+
+    def _forget(self, rel_dir):
+        listing = self._dirs.pop(rel_dir, None)
+        if listing is None:
+            return
+
+        for name in listing.subdirs:
+            self._forget(os.path.join(rel_dir, name))
+
+
+def _get_key(dirpath):
+    return os.path.normcase(os.path.abspath(str(dirpath)))
+
+
+def _get_rel_key(key, root_key):
+    '''
+    Returns the path of key relative to root_key, with the root itself
+    being an empty string, or None if key isn't inside root_key.
+    '''
+    try:
+        rel_key = os.path.relpath(key, root_key)
+    except ValueError:
+        # on a different drive
+        return None
+
+    if rel_key == os.curdir:
+        return ""
+    elif rel_key == os.pardir or rel_key.startswith(os.pardir + os.sep):
+        return None
+    return rel_key
+
+
+def get_tags_dir_index(dirpath):
+    '''
+    Returns the TagsDirIndex shared by every tool for the directory.
+    If the directory is inside an already indexed directory, that
+    index is returned instead, and the directory can be walked with
+    index.iter_files(dirpath). If already indexed directories are
+    inside this one, their listings are moved into the new index and
+    they're forgotten, so no directory is ever in two indices.
+    '''
+    key = _get_key(dirpath)
+    with _indices_lock:
+        for root_key, index in _indices.items():
+            if _get_rel_key(key, root_key) is not None:
+                return index
+
+        index = TagsDirIndex(dirpath)
+        for root_key in list(_indices):
+            if _get_rel_key(root_key, key) is not None:
+                child = _indices.pop(root_key)
+                index._adopt(child, index.get_rel_dir(child.root))
+
+        _indices[key] = index
+        return index
+
+
+def clear_tags_dir_indices(keep_dirs=()):
+    '''
+    Forgets every shared index, except those holding a directory in
+    keep_dirs or held by one, so the next use rebuilds them.
+    '''
+    keep_keys = [_get_key(dirpath) for dirpath in keep_dirs]
+    with _indices_lock:
+        for root_key in list(_indices):
+            if not any(_get_rel_key(root_key, keep_key) is not None or
+                       _get_rel_key(keep_key, root_key) is not None
+                       for keep_key in keep_keys):
+                del _indices[root_key]
@@ -0,0 +1,368 @@
+#
+# This file is part of Mozzarilla.
+#
+# For authors and copyright check AUTHORS.TXT
+#
+# Mozzarilla is free software under the GNU General Public License v3.0.
+# See LICENSE for more information.
+#
+
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import sys
+
+from pathlib import Path
+from threading import Event, Thread
+from time import time
+from traceback import format_exc
+
+from mozzarilla.tags_dir_index import get_tags_dir_index
+
+__all__ = (
+    "TagsDirWatcher", "InotifyTagsDirWatcher", "PollingTagsDirWatcher",
+    "make_tags_dir_watcher",
+    )
+
+# constants from <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM  = 0x00000040
+IN_MOVED_TO    = 0x00000080
+IN_CREATE      = 0x00000100
+IN_DELETE      = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF   = 0x00000800
+IN_Q_OVERFLOW  = 0x00004000
+IN_IGNORED     = 0x00008000
+IN_ONLYDIR     = 0x01000000
+IN_ISDIR       = 0x40000000
+IN_NONBLOCK    = os.O_NONBLOCK
+IN_CLOEXEC     = getattr(os, "O_CLOEXEC", 0o2000000)
+
+# IN_MODIFY is left out on purpose. IN_CLOSE_WRITE is only sent once
+# a file is done being written, so tags aren't read half written.
+INOTIFY_WATCH_MASK = (
+    IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE |
+    IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR)
+
+INOTIFY_EVENT_HEADER = struct.Struct("iIII")
+
+_libc = None
+if "linux" in sys.platform.lower():
+    try:
+        _libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6",
+                            use_errno=True)
+        _libc.inotify_init1.argtypes = (ctypes.c_int, )
+        _libc.inotify_add_watch.argtypes = (
+            ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32)
+    except (OSError, AttributeError):
+        _libc = None
+
+
+class TagsDirWatcher:
+    '''
+    Base class for watching a tags directory for changes in a background
+    thread. Changes are collected until none have happened for
+    settle_time seconds, and then callback is called from the watcher
+    thread with a set of the tags directory relative paths that were
+    created, modified or deleted. A path may be a directory, in which
+    case anything under it may have changed. If the watcher loses track
+    of what changed, callback is called with None instead.
+    '''
+    settle_time = 0.5
+
+    def __init__(self, tags_dir, callback):
+        self.tags_dir = Path(tags_dir)
+        self.callback = callback
+        self._changed = set()
+        self._last_change = 0.0
+        self._stop_event = Event()
+        self._thread = None
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        if self.running:
+            return
+
+        self._stop_event.clear()
+        self._setup()
+        self._thread = Thread(target=self._run_thread)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def mark_changed(self, rel_paths):
+        '''Records that the given relative paths have changed.'''
+        if self._changed is not None:
+            self._changed.update(rel_paths)
+        self._last_change = time()
+
+    def mark_all_changed(self):
+        self._changed = None
+        self._last_change = time()
+
+    def flush(self):
+        '''
+        Calls the callback with the changes collected so far,
+        as long as nothing has changed for settle_time seconds.
+        '''
+        changed = self._changed
+        if changed is not None and not changed:
+            return
+        elif time() - self._last_change < self.settle_time:
+            return
+
+        self._changed = set()
+        if changed is None:
+            get_tags_dir_index(self.tags_dir).refresh(self.tags_dir)
+        else:
+            # keep the shared directory index current while we're at it
+            tags_dir_index = get_tags_dir_index(self.tags_dir)
+            for rel_path in changed:
+                try:
+                    tags_dir_index.update_path(self.tags_dir.joinpath(rel_path))
+                except Exception:
+                    pass
+
+        try:
+            self.callback(changed)
+        except Exception:
+            print(format_exc())
+
+    def _setup(self):
+        pass
+
+    def _run_thread(self):
+        try:
+            self._run()
+        except Exception:
+            print(format_exc())
+            print("Stopped watching '%s' for changes." % self.tags_dir)
+
+    def _run(self):
+        raise NotImplementedError()
+
+
+class PollingTagsDirWatcher(TagsDirWatcher):
+    '''
+    Watches a tags directory by checking the size and mtime of every file
+    in it every poll_interval seconds. Works everywhere, but costs a
+    stat of every file per poll, so it's only used if inotify isn't
+    available.
+    '''
+    poll_interval = 2.0
+    # changes are only seen once per poll, so the poll
+    # interval already gives them time to settle.
+    settle_time = 0.0
+
+    def __init__(self, tags_dir, callback):
+        TagsDirWatcher.__init__(self, tags_dir, callback)
+        self._stats = {}
+
+    def _setup(self):
+        self._stats = self._get_stats()
+
+    def _get_stats(self):
+        stats = {}
+        tags_dir_index = get_tags_dir_index(self.tags_dir)
+        root = tags_dir_index.root
+        for entry in tags_dir_index.iter_files(self.tags_dir):
+            filepath = root.joinpath(entry.rel_path)
+            try:
+                st = os.stat(str(filepath))
+            except OSError:
+                continue
+
+            stats[str(filepath.relative_to(self.tags_dir))] = (
+                st.st_size, st.st_mtime_ns)
+
+        return stats
+
+    def _run(self):
+        while not self._stop_event.wait(self.poll_interval):
+            stats = self._get_stats()
+            old_stats = self._stats
+            self._stats = stats
+
+            changed = set(old_stats).symmetric_difference(stats)
+            changed.update(rel_path for rel_path, stat in stats.items()
+                           if old_stats.get(rel_path, stat) != stat)
+            if changed:
+                self.mark_changed(changed)
+
+            self.flush()
+
+
+class InotifyTagsDirWatcher(TagsDirWatcher):
+    '''
+    Watches a tags directory using inotify. Only available on linux.
+    inotify watches aren't recursive, so every directory in the tags
+    directory is watched separately, and new directories are watched
+    as they're created.
+    '''
+    def __init__(self, tags_dir, callback):
+        TagsDirWatcher.__init__(self, tags_dir, callback)
+        self._fd = -1
+        # maps watch descriptors to the relative path of their directory
+        self._watch_dirs = {}
+
+    @staticmethod
+    def is_available():
+        return _libc is not None and hasattr(_libc, "inotify_init1")
+
+    def _setup(self):
+        if not self.is_available():
+            raise OSError("inotify is not available.")
+
+        fd = _libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+
+        self._fd = fd
+        self._watch_dirs = {}
+        try:
+            self._add_watches("")
+        except Exception:
+            self._close()
+            raise
+
+    def _close(self):
+        if self._fd >= 0:
+            os.close(self._fd)
+        self._fd = -1
+        self._watch_dirs = {}
+
+    def _add_watch(self, rel_dir):
+        wd = _libc.inotify_add_watch(
+            self._fd, os.fsencode(str(self.tags_dir.joinpath(rel_dir))),
+            INOTIFY_WATCH_MASK)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, "Could not watch '%s': %s" %
+                          (self.tags_dir.joinpath(rel_dir),
+                           os.strerror(errno)))
+
+        self._watch_dirs[wd] = rel_dir
+
+    def _add_watches(self, rel_dir):
+        '''
+        Watches the directory and every directory under it, and returns
+        the relative paths of every file found in them. Directories are
+        watched before being listed so nothing created in between is lost.
+        '''
+        rel_paths = []
+        rel_dirs = [rel_dir]
+        while rel_dirs:
+            rel_dir = rel_dirs.pop()
+            try:
+                self._add_watch(rel_dir)
+                dir_entries = list(os.scandir(
+                    str(self.tags_dir.joinpath(rel_dir))))
+            except FileNotFoundError:
+                continue
+
+            for dir_entry in dir_entries:
+                rel_path = os.path.join(rel_dir, dir_entry.name)
+                try:
+                    if dir_entry.is_dir(follow_symlinks=False):
+                        rel_dirs.append(rel_path)
+                    else:
+                        rel_paths.append(rel_path)
+                except OSError:
+                    pass
+
+        return rel_paths
+
+    def _run(self):
+        try:
+            while not self._stop_event.is_set():
+                readable = select.select(
+                    [self._fd], [], [], self.settle_time / 2)[0]
+                if readable:
+                    self._read_events()
+                self.flush()
+        finally:
+            self._close()
+
+    def _read_events(self):
+        try:
+            data = os.read(self._fd, 64*1024)
+        except BlockingIOError:
+            return
+
+        header_size = INOTIFY_EVENT_HEADER.size
+        off = 0
+        while off + header_size <= len(data):
+            wd, mask, cookie, name_len = INOTIFY_EVENT_HEADER.unpack_from(
+                data, off)
+            name = data[off + header_size: off + header_size + name_len]
+            name = os.fsdecode(name.split(b'\x00', 1)[0])
+            off += header_size + name_len
+
+            if mask & IN_Q_OVERFLOW:
+                # events were dropped, so we can't know what changed
+                self.mark_all_changed()
+                continue
+
+            rel_dir = self._watch_dirs.get(wd)
+            if rel_dir is None:
+                continue
+            elif mask & IN_IGNORED:
+                # the directory was deleted or moved away
+                del self._watch_dirs[wd]
+                continue
+            elif not name:
+                if rel_dir == "" and mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                    # the tags directory itself is gone
+                    self.mark_all_changed()
+                # other events about a watched directory itself are
+                # also reported for its entry in its parent.
+                continue
+
+            rel_path = os.path.join(rel_dir, name)
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                self.mark_changed(self._add_watches(rel_path))
+            elif mask & IN_ISDIR and mask & IN_MOVED_FROM:
+                # the watches under a moved directory still work, but
+                # would report their paths relative to where it was.
+                self._remove_watches(rel_path)
+            self.mark_changed((rel_path, ))
+
+    def _remove_watches(self, rel_dir):
+        prefix = os.path.join(rel_dir, "")
+        for wd, watch_dir in tuple(self._watch_dirs.items()):
+            if watch_dir == rel_dir or watch_dir.startswith(prefix):
+                _libc.inotify_rm_watch(self._fd, wd)
+                del self._watch_dirs[wd]
+
+
+def make_tags_dir_watcher(tags_dir, callback, use_polling=False):
+    '''
+    Makes and starts a watcher for the tags directory, using inotify
+    if it's available, and falling back to polling if it isn't or
+    the directory can't be watched with it.
+    '''
+    if not use_polling and InotifyTagsDirWatcher.is_available():
+        watcher = InotifyTagsDirWatcher(tags_dir, callback)
+        try:
+            watcher.start()
+            return watcher
+        except OSError as e:
+            print(e)
+            print("Could not watch '%s' with inotify. Polling instead." %
+                  tags_dir)
+
+    watcher = PollingTagsDirWatcher(tags_dir, callback)
+    watcher.start()
+    return watcher
@@ -8,14 +8,21 @@
 #
 
 import os
+import queue
 import tkinter as tk
 
+from itertools import count
 from pathlib import Path, PureWindowsPath
 from sys import platform
+from threading import Lock, Thread
+from time import monotonic
 from traceback import format_exc
 
 from binilla.widgets.binilla_widget import BinillaWidget
 
+from mozzarilla import tag_ref_index, tag_refs
+from mozzarilla.tags_dir_index import get_tags_dir_index
+
 # inject this default color
 BinillaWidget.active_tags_directory_color = '#%02x%02x%02x' % (40, 170, 80)
 
@@ -31,8 +38,10 @@ def __init__(self, master, *args, **kwargs):
         BinillaWidget.__init__(self)
         tk.Frame.__init__(self, master, *args, **kwargs)
 
+        self.tag_finder_frame = TagFinderFrame(self, app_root=self.app_root)
         self.hierarchy_frame = HierarchyFrame(self, app_root=self.app_root)
 
+        self.tag_finder_frame.pack(fill='x')
         self.hierarchy_frame.pack(fill='both', expand=True)
         self.apply_style()
 
@@ -49,15 +58,172 @@ def highlight_tags_dir(self, root_dir):
         self.hierarchy_frame.highlight_tags_dir(root_dir)
 
     def apply_style(self, seen=None):
+        self.tag_finder_frame.apply_style(seen)
         self.hierarchy_frame.apply_style(seen)
 
 
+class TagFinderFrame(BinillaWidget, tk.Frame):
+    '''
+    Quick open box for finding tags in every tags directory by typing
+    parts of their path. Searches the app_root's tag_path_index, which
+    is a mozzarilla.tag_path_finder.TagPathIndex.
+    '''
+    app_root = None
+    # milliseconds to wait after a keystroke before searching
+    search_delay = 40
+    max_results = 50
+    # seconds after refreshing the index before focusing the query
+    # box refreshes it again. each refresh stats every directory.
+    min_refresh_interval = 30.0
+
+    _search_after_id = None
+    _last_refresh = None
+
+    def __init__(self, master, *args, **kwargs):
+        kwargs.setdefault('app_root', master)
+        self.app_root = kwargs.pop('app_root')
+
+        kwargs.update(bd=0, highlightthickness=0, bg=self.default_bg_color)
+        BinillaWidget.__init__(self)
+        tk.Frame.__init__(self, master, *args, **kwargs)
+
+        self.query = tk.StringVar(self)
+        # (tags_dir, rel_path) of each tag listed in the results
+        self.results = []
+
+        self.query_entry = tk.Entry(self, textvariable=self.query)
+        self.results_listbox = tk.Listbox(
+            self, height=10, highlightthickness=0, exportselection=False)
+        self.query_entry.tooltip_string = (
+            "Type parts of a tag's path to find it(F8).\n"
+            "Press Enter to open the first match, or the down\n"
+            "arrow key to pick from the rest of the matches.")
+
+        self.query.trace("w", self.schedule_search)
+        self.query_entry.bind('<Return>', self.open_result)
+        self.query_entry.bind('<Down>', self.focus_results)
+        self.query_entry.bind('<Escape>', self.clear)
+        self.query_entry.bind('<FocusIn>', self.refresh_index)
+        self.results_listbox.bind('<Return>', self.open_result)
+        self.results_listbox.bind('<Double-Button-1>', self.open_result)
+        self.results_listbox.bind('<Escape>', self.clear)
+
+        self.query_entry.pack(fill='x', padx=2, pady=2)
+        self.apply_style()
+
+    def focus_query(self):
+        self.query_entry.focus_set()
+        self.query_entry.select_range(0, 'end')
+
+    def focus_results(self, e=None):
+        if not self.results:
+            return
+
+        self.results_listbox.focus_set()
+        self.results_listbox.selection_clear(0, 'end')
+        self.results_listbox.selection_set(0)
+        self.results_listbox.activate(0)
+
+    def clear(self, e=None):
+        self.query.set("")
+        self.query_entry.focus_set()
+
+    def refresh_index(self, e=None):
+        # pick up tags added or removed since the index was made
+        now = monotonic()
+        if (self._last_refresh is not None and
+                now - self._last_refresh < self.min_refresh_interval):
+            return
+
+        self._last_refresh = now
+        self.app_root.update_tag_path_index(True)
+
+    def schedule_search(self, *args):
+        if self._search_after_id is not None:
+            self.after_cancel(self._search_after_id)
+        self._search_after_id = self.after(
+            self.search_delay, self.update_results)
+
+    def update_results(self):
+        self._search_after_id = None
+        index = getattr(self.app_root, "tag_path_index", None)
+        query = self.query.get()
+
+        self.results = []
+        if index is not None and query.strip():
+            self.results = index.search(query, self.max_results)
+
+        listbox = self.results_listbox
+        listbox.delete(0, 'end')
+        show_dirs = len(self.app_root.tags_dirs) > 1
+        for tags_dir, rel_path in self.results:
+            if show_dirs:
+                listbox.insert('end', "%s    [%s]" % (rel_path, tags_dir))
+            else:
+                listbox.insert('end', rel_path)
+
+        if query.strip():
+            listbox.pack(fill='x', padx=2, pady=(0, 2))
+        else:
+            listbox.pack_forget()
+
+    def open_result(self, e=None):
+        if self._search_after_id is not None:
+            # enter was pressed before the search finished
+            self.after_cancel(self._search_after_id)
+            self.update_results()
+
+        selection = self.results_listbox.curselection()
+        i = int(selection[0]) if selection else 0
+        if i >= len(self.results):
+            return
+
+        app = self.app_root
+        tags_dir, rel_path = self.results[i]
+        try:
+            tags_dir_index = app.get_tags_dir_index(tags_dir)
+            if tags_dir_index is not None:
+                app.directory_frame.highlight_tags_dir(tags_dir)
+                app.switch_tags_dir(index=tags_dir_index, manual=False)
+
+            app.load_tags(filepaths=Path(tags_dir, rel_path))
+        except Exception:
+            print(format_exc())
+
+
+def format_file_size(filesize):
+    if filesize < 1024:
+        return "%d Bytes" % (filesize)
+    elif filesize < 1024**2:
+        return "%.2f KiB" % (filesize/1024)
+    return "%.2f MiB" % (filesize/1024**2)
+
+
 class HierarchyFrame(BinillaWidget, tk.Frame):
     tags_dir = ''
     app_root = None
     tags_dir_items = ()
     active_tags_dir = ""
 
+    # milliseconds between checks for directory listings
+    # finished by the background listing thread.
+    listing_poll_interval = 30
+
+    # directories are listed by a background thread so slow drives
+    # don't freeze the ui. listings are cached by the shared
+    # TagsDirIndex, so reopening a directory is instant.
+    _listing_thread = None
+    _listing_poll_scheduled = False
+
+    # max number of items inserted under a node at a time. the rest are
+    # inserted in later chunks, so expanding huge nodes doesn't block.
+    insert_chunk_size = 250
+    # if True, the next chunk of a node's items is only inserted once
+    # the row standing in for them is scrolled into view. otherwise
+    # chunks are inserted one after the other in the background.
+    windowed_insert = True
+    _more_rows_check_scheduled = False
+
     def __init__(self, master, *args, **kwargs):
         kwargs.update(bg=self.default_bg_color, bd=self.listbox_depth,
             relief='sunken', highlightthickness=0)
@@ -69,6 +235,21 @@ def __init__(self, master, *args, **kwargs):
         BinillaWidget.__init__(self)
         tk.Frame.__init__(self, master, *args, **kwargs)
 
+        # requests are (priority, order, dirpath, count_only) tuples, and
+        # results are (dirpath, count_only, dir_list) tuples. full listings
+        # are prioritized over listings only done to count items.
+        self._listing_requests = queue.PriorityQueue()
+        self._listing_results = queue.Queue()
+        self._listing_order = count()
+        self._listing_lock = Lock()
+        # (dirpath, count_only) pairs requested but not received yet
+        self._pending_listings = set()
+        # maps open directories to a summary of the listing they show
+        self._shown_listings = {}
+        # maps items to a [items, next_index, insert_item, more_iid] list
+        # of the items still to be inserted under them.
+        self._pending_inserts = {}
+
         self.tags_tree_frame = tk.Frame(self, highlightthickness=0)
 
         self.tags_tree = tk.ttk.Treeview(
@@ -76,7 +257,7 @@ def __init__(self, master, *args, **kwargs):
         self.scrollbar_y = tk.Scrollbar(
             self.tags_tree_frame, orient='vertical',
             command=self.tags_tree.yview)
-        self.tags_tree.config(yscrollcommand=self.scrollbar_y.set)
+        self.tags_tree.config(yscrollcommand=self.tree_yscrolled)
 
         self.tags_tree.bind('<<TreeviewOpen>>', self.open_selected)
         self.tags_tree.bind('<<TreeviewClose>>', self.close_selected)
@@ -92,6 +273,10 @@ def __init__(self, master, *args, **kwargs):
         self.reload()
         self.apply_style()
 
+    def tree_yscrolled(self, first, last):
+        self.scrollbar_y.set(first, last)
+        self.schedule_more_rows_check()
+
     def apply_style(self, seen=None):
         BinillaWidget.apply_style(self, seen)
         self.tags_tree_frame.config(bg=self.default_bg_color)
@@ -157,6 +342,7 @@ def destroy_subitems(self, directory):
         subitem so as to give the item the appearance of being expandable.
         '''
         dir_tree = self.tags_tree
+        self.cancel_pending_inserts(directory)
 
         for child in dir_tree.get_children(directory):
             dir_tree.delete(child)
@@ -165,42 +351,250 @@ def destroy_subitems(self, directory):
         dir_tree.insert(directory, 'end')
 
     def generate_subitems(self, directory):
+        '''
+        Fills in the items under the directory. If the directory has been
+        listed before, the cached listing is shown right away. Either way,
+        it's relisted in the background and updated if it has changed.
+        '''
+        directory = str(directory)
+        self._shown_listings.pop(directory, None)
+        try:
+            dir_list = get_tags_dir_index(directory).get_cached_dir_list(
+                directory)
+        except ValueError:
+            dir_list = None
+
+        if dir_list is not None:
+            self.insert_dir_list(directory, *dir_list)
+        else:
+            self.tags_tree.insert(directory, 'end', text="Loading...",
+                                  tags=('item',))
+
+        self.request_listing(directory)
+
+    def insert_dir_list(self, directory, subdirs, entries):
+        '''
+        Replaces the items under the directory with its subdirectories
+        and the given TagsDirEntrys of its files. Item counts of the
+        subdirectories are filled in once they've been listed.
+        '''
+        self._shown_listings[directory] = self._get_listing_summary(
+            subdirs, entries)
+        self.insert_items(
+            directory, [(True, subdir) for subdir in subdirs] +
+            [(False, entry) for entry in entries], self._insert_dir_item)
+
+    def _insert_dir_item(self, directory, item):
         dir_tree = self.tags_tree
+        is_dir, item = item
+        if not is_dir:
+            filename = os.path.basename(item.rel_path)
+            dir_tree.insert(directory, 'end', text=filename,
+                            iid=os.path.join(directory, filename),
+                            tags=('item',),
+                            values=(format_file_size(item.size), ))
+            return
 
-        directory = str(directory)
-        for root, subdirs, files in os.walk(directory):
-            for subdir in sorted(subdirs, key=str.casefold):
-                folderpath = os.path.join(root, subdir)
+        folderpath = os.path.join(directory, item)
+        try:
+            sub_list = get_tags_dir_index(folderpath).get_cached_dir_list(
+                folderpath)
+        except ValueError:
+            sub_list = None
+
+        dir_info_str = "..."
+        if sub_list is not None:
+            dir_info_str = "%s items" % (len(sub_list[0]) + len(sub_list[1]))
+
+        dir_tree.insert(
+            directory, 'end', text=item,
+            iid=folderpath, tags=('item',),
+            values=(dir_info_str, ))
+
+        # give the new item at least one item so it can be expanded.
+        self.destroy_subitems(folderpath)
+        self.request_listing(folderpath, True)
+
+    def insert_items(self, parent, items, insert_item):
+        '''
+        Replaces the items under parent by calling insert_item(parent, item)
+        for each of the given items. Only the first insert_chunk_size are
+        inserted right away, with a row standing in for the rest until
+        they're inserted in later chunks.
+        '''
+        dir_tree = self.tags_tree
+        self.cancel_pending_inserts(parent)
+        for child in dir_tree.get_children(parent):
+            dir_tree.delete(child)
+
+        self._pending_inserts[parent] = [list(items), 0, insert_item, None]
+        self.insert_next_chunk(parent)
+
+    def insert_next_chunk(self, parent):
+        '''
+        Inserts the next chunk of the items waiting to be inserted under
+        parent. Returns False if there weren't any waiting.
+        '''
+        dir_tree = self.tags_tree
+        pending = self._pending_inserts.pop(parent, None)
+        if pending is None:
+            return False
+        elif not dir_tree.exists(parent):
+            return True
+
+        items, i, insert_item, more_iid = pending
+        if more_iid is not None and dir_tree.exists(more_iid):
+            dir_tree.delete(more_iid)
+
+        end = i + max(1, self.insert_chunk_size)
+        for item in items[i: end]:
+            insert_item(parent, item)
+
+        if end >= len(items):
+            return True
+
+        pending[1] = end
+        pending[3] = dir_tree.insert(
+            parent, 'end', text="%s more..." % (len(items) - end),
+            tags=('item', 'more'))
+        self._pending_inserts[parent] = pending
+        if self.windowed_insert:
+            # the row might already be in view if the chunk was small
+            self.schedule_more_rows_check()
+        else:
+            self.after(1, self.insert_next_chunk, parent)
 
-                dir_info_str = "%s items" % len(list(os.scandir(folderpath)))
+        return True
 
-                dir_tree.insert(
-                    directory, 'end', text=subdir,
-                    iid=folderpath, tags=('item',),
-                    values=(dir_info_str, ))
+    def insert_more_items(self, iid):
+        '''
+        If iid is a row standing in for items waiting to be inserted,
+        inserts the next chunk of them and returns True.
+        '''
+        dir_tree = self.tags_tree
+        if not iid or not dir_tree.exists(iid):
+            return False
+
+        parent = dir_tree.parent(iid)
+        pending = self._pending_inserts.get(parent)
+        if pending is None or pending[3] != iid:
+            return False
+
+        self.insert_next_chunk(parent)
+        return True
+
+    def cancel_pending_inserts(self, parent):
+        self._pending_inserts.pop(parent, None)
+
+    def schedule_more_rows_check(self):
+        if self._pending_inserts and not self._more_rows_check_scheduled:
+            self._more_rows_check_scheduled = True
+            self.after_idle(self._check_more_rows)
+
+    def _check_more_rows(self):
+        # inserts the next chunk of any node whose
+        # stand-in row has been scrolled into view.
+        self._more_rows_check_scheduled = False
+        if not self.winfo_exists():
+            return
 
-                # loop over each of the new items, give them
-                # at least one item so they can be expanded.
-                self.destroy_subitems(folderpath)
+        dir_tree = self.tags_tree
+        for parent, pending in tuple(self._pending_inserts.items()):
+            more_iid = pending[3]
+            if more_iid is None or not dir_tree.exists(more_iid):
+                continue
+            elif dir_tree.bbox(more_iid):
+                self.insert_next_chunk(parent)
 
-            for file in sorted(files, key=str.casefold):
-                fullpath = os.path.join(root, file)
+    def request_listing(self, dirpath, count_only=False):
+        '''
+        Queues the directory to be listed by the background thread.
+        If count_only is True, the listing is only used to update
+        the item count shown for the directory.
+        '''
+        key = (dirpath, count_only)
+        if key in self._pending_listings:
+            return
+
+        self._pending_listings.add(key)
+        self._listing_requests.put(
+            (int(count_only), next(self._listing_order), dirpath, count_only))
+        with self._listing_lock:
+            if self._listing_thread is None:
+                self._listing_thread = Thread(target=self._list_dirs)
+                self._listing_thread.daemon = True
+                self._listing_thread.start()
+
+        if not self._listing_poll_scheduled:
+            self._listing_poll_scheduled = True
+            self.after(self.listing_poll_interval, self._poll_listings)
+
+    def _list_dirs(self):
+        while True:
+            with self._listing_lock:
                 try:
-                    filesize = os.stat(fullpath).st_size
-                    if filesize < 1024:
-                        filesize = "%d Bytes" % (filesize)
-                    elif filesize < 1024**2:
-                        filesize = "%.2f KiB" % (filesize/1024)
-                    else:
-                        filesize = "%.2f MiB" % (filesize/1024**2)
-                except Exception:
-                    filesize = 'ERROR'
-                dir_tree.insert(directory, 'end', text=file,
-                                iid=fullpath, tags=('item',),
-                                values=(filesize, ))
-
-            # just do the toplevel of the hierarchy
-            break
+                    request = self._listing_requests.get_nowait()
+                except queue.Empty:
+                    # checked while holding the lock so a new request
+                    # can't be queued between this and the thread ending.
+                    self._listing_thread = None
+                    return
+
+            priority, order, dirpath, count_only = request
+            try:
+                tags_dir_index = get_tags_dir_index(dirpath)
+                dir_list = tags_dir_index.list_dir(dirpath)
+                if dir_list is not None and not count_only:
+                    # files changed in place don't change their directory,
+                    # so restat them to show their current sizes.
+                    subdirs, entries = dir_list
+                    entries = [tags_dir_index.update_path(
+                        tags_dir_index.root.joinpath(entry.rel_path))
+                               for entry in entries]
+                    dir_list = (subdirs, [entry for entry in entries
+                                          if entry is not None])
+            except Exception:
+                dir_list = None
+
+            self._listing_results.put((dirpath, count_only, dir_list))
+
+    def _poll_listings(self):
+        self._listing_poll_scheduled = False
+        if not self.winfo_exists():
+            return
+
+        dir_tree = self.tags_tree
+        while True:
+            try:
+                dirpath, count_only, dir_list = \
+                         self._listing_results.get_nowait()
+            except queue.Empty:
+                break
+
+            self._pending_listings.discard((dirpath, count_only))
+            if not dir_tree.exists(dirpath):
+                # collapsed or removed before it was listed
+                continue
+            elif count_only:
+                if dir_list is not None:
+                    dir_tree.set(dirpath, 'size', "%s items" % (
+                        len(dir_list[0]) + len(dir_list[1])))
+            elif not dir_tree.item(dirpath, 'open'):
+                continue
+            elif dir_list is None:
+                for child in dir_tree.get_children(dirpath):
+                    dir_tree.delete(child)
+            elif (self._shown_listings.get(dirpath) !=
+                  self._get_listing_summary(*dir_list)):
+                self.insert_dir_list(dirpath, *dir_list)
+
+        if self._pending_listings and not self._listing_poll_scheduled:
+            self._listing_poll_scheduled = True
+            self.after(self.listing_poll_interval, self._poll_listings)
+
+    def _get_listing_summary(self, subdirs, entries):
+        return (tuple(subdirs),
+                tuple((entry.rel_path, entry.size) for entry in entries))
 
     def get_item_tags_dir(self, iid):
         '''Returns the tags directory of the given item'''
@@ -255,7 +649,7 @@ def highlight_tags_dir(self, tags_dir=None):
     def activate_item(self, e=None):
         dir_tree = self.tags_tree
         tag_path = dir_tree.focus()
-        if tag_path is None:
+        if tag_path is None or self.insert_more_items(tag_path):
             return
 
         try:
@@ -334,27 +728,18 @@ def reload(self):
         self.destroy_subitems(iid)
 
     def get_dependencies(self, tag_path):
-        tag = self.master.get_tag(tag_path)
-        if tag is None:
+        # only the tag references are read from the tag, unless it's
+        # already loaded or can't be read that way. they're cached until
+        # the tag changes, so shared tags are only read once.
+        refs = tag_refs.get_cached_tag_refs(
+            self.handler, tag_path, self.master.get_tag,
+            tag_ref_index.get_live_index(self.handler))
+        if refs is None:
             print(("Unable to load '%s'.\n" % tag_path) +
                   "    You may need to change the tag set to load this tag.")
             return ()
 
-        handler = self.handler
-        d_id = tag.def_id
-        dependency_cache = handler.tag_ref_cache.get(d_id)
-
-        if not dependency_cache:
-            return ()
-
-        dependencies = []
-
-        for block in handler.get_nodes_by_paths(dependency_cache, tag.data):
-            # if the node's filepath is empty, just skip it
-            if not block.filepath:
-                continue
-            dependencies.append(block)
-        return dependencies
+        return refs
 
     def destroy_subitems(self, iid):
         '''
@@ -362,6 +747,7 @@ def destroy_subitems(self, iid):
         subitem so as to give the item the appearance of being expandable.
         '''
         dir_tree = self.tags_tree
+        self.cancel_pending_inserts(iid)
 
         for child in dir_tree.get_children(iid):
             dir_tree.delete(child)
@@ -380,53 +766,40 @@ def close_selected(self, e=None):
             self.destroy_subitems(iid)
 
     def generate_subitems(self, parent_iid):
-        tags_dir = self.handler.tagsdir
         dir_tree = self.tags_tree
         parent_tag_path = Path(dir_tree.item(parent_iid)['values'][-1])
 
         if not parent_tag_path.is_file():
             return
 
-        for tag_ref_block in self.get_dependencies(parent_tag_path):
-            filepath = Path(PureWindowsPath(tag_ref_block.filepath))
-            try:
-                ext = '.' + tag_ref_block.tag_class.enum_name
-                if (self.handler.treat_mode_as_mod2 and ext == '.model' and
-                not Path(tags_dir, str(filepath) + ".model").is_file()):
-                    ext = '.gbxmodel'
-            except Exception:
-                ext = ''
-            tag_path = str(filepath) + ext
-
-            dependency_name = tag_ref_block.NAME
-            last_block = tag_ref_block
-            parent = last_block.parent
-            while parent is not None and hasattr(parent, 'NAME'):
-                name = parent.NAME
-                f_type = parent.TYPE
-                if f_type.is_array:
-                    index = parent.index(last_block)
-                    dependency_name = '[%s].%s' % (index, dependency_name)
-                elif name not in ('tagdata', 'data'):
-                    if not last_block.TYPE.is_array:
-                        name += '.'
-                    dependency_name = name + dependency_name
-                last_block = parent
-                parent = last_block.parent
-
-            # slice off the extension and the period
-            dependency_name = dependency_name.split('.', 1)[-1]
-
-            iid = dir_tree.insert(
-                parent_iid, 'end', text=tag_path, tags=('item',),
-                values=(dependency_name, Path(tags_dir, tag_path)))
+        self.insert_items(parent_iid, self.get_dependencies(parent_tag_path),
+                          self._insert_dependency_item)
 
-            self.destroy_subitems(iid)
+    def _insert_dependency_item(self, parent_iid, tag_ref):
+        tags_dir = self.handler.tagsdir
+        filepath = Path(PureWindowsPath(tag_ref.filepath))
+        try:
+            ext = '.' + tag_ref.tag_class_name
+            if (self.handler.treat_mode_as_mod2 and ext == '.model' and
+            not Path(tags_dir, str(filepath) + ".model").is_file()):
+                ext = '.gbxmodel'
+        except Exception:
+            ext = ''
+        tag_path = str(filepath) + ext
+
+        # slice off the "tagdata" and the period
+        dependency_name = tag_ref.block_path.split('.', 1)[-1]
+
+        iid = self.tags_tree.insert(
+            parent_iid, 'end', text=tag_path, tags=('item',),
+            values=(dependency_name, Path(tags_dir, tag_path)))
+
+        self.destroy_subitems(iid)
 
     def activate_item(self, e=None):
         dir_tree = self.tags_tree
         active = dir_tree.focus()
-        if active is None:
+        if active is None or self.insert_more_items(active):
             return
 
         tag_path = Path(dir_tree.item(active)['values'][-1])
@@ -444,3 +817,56 @@ def activate_item(self, e=None):
             app.load_tags(filepaths=tag_path)
         except Exception:
             print(format_exc())
+
+
+class ReferrerFrame(DependencyFrame):
+    '''
+    Shows the tags which reference the root tag, rather than the tags
+    the root tag references. The references are looked up in ref_index,
+    which must be a tag_ref_index.TagRefIndex for the handler.
+    '''
+    ref_index = None
+
+    def reload(self):
+        dir_tree = self.tags_tree
+        if not dir_tree['columns']:
+            dir_tree["columns"]=("dependency", )
+            dir_tree.heading("#0", text='Filepath')
+            dir_tree.heading("dependency", text='Referenced by')
+
+        DependencyFrame.reload(self)
+
+    def get_dependencies(self, tag_path):
+        if self.ref_index is None:
+            return ()
+
+        try:
+            return self.ref_index.get_referrers(tag_path)
+        except ValueError:
+            # not in the tags directory
+            return ()
+
+    def generate_subitems(self, parent_iid):
+        dir_tree = self.tags_tree
+        parent_tag_path = Path(dir_tree.item(parent_iid)['values'][-1])
+
+        if not parent_tag_path.is_file():
+            return
+
+        self.insert_items(
+            parent_iid, [(rel_path, parent_tag_path) for rel_path in
+                         self.get_dependencies(parent_tag_path)],
+            self._insert_referrer_item)
+
+    def _insert_referrer_item(self, parent_iid, item):
+        rel_path, parent_tag_path = item
+        # slice off the "tagdata" and the period
+        dependency_names = ", ".join(
+            block_path.split('.', 1)[-1] for block_path in
+            self.ref_index.get_ref_block_paths(rel_path, parent_tag_path))
+
+        iid = self.tags_tree.insert(
+            parent_iid, 'end', text=rel_path, tags=('item',),
+            values=(dependency_names, Path(self.handler.tagsdir, rel_path)))
+
+        self.destroy_subitems(iid)
@@ -19,6 +19,8 @@
 from binilla.windows.filedialog import askopenfilename, askdirectory
 from supyr_struct.util import path_replace, path_split
 from mozzarilla import editor_constants as e_c
+from mozzarilla import tag_header
+from mozzarilla.tags_dir_index import get_tags_dir_index
 
 curr_dir = Path.cwd()
 
@@ -195,17 +197,17 @@ def do_convert_dir(self, *args, **kwargs):
         print("Converting  %s  to  %s" % (self.src_ext, self.dst_ext))
         start = time()
         valid_ext = "." + self.src_ext
-        for root, dirs, files in os.walk(self.tags_dir.get()):
-            for filename in files:
-                if self.stop_conversion:
-                    break
-
-                filepath = Path(root, filename)
-                if filepath.suffix.lower() == valid_ext:
-                    self.do_convert_tag(str(filepath))
-
+        tags_dir = self.tags_dir.get()
+        tags_dir_index = get_tags_dir_index(tags_dir)
+        for entry in tags_dir_index.iter_files(tags_dir, (valid_ext, )):
             if self.stop_conversion:
                 print("    Conversion cancelled by user.")
                 break
 
+            filepath = tags_dir_index.root.joinpath(entry.rel_path)
+            # reject anything that isn't a tag by reading only its
+            # header, rather than after failing to build it.
+            if tag_header.read_tag_header(filepath) is not None:
+                self.do_convert_tag(str(filepath))
+
         print('    Finished. Took %s seconds.\n' % round(time() - start, 1))
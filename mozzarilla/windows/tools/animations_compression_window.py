@@ -24,6 +24,8 @@
      compress_animation, decompress_animation
 
 from mozzarilla import editor_constants as e_c
+from mozzarilla import tag_header
+from mozzarilla.tags_dir_index import get_tags_dir_index
 from supyr_struct.util import is_path_empty
 
 if __name__ == "__main__":
@@ -272,14 +274,16 @@ def _do_all_compression(self, compress):
                 print("    Model_animations %sion cancelled." % compress)
                 return
 
-        for root, _, files in os.walk(antr_dir):
-            for fname in files:
-                try:
-                    if Path(fname).suffix.lower() != ".model_animations":
-                        continue
-                    self._do_compression(compress, Path(root, fname))
-                except Exception:
-                    pass#print(format_exc())
+        tags_dir_index = get_tags_dir_index(antr_dir)
+        for entry in tags_dir_index.iter_files(antr_dir):
+            try:
+                # check the header here so misnamed model_animations
+                # tags are found and other files are skipped quietly.
+                antr_path = tags_dir_index.root.joinpath(entry.rel_path)
+                if tag_header.get_tag_class(antr_path, ('antr', )):
+                    self._do_compression(compress, antr_path)
+            except Exception:
+                pass#print(format_exc())
 
     def _do_compression(self, compress, antr_path=None):
         state = "compress" if compress else "decompress"
@@ -298,19 +302,12 @@ def _do_compression(self, compress, antr_path=None):
 
         self.app_root.update()
         antr_def = None
-        try:
-            with antr_path.open('rb') as f:
-                f.seek(36)
-                tag_type = f.read(4)
-                if tag_type == b'antr':
-                    f.seek(56)
-                    antr_ver = f.read(2)
-                    if antr_ver == b'\x00\x05':
-                        antr_def = stubbs_antr_def
-                    elif antr_ver == b'\x00\x04':
-                        antr_def = halo_antr_def
-        except Exception:
-            pass
+        header = tag_header.read_tag_header(antr_path)
+        if header is not None and header.tag_class == 'antr':
+            if header.version == 5:
+                antr_def = stubbs_antr_def
+            elif header.version == 4:
+                antr_def = halo_antr_def
 
         if antr_def is None:
             print("Could not determine model_animation tag version.")
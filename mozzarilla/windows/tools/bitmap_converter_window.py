@@ -8,64 +8,49 @@
 #
 
 import ctypes
-import gc
 import os
 import sys
 import tkinter as tk
+import tkinter.font as tkfont
 import weakref
 
+from array import array
+from collections import deque
 from copy import deepcopy
+from itertools import compress
 from pathlib import Path
 from threading import Thread
 from time import time
 from traceback import format_exc
 
-import arbytmap as ab
-
 from reclaimer.bitmaps.p8_palette import HALO_P8_PALETTE, STUBBS_P8_PALETTE
 from reclaimer.hek.defs.bitm import bitm_def
-from reclaimer.constants import TYPE_NAME_MAP, FORMAT_NAME_MAP,\
-     I_FORMAT_NAME_MAP
 
 from binilla.util import do_subprocess, ProcController
+from binilla.widgets import get_mouse_delta
 from binilla.widgets.binilla_widget import BinillaWidget
 from binilla.widgets.scroll_menu import ScrollMenu
 from binilla.windows.filedialog import askdirectory, asksaveasfilename
 from mozzarilla.widgets.field_widgets import HaloBitmapDisplayFrame,\
      HaloBitmapDisplayBase
 from mozzarilla import editor_constants as e_c
+from mozzarilla.tags_dir_index import get_tags_dir_index
+from mozzarilla.bitmap_info_cache import BitmapInfoCache
+from mozzarilla.bitmap_texture_cache import BitmapTextureCache,\
+     DEFAULT_MAX_TEXTURE_CACHE_SIZE
+from mozzarilla.bitmap_converting import BITMAP_PLATFORMS,\
+     MULTI_SWAP_OPTIONS, AY8_OPTIONS, EXTRACT_TO_OPTIONS, NO_YES_OPTIONS,\
+     BITMAP_TYPES, BITMAP_FORMATS, VALID_FORMAT_ENUMS, PARAM_FORMAT_TO_FORMAT,\
+     FORMAT_OPTIONS, HALO_1_TYPE_COUNT, HALO_1_FORMAT_COUNT, ConversionFlags,\
+     BitmapTagInfo, get_will_be_converted, get_will_be_processed,\
+     time_bitmap_job, get_process_count, make_convert_pool,\
+     convert_bitmap_job, read_bitmap_tag_info, ConversionReport
 
 window_base_class = tk.Toplevel
 if __name__ == "__main__":
     window_base_class = tk.Tk
 
 
-#                      (A, R, G, B)
-PC_ARGB_TO_XBOX_ARGB = (1, 3, 2, 0)
-XBOX_ARGB_TO_PC_ARGB = (3, 0, 2, 1)
-
-AL_COMBO_TO_AL   = (0, 0)
-AL_COMBO_TO_ARGB = (0, 0, 0, 0)
-
-
-BITMAP_PLATFORMS = ("PC", "XBOX")
-MULTI_SWAP_OPTIONS = ("", "PC to XBOX", "XBOX to PC")
-AY8_OPTIONS = ("Alpha", "Intensity")
-EXTRACT_TO_OPTIONS = ("", "DDS", "TGA", "PNG")
-NO_YES_OPTIONS = ("No", "Yes")
-BITMAP_TYPES = TYPE_NAME_MAP
-BITMAP_FORMATS = FORMAT_NAME_MAP
-DXT_ALPHA_FORMATS = (ab.FORMAT_DXT2, ab.FORMAT_DXT3,
-                     ab.FORMAT_DXT4, ab.FORMAT_DXT5)
-
-VALID_FORMAT_ENUMS = (0, 1, 2, 3, 6, 8, 9, 10, 11, 14, 15, 16, 17)
-PARAM_FORMAT_TO_FORMAT = (-1, ) + VALID_FORMAT_ENUMS
-FORMAT_OPTIONS = ("Unchanged", ) + tuple(BITMAP_FORMATS[i] for i in VALID_FORMAT_ENUMS)
-
-HALO_1_TYPE_COUNT   = 4
-HALO_1_FORMAT_COUNT = 18
-
-
 platform = sys.platform.lower()
 if "linux" in platform:
     platform = "linux"
@@ -84,283 +69,6 @@
     TEXT_EDITOR_NAME = "nano"
 
 
-class ConversionFlags:
-    platform = BITMAP_PLATFORMS.index("PC")
-    multi_swap = MULTI_SWAP_OPTIONS.index("")
-    mono_channel_to_keep = AY8_OPTIONS.index("Alpha")
-
-    extract_to = EXTRACT_TO_OPTIONS.index("")
-    downres = 0
-    alpha_bias = 127
-    new_format = 0
-
-    prune_tiff = 0
-    swizzled = 0
-    mono_swap = 0
-    ck_trans = 0
-    mip_gen = 0
-
-    extract_path = ""
-
-
-class BitmapInfo:
-    type = 0
-    format = 0
-    swizzled = False
-    width = 0
-    height = 0
-    depth = 0
-    mipmaps = 0
-
-    def __init__(self, bitmap_block=None):
-        if not bitmap_block:
-            return
-        self.type = bitmap_block.type.data
-        self.format = bitmap_block.format.data
-        self.swizzled = bool(bitmap_block.flags.swizzled)
-        self.width = bitmap_block.width
-        self.height = bitmap_block.height
-        self.depth = bitmap_block.depth
-        self.mipmaps = bitmap_block.mipmaps
-
-
-class BitmapTagInfo:
-    platform = 0
-    pixel_data_size = 0
-    tiff_data_size = 0
-    bitmap_infos = ()
-
-    def __init__(self, bitm_tag=None):
-        self.bitmap_infos = []
-        if not bitm_tag:
-            return
-
-        bitm_data = bitm_tag.data.tagdata
-        self.tiff_data_size = bitm_data.compressed_color_plate_data.size
-        self.pixel_data_size = bitm_data.processed_pixel_data.size
-        for bitmap in bitm_data.bitmaps.STEPTREE:
-            self.bitmap_infos.append(BitmapInfo(bitmap))
-
-        self.platform = bitm_tag.is_xbox_bitmap
-
-    @property
-    def type(self):
-        return 0 if not self.bitmap_infos else self.bitmap_infos[0].type
-    @property
-    def format(self):
-        return 0 if not self.bitmap_infos else self.bitmap_infos[0].format
-    @property
-    def swizzled(self):
-        return 0 if not self.bitmap_infos else self.bitmap_infos[0].swizzled
-
-
-def get_will_be_converted(flags, tag_info):
-    if flags.platform != tag_info.platform:
-        return True
-    elif (flags.swizzled != tag_info.swizzled and
-          tag_info.format not in (14, 15, 16)):
-        return True
-    elif (flags.mono_swap and (PARAM_FORMAT_TO_FORMAT[flags.new_format] == 3 or
-                               tag_info.format == 3)):
-        return True
-    elif flags.multi_swap and tag_info.format in (6, 8, 9, 10, 11, 14, 15, 16):
-        return True
-
-    for info in tag_info.bitmap_infos:
-        if PARAM_FORMAT_TO_FORMAT[flags.new_format] not in (-1, info.format):
-            return True
-        elif flags.downres and max(info.width, info.height, info.depth) > 4:
-            return True
-        elif flags.mip_gen and info.mipmaps == 0:
-            return True
-
-    return False
-
-
-def get_channel_mappings(conv_flags, bitmap_info):
-    mono_swap = conv_flags.mono_swap
-    fmt_s = FORMAT_NAME_MAP[bitmap_info.format]
-    fmt_t = PARAM_FORMAT_TO_FORMAT[conv_flags.new_format]
-    fmt_t = fmt_s if fmt_t < 0 else FORMAT_NAME_MAP[fmt_t]
-
-    multi_swap = conv_flags.multi_swap
-    chan_to_keep = conv_flags.mono_channel_to_keep
-
-    chan_ct_s = ab.CHANNEL_COUNTS[fmt_s]
-    chan_ct_t = ab.CHANNEL_COUNTS[fmt_t]
-    chan_map = None
-    chan_merge_map = None
-
-    if chan_ct_s == 4:
-        if chan_ct_t == 4:
-            # TAKES CARE OF ALL THE MULTIPURPOSE CHANNEL SWAPPING
-            if multi_swap == 1:
-                chan_map = PC_ARGB_TO_XBOX_ARGB
-            elif multi_swap == 2:
-                chan_map = XBOX_ARGB_TO_PC_ARGB
-
-        elif fmt_t == ab.FORMAT_A8L8:
-            chan_merge_map = ab.M_ARGB_TO_LA if mono_swap else ab.M_ARGB_TO_AL
-
-        elif fmt_t in (ab.FORMAT_A8, ab.FORMAT_L8, ab.FORMAT_AL8):
-            # CONVERTING FROM A 4 CHANNEL FORMAT TO MONOCHROME
-            if fmt_t == ab.FORMAT_L8:
-                chan_merge_map = ab.M_ARGB_TO_L
-            elif fmt_t == ab.FORMAT_A8 or chan_to_keep == 0:
-                chan_map = ab.ANYTHING_TO_A
-                chan_merge_map = ab.M_ARGB_TO_A
-            else:
-                chan_merge_map = ab.M_ARGB_TO_L
-
-    elif chan_ct_s == 2:
-        # CONVERTING FROM A 2 CHANNEL FORMAT TO OTHER FORMATS
-        if fmt_s == ab.FORMAT_AL8:
-            chan_map = AL_COMBO_TO_ARGB if chan_ct_t == 4 else AL_COMBO_TO_AL
-
-        elif fmt_s == ab.FORMAT_A8L8:
-            if chan_ct_t == 4:
-                if mono_swap:
-                    chan_map = ab.LA_TO_ARGB
-                else:
-                    chan_map = ab.AL_TO_ARGB
-            elif fmt_t == ab.FORMAT_A8 or (fmt_t == ab.FORMAT_AL8 and
-                                           not chan_to_keep):
-                chan_map = ab.ANYTHING_TO_A
-            elif fmt_t == ab.FORMAT_L8 or (fmt_t == ab.FORMAT_AL8 and
-                                           chan_to_keep):
-                chan_map = ab.AL_TO_L
-            elif mono_swap:
-                if fmt_t == ab.FORMAT_A8L8:
-                    chan_map = ab.AL_TO_LA
-                elif chan_ct_t == 4:
-                    chan_map = ab.LA_TO_ARGB
-
-    elif chan_ct_s == 1:
-        # CONVERTING FROM A 1 CHANNEL FORMAT TO OTHER FORMATS
-        if chan_ct_t == 4:
-            if fmt_s == ab.FORMAT_A8:
-                chan_map = ab.A_TO_ARGB
-            elif fmt_s == ab.FORMAT_L8:
-                chan_map = ab.L_TO_ARGB
-
-        elif chan_ct_t == 2:
-            if fmt_s == ab.FORMAT_A8:
-                chan_map = ab.A_TO_AL
-            elif fmt_s == ab.FORMAT_L8:
-                chan_map = ab.L_TO_AL
-
-    return chan_map, chan_merge_map
-
-
-def convert_bitmap_tag(tag, conv_flags, bitmap_info, use_stubbs_p8=False):
-    for i in range(tag.bitmap_count()):
-        if not tag.is_power_of_2_bitmap(i):
-            return False
-
-    new_format = BITMAP_FORMATS[
-        PARAM_FORMAT_TO_FORMAT[conv_flags.new_format]]
-
-    extract_ext = EXTRACT_TO_OPTIONS[conv_flags.extract_to]
-    ck_trans = conv_flags.ck_trans
-
-    do_conversion = get_will_be_converted(conv_flags, bitmap_info)
-    if not do_conversion and not extract_ext:
-        return True
-
-    arb = ab.Arbytmap()
-    if tag.sanitize_mipmap_counts():
-        print("ERROR: Bad mipmap counts in:\n%s\t\n" % tag.filepath)
-        return False
-
-    tag.parse_bitmap_blocks()
-    pixel_data = tag.data.tagdata.processed_pixel_data.data
-
-    for i in range(tag.bitmap_count()):
-        typ   = BITMAP_TYPES[tag.bitmap_type(i)]
-        fmt_s = BITMAP_FORMATS[tag.bitmap_format(i)]
-        fmt_t = fmt_s if conv_flags.new_format <= 0 else new_format
-
-        #get the texture block to be loaded
-        tex_block = list(pixel_data[i])
-        tex_info = tag.tex_infos[i]
-
-        if fmt_t == ab.FORMAT_P8_BUMP and typ in (ab.TYPE_CUBEMAP, ab.TYPE_3D):
-            print("Cannot convert cubemaps or 3d textures to P8.")
-            fmt_t = fmt_s
-        elif fmt_t in ab.DDS_FORMATS and typ == ab.TYPE_3D:
-            print("Cannot convert 3D textures to DXT formats.")
-            fmt_t = fmt_s
-
-        if (fmt_s in (ab.FORMAT_A8, ab.FORMAT_L8, ab.FORMAT_AL8) and
-            fmt_t in (ab.FORMAT_A8, ab.FORMAT_L8, ab.FORMAT_AL8)):
-            tex_info["format"] = fmt_s = fmt_t
-
-        chan_map, chan_merge_map = get_channel_mappings(conv_flags, bitmap_info)
-        palette_picker = None
-        palettize = (fmt_t == ab.FORMAT_P8_BUMP)
-
-        p8_palette = STUBBS_P8_PALETTE if use_stubbs_p8 else HALO_P8_PALETTE
-
-        if "palette" in tex_info:
-            tex_info["palette"] = [
-                p8_palette.p8_palette_32bit_packed] * len(tex_block)
-
-        # we want to preserve the color key transparency of
-        # the original image if converting to the same format
-        if fmt_s == fmt_t and fmt_t in (ab.FORMAT_P8_BUMP, ab.FORMAT_DXT1):
-            # also need to make sure channels aren't being swapped around
-            if not conv_flags.multi_swap:
-                ck_trans = True
-
-        if ab.CHANNEL_COUNTS[fmt_s] == 4:
-            if not ck_trans or fmt_s in (ab.FORMAT_X8R8G8B8, ab.FORMAT_R5G6B5):
-                palette_picker = p8_palette.argb_array_to_p8_array_best_fit
-            else:
-                palette_picker = p8_palette.argb_array_to_p8_array_best_fit_alpha
-
-        arb.load_new_texture(texture_block=tex_block, texture_info=tex_info)
-
-        # build the initial conversion settings list from the above settings
-        conv_settings = dict(
-            swizzle_mode=conv_flags.swizzled, palettize=palettize,
-            one_bit_bias=conv_flags.alpha_bias, palette_picker=palette_picker,
-            downres_amount=conv_flags.downres, target_format=fmt_t,
-            color_key_transparency=ck_trans, mipmap_gen=conv_flags.mip_gen,
-            channel_mapping=chan_map, channel_merge_mapping=chan_merge_map)
-
-        arb.load_new_conversion_settings(**conv_settings)
-
-        if extract_ext and conv_flags.extract_path:
-            path = conv_flags.extract_path
-            if tag.bitmap_count() > 1:
-                path = os.path.join(path, str(i))
-            arb.save_to_file(output_path=path, ext=extract_ext)
-
-        if do_conversion:
-            success = arb.convert_texture()
-            tag.tex_infos[i] = arb.texture_info  # tex_info may have changed
-
-            if success:
-                tex_root = pixel_data[i]
-                tex_root.parse(initdata=arb.texture_block,
-                               clear=False, init_attrs=False)
-                tag.swizzled(i, arb.swizzled)
-
-                #change the bitmap format to the new format
-                tag.bitmap_format(i, I_FORMAT_NAME_MAP[arb.format])
-            else:
-                print("Error occurred while converting:\n\t%s\n" % tag.filepath)
-                return False
-
-    if do_conversion:
-        tag.sanitize_bitmaps()
-        tag.set_platform(conv_flags.platform)
-        tag.add_bitmap_padding(conv_flags.platform)
-        tag.fix_top_format()
-
-    return True
-
-
 class BitmapConverterWindow(window_base_class, BinillaWidget):
     app_root = None
     tag_list_frame = None
@@ -375,6 +83,8 @@ class BitmapConverterWindow(window_base_class, BinillaWidget):
     conversion_flags = ()
     bitmap_tag_infos = ()
     bitmap_display_windows = ()
+    # persistent cache of the infos of scanned bitmaps(see BitmapInfoCache)
+    bitmap_info_cache = None
 
     _processing = False
     _cancel_processing = False
@@ -383,6 +93,12 @@ class BitmapConverterWindow(window_base_class, BinillaWidget):
     _settings_enabled = True
 
     print_interval = 5
+    # limits how many processes convert bitmaps when using
+    # multiple processes. None means one per cpu.
+    max_processes = None
+    # the least recently used converted textures are deleted from
+    # the texture cache after converting if it's larger than this.
+    max_texture_cache_size = DEFAULT_MAX_TEXTURE_CACHE_SIZE
 
     # these cache references to the settings widgets for iteratively
     # enabling/disabling settings before and after converting.
@@ -420,6 +136,8 @@ def __init__(self, app_root, *args, **kwargs):
         self.backup_tags = tk.BooleanVar(self, True)
         self.open_log = tk.BooleanVar(self, True)
         self.use_stubbs_p8 = tk.BooleanVar(self)
+        self.use_processes = tk.BooleanVar(self, False)
+        self.use_texture_cache = tk.BooleanVar(self, True)
 
         self.scan_dir_path = tk.StringVar(self)
         self.data_dir_path = tk.StringVar(self)
@@ -516,6 +234,12 @@ def __init__(self, app_root, *args, **kwargs):
         self.use_stubbs_p8_cbutton = tk.Checkbutton(
             self.global_params_frame, text="Use Stubbs p8 palette �",
             variable=self.use_stubbs_p8)
+        self.use_processes_cbutton = tk.Checkbutton(
+            self.global_params_frame, text="Use multiple processes �",
+            variable=self.use_processes)
+        self.use_texture_cache_cbutton = tk.Checkbutton(
+            self.global_params_frame, text="Cache converted bitmaps �",
+            variable=self.use_texture_cache)
 
 
         self.read_only_cbutton.tooltip_string = (
@@ -529,6 +253,14 @@ def __init__(self, app_root, *args, **kwargs):
         self.use_stubbs_p8_cbutton.tooltip_string = (
             "Use Stubbs the Zombie's p8-bump palette\n"
             "instead of Halo's for P8-bump textures.")
+        self.use_processes_cbutton.tooltip_string = (
+            "Convert bitmaps in parallel using one\n"
+            "process per cpu. Converted tags are\n"
+            "the same as when converting one by one.")
+        self.use_texture_cache_cbutton.tooltip_string = (
+            "Save each converted bitmap to a cache, so\n"
+            "identical bitmaps converted the same way\n"
+            "are copied from it instead of converted.")
 
 
         self.platform_menu = ScrollMenu(
@@ -667,6 +399,8 @@ def __init__(self, app_root, *args, **kwargs):
         self.backup_tags_cbutton.grid(row=0, column=1, sticky='w')
         self.open_log_cbutton.grid(row=0, column=2, sticky='w')
         self.use_stubbs_p8_cbutton.grid(row=0, column=3, sticky='w')
+        self.use_processes_cbutton.grid(row=1, column=0, sticky='w')
+        self.use_texture_cache_cbutton.grid(row=1, column=1, sticky='w')
 
         i = 0
         widgets = (self.platform_menu, self.format_menu, self.extract_to_menu,
@@ -751,7 +485,9 @@ def __init__(self, app_root, *args, **kwargs):
         self.buttons = (self.scan_dir_browse_button, self.scan_button,
                         self.log_file_browse_button, self.convert_button)
         self.checkbuttons = (self.read_only_cbutton, self.backup_tags_cbutton,
-                             self.open_log_cbutton, self.use_stubbs_p8_cbutton)
+                             self.open_log_cbutton, self.use_stubbs_p8_cbutton,
+                             self.use_processes_cbutton,
+                             self.use_texture_cache_cbutton)
         self.spinboxes = (self.downres_box, self.alpha_bias_box)
         self.menus = (self.platform_menu, self.format_menu,
                       self.extract_to_menu, self.prune_tiff_menu,
@@ -767,9 +503,8 @@ def __init__(self, app_root, *args, **kwargs):
             self.transient(self.app_root)
 
     def update_all_path_colors(self):
-        update_color = self.tag_list_frame.update_path_listbox_entry_color
-        for i in range(self.tag_list_frame.path_listbox.size()):
-            update_color(i)
+        self.tag_list_frame.update_will_process()
+        self.tag_list_frame.render_rows()
 
     def destroy(self):
         try:
@@ -811,11 +546,9 @@ def set_conversion_flag(self, widget, flag_name):
             return
 
         conv_flags = self.conversion_flags
-        path_listbox = self.tag_list_frame.path_listbox
-        update_color = self.tag_list_frame.update_path_listbox_entry_color
-        for i in path_listbox.curselection():
-            fp = path_listbox.get(i)
-
+        tag_ids = self.tag_list_frame.get_displayed_selection()
+        tag_paths = self.tag_list_frame.tag_paths
+        for fp in (tag_paths[i] for i in tag_ids):
             bitm_tag_info = self.bitmap_tag_infos.get(fp)
             if flag_name == "new_format" and bitm_tag_info:
                 fmt = PARAM_FORMAT_TO_FORMAT[new_value]
@@ -829,7 +562,8 @@ def set_conversion_flag(self, widget, flag_name):
             if conv_flags.get(fp):
                 setattr(conv_flags[fp], flag_name, new_value)
 
-            update_color(i)
+        self.tag_list_frame.update_will_process(tag_ids)
+        self.tag_list_frame.render_rows()
 
     def initialize_conversion_flags(self):
         data_dir = self.data_dir_path.get()
@@ -876,38 +610,54 @@ def _scan(self):
 
             seen_files = set()  # keep track of all absolute filepaths seen
             scan_dir = self.loaded_tags_dir
-            for root, _, files in os.walk(scan_dir):
-                rel_root = Path(os.path.relpath(root, scan_dir))
-                root = Path(root)
-
-                for filename in files:
-                    if Path(filename).suffix.lower() != ".bitmap":
+            info_cache = self.get_bitmap_info_cache()
+            cached_count = 0
+            # the directory is listed through the shared index, so
+            # rescanning it in the same session doesn't walk it again.
+            tags_dir_index = get_tags_dir_index(scan_dir)
+            for entry in tags_dir_index.iter_files(scan_dir, (".bitmap", )):
+                filepath = tags_dir_index.root.joinpath(entry.rel_path)
+
+                # We use an absolute path here because we later store the
+                # bitmap tag info as hash keys. This is just so that we
+                # don't do any double conversions.
+                try:
+                    rel_filepath = os.path.relpath(str(filepath), str(scan_dir))
+                    filepath = filepath.resolve()
+                    if filepath in seen_files:
                         continue
 
-                    # We use an absolute path here because we later store the
-                    # bitmap tag info as hash keys. This is just so that we
-                    # don't do any double conversions.
-                    try:
-                        filepath = root.joinpath(filename).resolve()
-                        if filepath in seen_files:
-                            continue
+                    seen_files.add(filepath)
+                except FileNotFoundError:
+                    continue
 
-                        seen_files.add(filepath)
-                    except FileNotFoundError:
-                        continue
+                if time() - c_time > p_int:
+                    c_time = time()
+                    print('    ' + rel_filepath)
+                    if self.app_root:
+                        self.app_root.update_idletasks()
 
-                    rel_filepath = str(rel_root.joinpath(filename))
-                    if time() - c_time > p_int:
-                        c_time = time()
-                        print('    ' + rel_filepath)
-                        if self.app_root:
-                            self.app_root.update_idletasks()
+                if self._cancel_processing:
+                    print('Bitmap scanning cancelled.\n')
+                    self.save_bitmap_info_cache()
+                    self.after(0, self.enable_settings)
+                    return
+
+                try:
+                    stat = info_cache.get_stat(filepath)
+                except OSError:
+                    continue
 
-                    if self._cancel_processing:
-                        print('Bitmap scanning cancelled.\n')
-                        self.after(0, self.enable_settings)
-                        return
+                tag_info = info_cache.get_info(filepath, stat)
+                if tag_info is not None:
+                    cached_count += 1
+                    self.bitmap_tag_infos[rel_filepath] = tag_info
+                    continue
 
+                # only the metadata is needed, so try reading just that
+                # before falling back to loading the whole tag.
+                tag_info = read_bitmap_tag_info(filepath, self.bitm_def)
+                if tag_info is None:
                     try:
                         bitm_tag = self.bitm_def.build(filepath=filepath)
                     except Exception:
@@ -918,8 +668,17 @@ def _scan(self):
                         print("Could not load: %s" % filepath)
                         continue
 
-                    self.bitmap_tag_infos[rel_filepath] = BitmapTagInfo(bitm_tag)
+                    tag_info = BitmapTagInfo(bitm_tag)
+                    del bitm_tag
+
+                info_cache.set_info(filepath, stat, tag_info)
+                self.bitmap_tag_infos[rel_filepath] = tag_info
 
+            info_cache.prune(Path(scan_dir).resolve(), seen_files)
+            self.save_bitmap_info_cache()
+            if cached_count:
+                print("    %s of %s bitmaps unchanged since last scanned." %
+                      (cached_count, len(self.bitmap_tag_infos)))
             print("    Finished in %s seconds." % int(time() - s_time))
         except Exception:
             print(format_exc())
@@ -932,6 +691,25 @@ def _scan(self):
         self.after(0, self.enable_settings)
         self._processing = False
 
+    def get_bitmap_info_cache(self):
+        '''
+        Returns the cache of the infos of previously scanned
+        bitmaps, loading it the first time it's needed.
+        '''
+        if self.bitmap_info_cache is None:
+            self.bitmap_info_cache = BitmapInfoCache(
+                e_c.BITMAP_INFO_CACHE_PATH)
+            self.bitmap_info_cache.load()
+        return self.bitmap_info_cache
+
+    def save_bitmap_info_cache(self):
+        try:
+            if self.bitmap_info_cache is not None:
+                self.bitmap_info_cache.save()
+        except Exception:
+            print(format_exc())
+            print("Could not save bitmap info cache.")
+
     def convert_pressed(self):
         if self._processing or not self.bitmap_tag_infos:
             return
@@ -960,40 +738,61 @@ def _convert(self):
         else:
             print("Converting bitmaps...")
             tags_dir = self.loaded_tags_dir
+            use_stubbs_p8 = self.use_stubbs_p8.get()
+            backup = self.backup_tags.get()
+            texture_cache_dir = None
+            if self.use_texture_cache.get():
+                texture_cache_dir = str(e_c.BITMAP_TEXTURE_CACHE_DIR)
 
+            jobs = []
             for fp in sorted(self.bitmap_tag_infos):
-                try:
-                    if self._cancel_processing:
-                        print("Conversion cancelled by user.")
-                        break
-
-                    bitmap_info = self.bitmap_tag_infos[fp]
-                    conv_flags = self.conversion_flags[fp]
-                    pruning = conv_flags.prune_tiff
-                    extracting = conv_flags.extract_to != 0
-                    converting = get_will_be_converted(conv_flags, bitmap_info)
-                    if pruning or converting or extracting:
-                        tag = self.bitm_def.build(filepath=os.path.join(tags_dir, fp))
-                        if pruning:
-                            tag.data.tagdata.compressed_color_plate_data.data = bytearray()
+                bitmap_info = self.bitmap_tag_infos[fp]
+                conv_flags = self.conversion_flags[fp]
+                if get_will_be_processed(conv_flags, bitmap_info):
+                    jobs.append((tags_dir, fp, conv_flags, bitmap_info,
+                                 use_stubbs_p8, backup, texture_cache_dir))
+
+            in_workers = self.use_processes.get() and len(jobs) > 1
+            if in_workers:
+                results = self.iter_pool_conversions(jobs)
+            else:
+                results = self.iter_serial_conversions(jobs)
 
-                        if converting or extracting:
-                            convert_bitmap_tag(tag, conv_flags, bitmap_info,
-                                               use_stubbs_p8=self.use_stubbs_p8.get())
+            done_count = 0
+            report = ConversionReport(in_workers)
+            try:
+                for fp, processed, output, seconds, peak_memory in results:
+                    if output:
+                        print(output, end='')
 
-                        if converting or pruning:
-                            tag.serialize(temp=False, calc_pointers=False,
-                                          backup=self.backup_tags.get())
+                    report.add_tag(fp, seconds, peak_memory)
 
+                    if processed:
                         self.bitmap_tag_infos.pop(fp, None)
                         self.conversion_flags.pop(fp, None)
                         self.bitmap_display_windows.pop(fp, None)
 
-                        del tag
-                        gc.collect()
+                    done_count += 1
+                    if time() - c_time > self.print_interval:
+                        c_time = time()
+                        print("    %s of %s bitmaps done" %
+                              (done_count, len(jobs)))
+                        if self.app_root:
+                            self.app_root.update_idletasks()
+            except Exception:
+                print(format_exc())
+
+            if self._cancel_processing:
+                print("Conversion cancelled by user.")
+
+            print(report.format())
+            if texture_cache_dir:
+                try:
+                    BitmapTextureCache(texture_cache_dir).prune(
+                        self.max_texture_cache_size)
                 except Exception:
                     print(format_exc())
-                    print("Could not convert: %s" % fp)
+                    print("Could not prune bitmap texture cache.")
 
         print("    Finished in %s seconds." % int(time() - s_time))
 
@@ -1001,6 +800,54 @@ def _convert(self):
         self.after(0, self.enable_settings)
         self.after(0, self.tag_list_frame.display_sorted_tags)
 
+    def iter_serial_conversions(self, jobs):
+        '''
+        Processes each job in this process, yielding a (filepath,
+        processed, output, seconds, peak_memory) tuple for each one.
+        '''
+        for job in jobs:
+            if self._cancel_processing:
+                return
+            processed, seconds, peak_memory = time_bitmap_job(job)
+            yield job[1], processed, "", seconds, peak_memory
+
+    def iter_pool_conversions(self, jobs):
+        '''
+        Processes the jobs in a process pool, yielding the same tuples as
+        iter_serial_conversions in the order the jobs are in. Cancelling
+        stops new jobs being started, but lets the ones already running
+        finish so no tag is left half written.
+        '''
+        # only keep a few jobs queued per process, so
+        # cancelling doesn't have to wait on all of them.
+        max_pending = get_process_count(self.max_processes)*2
+        pool = make_convert_pool(self.max_processes)
+        try:
+            pending = deque()
+            jobs = iter(jobs)
+            while True:
+                while not self._cancel_processing and len(pending) < max_pending:
+                    job = next(jobs, None)
+                    if job is None:
+                        break
+                    pending.append((job[1], pool.apply_async(
+                        convert_bitmap_job, (job, ))))
+
+                if not pending:
+                    break
+
+                fp, async_result = pending.popleft()
+                try:
+                    processed, output, seconds, peak_memory = async_result.get()
+                except Exception:
+                    processed, seconds, peak_memory = False, 0.0, 0
+                    output = "%s\nCould not convert: %s\n" % (format_exc(), fp)
+
+                yield fp, processed, output, seconds, peak_memory
+        finally:
+            pool.close()
+            pool.join()
+
     def cancel_pressed(self):
         if self._processing:
             self._cancel_processing = True
@@ -1362,9 +1209,35 @@ class BitmapConverterList(tk.Frame, BinillaWidget, HaloBitmapDisplayBase):
     toggle_to = True
     sort_method = 'path'
 
-    displayed_paths = ()
-    type_format_map = ()
-    selected_paths = ()
+    # columns of the infos of the scanned tags, indexed by tag id.
+    # see build_tag_sort_mappings for what each holds.
+    tag_paths = ()
+    tag_ids = ()
+    tag_sizes = ()
+    tag_types = ()
+    tag_formats = ()
+    tag_platforms = ()
+    tag_kinds = ()
+    tag_will_process = ()
+    active_tag_count = 0
+    # maps each sort method to the tag ids in the order it sorts them
+    sort_orders = ()
+
+    # ids of the tags shown, in the order they're shown in
+    displayed_ids = ()
+    selected_ids = ()
+
+    # only the rows that fit in the listboxes are inserted into them.
+    # top_row is the index in displayed_ids of the first one shown.
+    top_row = 0
+    visible_rows = 20
+    # rows scrolled per click of the mousewheel
+    scroll_rows = 3
+
+    # rows that shift-selecting extends from, and the arrow keys move from
+    _anchor_row = 0
+    _cursor_row = 0
+    _row_height = None
 
     _populating = False
 
@@ -1374,9 +1247,6 @@ def __init__(self, master, **options):
 
         self.formats_shown = [True] * HALO_1_FORMAT_COUNT
         self.types_shown   = [True] * HALO_1_TYPE_COUNT
-        self.displayed_paths = []
-        self.type_format_map = []
-        self.selected_paths = set()
         self.build_tag_sort_mappings()
 
         self.sort_menu = tk.Menu(self, tearoff=False)
@@ -1433,17 +1303,13 @@ def __init__(self, master, **options):
         self.listboxes = []
         self.listboxes.append(
             tk.Listbox(self, height=5, exportselection=False,
-                       yscrollcommand=self._path_scrolled,
                        xscrollcommand=self.hsb.set))
         self.listboxes.append(
-            tk.Listbox(self, width=8, height=5, exportselection=False,
-                       yscrollcommand=self._size_scrolled))
+            tk.Listbox(self, width=8, height=5, exportselection=False))
         self.listboxes.append(
-            tk.Listbox(self, width=11, height=5, exportselection=False,
-                       yscrollcommand=self._format_scrolled))
+            tk.Listbox(self, width=11, height=5, exportselection=False))
         self.listboxes.append(
-            tk.Listbox(self, width=6, height=5, exportselection=False,
-                       yscrollcommand=self._type_scrolled))
+            tk.Listbox(self, width=6, height=5, exportselection=False))
 
         self.path_listbox.bind("<Button-3>", lambda e, m=self.sort_menu:
                                self.post_rightclick_menu(e, m))
@@ -1455,18 +1321,40 @@ def __init__(self, master, **options):
                                self.post_rightclick_menu(e, m))
 
         self.hsb.config(command=self.path_listbox.xview)
-        self.vsb.config(command=self._scroll_all_yviews)
-        self.listboxes[0].bind('<<ListboxSelect>>', self.set_selected_tags_list)
-
-        for i in range(len(self.listboxes)):
-            self.listboxes[i].config(selectmode=tk.EXTENDED, highlightthickness=0)
-            self.listboxes[i].bind('<Double-Button-1>', lambda e, idx=i:
-                                   self.display_selected_tag(idx))
-            self.listboxes[i].bind('<Return>', lambda e, idx=i:
-                                   self.display_selected_tag(idx))
-            if i != 0:
-                self.listboxes[i].bind('<<ListboxSelect>>', lambda e, idx=i:
-                                       self.select_path_listbox(idx))
+        self.vsb.config(command=self.yview)
+        self.path_listbox.bind('<Configure>', self._listbox_resized)
+
+        # the listboxes only hold the visible rows, so selecting and
+        # scrolling are handled here rather than by the listboxes.
+        for listbox in self.listboxes:
+            listbox.config(selectmode=tk.EXTENDED, highlightthickness=0)
+            listbox.bind('<Button-1>', self._click_row)
+            listbox.bind('<Shift-Button-1>', lambda e:
+                         self._click_row(e, extend=True))
+            listbox.bind('<Control-Button-1>', lambda e:
+                         self._click_row(e, toggle=True))
+            listbox.bind('<B1-Motion>', self._drag_row)
+            listbox.bind('<Double-Button-1>', self.display_selected_tag)
+            listbox.bind('<Return>', self.display_selected_tag)
+
+            for key, step in (("Up", -1), ("Down", 1)):
+                listbox.bind('<%s>' % key, lambda e, s=step:
+                             self.move_cursor(s))
+                listbox.bind('<Shift-%s>' % key, lambda e, s=step:
+                             self.move_cursor(s, True))
+            for key, pages in (("Prior", -1), ("Next", 1)):
+                listbox.bind('<%s>' % key, lambda e, p=pages:
+                             self.move_cursor(p*self.visible_rows))
+            listbox.bind('<Home>', lambda e:
+                         self.move_cursor(-len(self.displayed_ids)))
+            listbox.bind('<End>', lambda e:
+                         self.move_cursor(len(self.displayed_ids)))
+
+            if e_c.IS_LNX:
+                listbox.bind('<4>', self._mousewheel_scroll)
+                listbox.bind('<5>', self._mousewheel_scroll)
+            else:
+                listbox.bind('<MouseWheel>', self._mousewheel_scroll)
 
         self.hsb.pack(side="bottom", fill="x")
         self.vsb.pack(side="right",  fill="y")
@@ -1498,34 +1386,61 @@ def post_rightclick_menu(self, event, menu):
         self.update_sort_menu()
         menu.post(event.x_root, event.y_root)
 
+    @property
+    def selected_paths(self):
+        tag_paths = self.tag_paths
+        return [tag_paths[i] for i in sorted(self.selected_ids)]
+
     def reset_listboxes(self):
-        self.selected_paths = set()
-        self.displayed_paths = []
-        for listbox in self.listboxes:
-            listbox.delete(0, tk.END)
+        self.selected_ids = set()
+        self.displayed_ids = array('l')
+        self.top_row = 0
+        self.render_rows()
+
+    def get_displayed_selection(self):
+        '''Returns the ids of the selected tags that are displayed.'''
+        return self.selected_ids.intersection(self.displayed_ids)
+
+    def select_row(self, row, extend=False, toggle=False):
+        '''
+        Selects the displayed row, like clicking it in an extended
+        listbox would. If extend is True, every row from the anchor row
+        to it is selected. If toggle is True, it's selection is toggled.
+        '''
+        displayed_ids = self.displayed_ids
+        if not displayed_ids:
+            return
 
-    def set_selected_tags_list(self, event=None):
-        selected = set(self.path_listbox.curselection())
-        if len(selected) == 1:
-            self.selected_paths.clear()
+        row = max(0, min(row, len(displayed_ids) - 1))
+        if extend:
+            start, end = sorted((self._anchor_row, row))
+            self.selected_ids = set(displayed_ids[start: end + 1])
+        elif toggle:
+            self.selected_ids ^= {displayed_ids[row]}
+            self._anchor_row = row
         else:
-            for i in range(self.path_listbox.size()):
-                if i not in selected:
-                    fp = self.path_listbox.get(i)
-                    if fp in self.selected_paths:
-                        self.selected_paths.remove(fp)
+            self.selected_ids = {displayed_ids[row]}
+            self._anchor_row = row
 
-        for i in selected:
-            self.selected_paths.add(self.path_listbox.get(i))
+        self._cursor_row = row
+        self.see_row(row)
+        self.render_selection()
+        self.selection_changed()
 
+    def selection_changed(self):
         self.master.populate_bitmap_info()
         self.master.populate_settings()
 
+    def move_cursor(self, step, extend=False):
+        self.select_row(self._cursor_row + step, extend)
+        return "break"
+
     def toggle_all(self):
         for flags in self.master.conversion_flags.values():
             flags.swizzled = flags.platform = self.toggle_to
 
         self.toggle_to = not self.toggle_to
+        self.update_will_process()
         self.display_sorted_tags()
         self.master.populate_settings()
 
@@ -1560,29 +1475,15 @@ def update_sort_menu(self):
                 self.sort_menu.entryconfig(i, label=sort_menu_strs[i])
 
     def invert_selection(self):
-        for i in range(self.path_listbox.size()):
-            fp = self.path_listbox.get(i)
-            if fp in self.selected_paths:
-                self.selected_paths.remove(fp)
-            else:
-                self.selected_paths.add(fp)
-
-        self.synchronize_selection()
-        self.set_selected_tags_list()
-
-    def synchronize_selection(self):
-        self.path_listbox.selection_clear(0, tk.END)
-        for i in range(self.path_listbox.size()):
-            if self.path_listbox.get(i) in self.selected_paths:
-                self.path_listbox.selection_set(i)
+        self.selected_ids.symmetric_difference_update(self.displayed_ids)
+        self.render_selection()
+        self.selection_changed()
 
-    def display_selected_tag(self, src_listbox_index=0):
-        self.select_path_listbox(src_listbox_index)
-        if len(self.selected_paths) != 1 or not self.master.loaded_tags_dir:
+    def display_selected_tag(self, e=None):
+        if len(self.selected_ids) != 1 or not self.master.loaded_tags_dir:
             return
 
-        for tag_path in self.selected_paths:
-            break
+        tag_path = self.selected_paths[0]
 
         display_frame = self.master.bitmap_display_windows.get(tag_path)
         if display_frame is None or display_frame() is None:
@@ -1612,19 +1513,6 @@ def display_selected_tag(self, src_listbox_index=0):
         display_frame().focus_set()
         self.master.place_window_relative(w)
 
-    def select_path_listbox(self, src_listbox_index=0):
-        src_listbox = self.listboxes[src_listbox_index]
-
-        if len(src_listbox.curselection()) > 0:
-            self.path_listbox.selection_set(src_listbox.curselection()[0])
-            self.set_selected_tags_list()
-
-        if src_listbox_index > 0:
-            src_listbox.selection_clear(0, tk.END)
-
-        self.master.populate_bitmap_info()
-        self.master.populate_settings()
-
     def toggle_types_allowed(self, menu_idx, typ):
         if typ == -1:
             for typ in range(HALO_1_TYPE_COUNT):
@@ -1665,34 +1553,70 @@ def toggle_formats_allowed(self, menu_idx, fmt):
         self.display_sorted_tags()
 
     def build_tag_sort_mappings(self):
-        self.selected_paths = set()
-        self.displayed_paths = []
-        self.type_format_map = []
-        self.size_map = {}
-
-        for typ in range(HALO_1_TYPE_COUNT):
-            self.type_format_map.append([])
-            for fmt in range(HALO_1_FORMAT_COUNT):
-                self.type_format_map[typ].append([])
+        '''
+        Builds the columns of the infos of every scanned tag, indexed by
+        tag id, along with the order of the tag ids for each sort method.
+        Tag ids are the index of the tag's path in the sorted tag_paths.
+        '''
+        self.selected_ids = set()
+        self.displayed_ids = array('l')
 
         remove = set()
         for fp, info in self.master.bitmap_tag_infos.items():
-            if not info.pixel_data_size in self.size_map:
-                self.size_map[info.pixel_data_size] = []
-
-            try:
-                self.type_format_map[info.type][info.format]
-                self.size_map[info.pixel_data_size]
-
-                self.type_format_map[info.type][info.format].append(fp)
-                self.size_map[info.pixel_data_size].append(fp)
-            except IndexError:
+            if not(0 <= info.type < HALO_1_TYPE_COUNT and
+                   0 <= info.format < HALO_1_FORMAT_COUNT):
                 remove.add(fp)
 
         for fp in remove:
             self.master.conversion_flags.pop(fp, None)
             self.master.bitmap_tag_infos.pop(fp, None)
 
+        infos = self.master.bitmap_tag_infos
+        self.tag_paths = tag_paths = sorted(infos)
+        self.tag_ids = {fp: i for i, fp in enumerate(tag_paths)}
+        self.tag_sizes = array('Q', (infos[fp].pixel_data_size
+                                     for fp in tag_paths))
+        self.tag_types = array('B', (infos[fp].type for fp in tag_paths))
+        self.tag_formats = array('B', (infos[fp].format for fp in tag_paths))
+        self.tag_platforms = array('B', (int(infos[fp].platform)
+                                         for fp in tag_paths))
+        # each tag's type and format combined into one index into the
+        # table of which combinations are shown. removed tags are given
+        # an index past the end of the combinations so they're never shown.
+        self.tag_kinds = array('B', (
+            typ*HALO_1_FORMAT_COUNT + fmt for typ, fmt in
+            zip(self.tag_types, self.tag_formats)))
+        self.tag_will_process = bytearray(len(tag_paths))
+        self.update_will_process()
+        self.active_tag_count = len(tag_paths)
+
+        # the tag ids are already in path order, and sorting is stable,
+        # so ties in the other orders are broken by path.
+        tag_ids = range(len(tag_paths))
+        types, formats = self.tag_types, self.tag_formats
+        self.sort_orders = dict(
+            path=array('l', tag_ids),
+            size=array('l', sorted(tag_ids, key=self.tag_sizes.__getitem__)),
+            format=array('l', sorted(tag_ids, key=lambda i:
+                                     (formats[i], types[i]))),
+            type=array('l', sorted(tag_ids, key=lambda i:
+                                   (types[i], formats[i]))),
+            )
+
+    def update_will_process(self, tag_ids=None):
+        '''
+        Updates whether the tags with the given ids will be processed
+        when converting, or every tag if no ids are given.
+        '''
+        if tag_ids is None:
+            tag_ids = range(len(self.tag_paths))
+
+        tag_paths = self.tag_paths
+        will_process = self.tag_will_process
+        get_will_be_processed = self.master.get_will_be_processed
+        for i in tag_ids:
+            will_process[i] = bool(get_will_be_processed(tag_paths[i]))
+
     def display_sorted_tags(self, sort_by=None, reverse=None):
         if sort_by is None:
             sort_by = self.sort_method
@@ -1704,63 +1628,66 @@ def display_sorted_tags(self, sort_by=None, reverse=None):
         self.after(0, self.populate_tag_list_boxes)
 
     def sort_displayed_tags(self, sort_by):
-        self.displayed_paths = displayed_paths = []
-        if not self.master.bitmap_tag_infos:
-            return
-
-        if sort_by == 'path':
-            for path in sorted(self.master.bitmap_tag_infos.keys()):
-                info = self.master.bitmap_tag_infos[path]
-                if (self.formats_shown[info.format] and
-                    self.types_shown[info.type]):
-                    displayed_paths.append(path)
-
-        elif sort_by == 'size':
-            for tagsize in sorted(self.size_map):
-                for path in self.size_map[tagsize]:
-                    info = self.master.bitmap_tag_infos[path]
-                    if (self.formats_shown[info.format] and
-                        self.types_shown[info.type]):
-                        displayed_paths.append(path)
-
-        elif sort_by == 'format':
-            for fmt in range(len(self.formats_shown)):
-                for typ in range(len(self.types_shown)):
-                    if self.formats_shown[fmt] and self.types_shown[typ]:
-                        displayed_paths.extend(self.type_format_map[typ][fmt])
-
-        elif sort_by == 'type':
-            for typ in range(len(self.types_shown)):
-                for fmt in range(len(self.formats_shown)):
-                    if self.formats_shown[fmt] and self.types_shown[typ]:
-                        displayed_paths.extend(self.type_format_map[typ][fmt])
-        else:
-            for path in self.master.bitmap_tag_infos.keys():
-                info = self.master.bitmap_tag_infos[path]
-                if (self.formats_shown[info.format] and
-                    self.types_shown[info.type]):
-                    displayed_paths.append(path)
+        if sort_by not in self.sort_orders:
+            sort_by = 'path'
+
+        infos = self.master.bitmap_tag_infos
+        if len(infos) != self.active_tag_count:
+            # converted tags are removed from the infos. stop showing them
+            removed_kind = HALO_1_TYPE_COUNT*HALO_1_FORMAT_COUNT
+            kinds = self.tag_kinds
+            for i, fp in enumerate(self.tag_paths):
+                if fp not in infos:
+                    kinds[i] = removed_kind
+            self.active_tag_count = len(infos)
+
+        # one byte per type and format combination, plus one for removed
+        # tags, saying whether tags with that combination are shown.
+        shown = bytes(
+            self.types_shown[typ] and self.formats_shown[fmt]
+            for typ in range(HALO_1_TYPE_COUNT)
+            for fmt in range(HALO_1_FORMAT_COUNT)) + b'\x00'
+
+        order = self.sort_orders[sort_by]
+        self.displayed_ids = array('l', compress(
+            order, map(shown.__getitem__,
+                       map(self.tag_kinds.__getitem__, order))))
 
         self.sort_method = sort_by
         if self.reverse_listbox:
-            displayed_paths.reverse()
+            self.displayed_ids.reverse()
+
+        # settings are only applied to displayed tags, so filtered out
+        # and converted tags mustn't stay selected and show their settings.
+        selected_ids = self.selected_ids
+        self.selected_ids = set(selected_ids).intersection(self.displayed_ids)
+        if len(self.selected_ids) != len(selected_ids):
+            self.after(0, self.selection_changed)
 
     def populate_tag_list_boxes(self):
+        self.render_rows()
+
+    def render_rows(self):
+        '''
+        Fills the listboxes with the rows currently scrolled into view.
+        Only those rows are inserted, so this takes the same number of
+        Tk calls no matter how many tags are displayed.
+        '''
         if self._populating:
             return
 
         self._populating = True
         try:
-            for listbox in self.listboxes:
-                listbox.delete(0, tk.END)
-
-            for fp in self.displayed_paths:
-                try:
-                    info = self.master.bitmap_tag_infos[fp]
-                except KeyError:
-                    continue
-
-                size = info.pixel_data_size
+            displayed_ids = self.displayed_ids
+            self.top_row = max(0, min(self.top_row, len(displayed_ids) -
+                                      self.visible_rows))
+            # one extra row is shown to fill any partial row at the bottom
+            row_ids = displayed_ids[
+                self.top_row: self.top_row + self.visible_rows + 1]
+
+            row_paths, sizes, formats, types = [], [], [], []
+            for i in row_ids:
+                size = self.tag_sizes[i]
                 if size < 1024:
                     size_str = str(size) + "  B"
                 elif size < 1024**2:
@@ -1768,49 +1695,131 @@ def populate_tag_list_boxes(self):
                 else:
                     size_str = str((size + 1024**2 // 2) // 1024**2) + "  MB"
 
-                self.path_listbox.insert(tk.END, fp)
-                self.format_listbox.insert(tk.END, BITMAP_FORMATS[info.format])
-                self.type_listbox.insert(tk.END, BITMAP_TYPES[info.type])
-                self.size_listbox.insert(tk.END, size_str)
+                row_paths.append(self.tag_paths[i])
+                sizes.append(size_str)
+                formats.append(BITMAP_FORMATS[self.tag_formats[i]])
+                types.append(BITMAP_TYPES[self.tag_types[i]])
+
+            for listbox, items in zip(self.listboxes,
+                                      (row_paths, sizes, formats, types)):
+                listbox.delete(0, tk.END)
+                if items:
+                    listbox.insert(tk.END, *items)
 
-                self.update_path_listbox_entry_color(tk.END)
+            for i in range(len(row_paths)):
+                self.update_path_listbox_entry_color(i)
 
-            self.synchronize_selection()
+            self.render_selection()
+            self._update_scrollbar()
         except Exception:
             print(format_exc())
 
         self._populating = False
 
+    def render_selection(self):
+        '''Shows which of the visible rows are selected.'''
+        path_listbox = self.path_listbox
+        path_listbox.selection_clear(0, tk.END)
+        selected_ids = self.selected_ids
+        if not selected_ids:
+            return
+
+        top_row = self.top_row
+        for i in range(path_listbox.size()):
+            if self.displayed_ids[top_row + i] in selected_ids:
+                path_listbox.selection_set(i)
+
+        cursor = self._cursor_row - self.top_row
+        if 0 <= cursor < path_listbox.size():
+            path_listbox.activate(cursor)
+
     def update_path_listbox_entry_color(self, i):
-        fp = self.path_listbox.get(i)
-        if self.master.get_will_be_processed(fp):
+        if self.tag_will_process[self.displayed_ids[self.top_row + i]]:
             self.path_listbox.itemconfig(i, bg='dark green', fg='white')
         else:
             self.path_listbox.itemconfig(i, bg=self.enum_normal_color,
                                          fg=self.text_normal_color,)
 
-    def _scroll_all_yviews(self, *args):
-        for listbox in self.listboxes:
-            listbox.yview(*args)
-
-    def _sync_yviews(self, src_listbox, *args):
-        for listbox in self.listboxes:
-            if listbox is not src_listbox and src_listbox.yview() != listbox.yview():
-                listbox.yview_moveto(args[0])
-        self.vsb.set(*args)
-
-    def _path_scrolled(self, *args):
-        self._sync_yviews(self.path_listbox, *args)
-
-    def _format_scrolled(self, *args):
-        self._sync_yviews(self.format_listbox, *args)
-
-    def _type_scrolled(self, *args):
-        self._sync_yviews(self.type_listbox, *args)
-
-    def _size_scrolled(self, *args):
-        self._sync_yviews(self.size_listbox, *args)
-
+    def yview(self, *args):
+        '''Scrolls the rows. Takes the same arguments as Listbox.yview.'''
+        if not args:
+            return
+        elif args[0] == tk.MOVETO:
+            self.scroll_to_row(int(round(
+                float(args[1])*len(self.displayed_ids))))
+        elif args[0] == tk.SCROLL:
+            step = int(args[1])
+            if args[2] == tk.PAGES:
+                step *= self.visible_rows
+            self.scroll_to_row(self.top_row + step)
+
+    def scroll_to_row(self, row):
+        row = max(0, min(row, len(self.displayed_ids) - self.visible_rows))
+        if row != self.top_row:
+            self.top_row = row
+            self.render_rows()
+
+    def see_row(self, row):
+        '''Scrolls the row into view if it isn't already.'''
+        if row < self.top_row:
+            self.scroll_to_row(row)
+        elif row >= self.top_row + self.visible_rows:
+            self.scroll_to_row(row - self.visible_rows + 1)
+
+    def _update_scrollbar(self):
+        row_count = len(self.displayed_ids)
+        if row_count <= self.visible_rows:
+            self.vsb.set(0.0, 1.0)
+        else:
+            self.vsb.set(self.top_row / row_count,
+                         (self.top_row + self.visible_rows) / row_count)
+
+    def _get_row_height(self):
+        if self._row_height is None:
+            path_listbox = self.path_listbox
+            bbox_0, bbox_1 = path_listbox.bbox(0), path_listbox.bbox(1)
+            if not(bbox_0 and bbox_1):
+                # not enough rows shown to measure them yet
+                return tkfont.Font(
+                    font=path_listbox.cget("font")).metrics("linespace") + 1
+
+            self._row_height = max(1, bbox_1[1] - bbox_0[1])
+        return self._row_height
+
+    def _listbox_resized(self, e=None):
+        visible_rows = max(
+            1, self.path_listbox.winfo_height() // self._get_row_height())
+        if visible_rows != self.visible_rows:
+            self.visible_rows = visible_rows
+            self.render_rows()
+
+    def _get_event_row(self, e):
+        if not e.widget.size():
+            return None
+        return self.top_row + e.widget.nearest(e.y)
+
+    def _click_row(self, e, extend=False, toggle=False):
+        e.widget.focus_set()
+        row = self._get_event_row(e)
+        if row is not None:
+            self.select_row(row, extend, toggle)
+        return "break"
+
+    def _drag_row(self, e):
+        row = self._get_event_row(e)
+        if row is None:
+            return "break"
+        elif e.y < 0:
+            row = self.top_row - 1
+        elif e.y >= e.widget.winfo_height():
+            row = self.top_row + self.visible_rows
+
+        self.select_row(row, extend=True)
+        return "break"
+
+    def _mousewheel_scroll(self, e):
+        self.scroll_to_row(self.top_row + get_mouse_delta(e)*self.scroll_rows)
+        return "break"
 
 if __name__ == "__main__":
     try:
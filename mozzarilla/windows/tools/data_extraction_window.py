@@ -23,6 +23,8 @@
 from reclaimer.halo_script.hsc import get_h1_scenario_script_object_type_strings
 
 from mozzarilla import editor_constants as e_c
+from mozzarilla import tag_header
+from mozzarilla.tags_dir_index import get_tags_dir_index
 
 
 class DataExtractionWindow(tk.Toplevel, BinillaWidget):
@@ -290,31 +292,31 @@ def do_dir_extract(self):
 
         print("Locating tags...")
 
-        for root, directories, files in os.walk(tags_path):
-            root = Path(root)
+        tags_dir_index = get_tags_dir_index(self.handler.tagsdir)
+        for entry in tags_dir_index.iter_files(tags_path):
             try:
-                root = root.relative_to(self.handler.tagsdir)
+                filepath = tags_dir_index.root.joinpath(
+                    entry.rel_path).relative_to(self.handler.tagsdir)
             except ValueError:
                 continue
 
-            for filename in files:
-                filepath = root.joinpath(filename)
-
-                if time() - c_time > p_int:
-                    c_time = time()
-                    print(' '*4, filepath, sep="")
-                    self.app_root.update_idletasks()
+            if time() - c_time > p_int:
+                c_time = time()
+                print(' '*4, filepath, sep="")
+                self.app_root.update_idletasks()
 
-                if self.stop_extracting:
-                    print('Tag data extraction cancelled.\n')
-                    return
+            if self.stop_extracting:
+                print('Tag data extraction cancelled.\n')
+                return
 
-                tag_paths = all_tag_paths.get(
-                    self.tag_class_ext_to_fcc.get(
-                        filepath.suffix[1:].lower()))
+            # only the header is read here, so files that aren't
+            # tags are skipped without trying to build them.
+            tag_paths = all_tag_paths.get(tag_header.get_tag_class(
+                self.handler.tagsdir.joinpath(filepath), all_tag_paths,
+                getattr(self.handler, "tag_header_engine_id", "blam")))
 
-                if tag_paths is not None:
-                    tag_paths.append(filepath)
+            if tag_paths is not None:
+                tag_paths.append(filepath)
 
         for def_id in sorted(all_tag_paths):
             extractor = self.tag_data_extractors[def_id]
@@ -9,19 +9,25 @@
 
 from pathlib import Path, PureWindowsPath
 import os
+import queue
 import tkinter as tk
 import zipfile
 
+from itertools import chain
 from threading import Thread
+from time import localtime
 from traceback import format_exc
 
 from binilla.widgets.binilla_widget import BinillaWidget
+from binilla.widgets.scroll_menu import ScrollMenu
 from binilla.windows.filedialog import askopenfilename, asksaveasfilename
 
 from supyr_struct.util import path_normalize, is_in_dir, tagpath_to_fullpath
 from mozzarilla.widgets.directory_frame import DirectoryFrame,\
-     HierarchyFrame, DependencyFrame
+     HierarchyFrame, DependencyFrame, ReferrerFrame
 from mozzarilla import editor_constants as e_c
+from mozzarilla import tag_closure, tag_ref_index, tag_refs, tag_scanning,\
+     tag_zip_manifest
 
 
 class DependencyWindow(tk.Toplevel, BinillaWidget):
@@ -29,8 +35,17 @@ class DependencyWindow(tk.Toplevel, BinillaWidget):
     handler = None
 
     _zipping = False
+    _indexing = False
+    _preflighting = False
     stop_zipping = False
 
+    # number of tags sent to a worker process at a time when zipping
+    zip_chunk_size = 16
+    # max number of worker processes to use. None means one per cpu
+    max_processes = None
+    # max number of tags waiting to be written to the zipfile
+    zip_write_queue_size = 256
+
     def __init__(self, app_root, *args, **kwargs):
         self.handler = app_root.handler
         self.app_root = app_root
@@ -49,20 +64,62 @@ def __init__(self, app_root, *args, **kwargs):
 
         # make the tkinter variables
         self.tag_filepath = tk.StringVar(self)
+        self.use_processes = tk.BooleanVar(self, False)
+        self.zip_compression = tk.IntVar(self, 2)
+        self.prev_manifest_path = tk.StringVar(self)
 
         # make the frames
         self.filepath_frame = tk.LabelFrame(self, text="Select a tag")
         self.button_frame = tk.LabelFrame(self, text="Actions")
+        self.zip_settings_frame = tk.LabelFrame(self, text="Zip settings")
+        self.prev_manifest_frame = tk.Frame(self.zip_settings_frame)
 
         self.display_button = tk.Button(
             self.button_frame, width=25, text='Show dependencies',
             command=self.populate_dependency_tree)
 
+        self.referrers_button = tk.Button(
+            self.button_frame, width=25, text='Show referenced by',
+            command=self.populate_referrer_tree)
+
+        self.preflight_button = tk.Button(
+            self.button_frame, width=25, text='Preflight report',
+            command=self.preflight_report)
+
         self.zip_button = tk.Button(
             self.button_frame, width=25, text='Zip tag recursively',
             command=self.recursive_zip)
 
+        self.use_processes_cbtn = tk.Checkbutton(
+            self.button_frame, text='Zip using multiple processes',
+            variable=self.use_processes)
+
+        self.zip_compression_label = tk.Label(
+            self.zip_settings_frame, text="Compression")
+        self.zip_compression_menu = ScrollMenu(
+            self.zip_settings_frame, variable=self.zip_compression,
+            menu_width=17, options=tag_zip_manifest.ZIP_COMPRESSION_NAMES)
+        self.zip_compression_label.tooltip_string = \
+            self.zip_compression_menu.tooltip_string = (
+                "How to compress the tags put in the zipfile.\n"
+                "Tags which barely compress, like ones holding ogg\n"
+                "sounds or dxt bitmaps, are always stored as is.")
+
+        self.prev_manifest_label = tk.Label(
+            self.prev_manifest_frame, text="Only add tags changed since")
+        self.prev_manifest_entry = tk.Entry(
+            self.prev_manifest_frame, textvariable=self.prev_manifest_path)
+        self.prev_manifest_browse_button = tk.Button(
+            self.prev_manifest_frame, text="Browse",
+            command=self.browse_prev_manifest)
+        self.prev_manifest_label.tooltip_string = \
+            self.prev_manifest_entry.tooltip_string = (
+                "The manifest saved beside a previous zip of this tag.\n"
+                "Only tags which are new or have changed since that zip\n"
+                "are put in the new zipfile. Leave blank to zip every tag.")
+
         self.dependency_frame = DependencyFrame(self, app_root=self.app_root)
+        self.referrer_frame = ReferrerFrame(self, app_root=self.app_root)
 
         self.filepath_entry = tk.Entry(
             self.filepath_frame, textvariable=self.tag_filepath)
@@ -70,14 +127,28 @@ def __init__(self, app_root, *args, **kwargs):
             self.filepath_frame, text="Browse", command=self.browse)
 
         self.display_button.pack(padx=4, pady=2, side='left')
+        self.referrers_button.pack(padx=4, pady=2, side='left')
+        self.preflight_button.pack(padx=4, pady=2, side='left')
         self.zip_button.pack(padx=4, pady=2, side='right')
+        self.use_processes_cbtn.pack(padx=4, pady=2, side='right')
 
         self.filepath_entry.pack(padx=(4, 0), pady=2, side='left',
                                  expand=True, fill='x')
         self.browse_button.pack(padx=(0, 4), pady=2, side='left')
 
+        self.prev_manifest_label.pack(padx=(4, 0), pady=2, side='left')
+        self.prev_manifest_entry.pack(padx=(4, 0), pady=2, side='left',
+                                      expand=True, fill='x')
+        self.prev_manifest_browse_button.pack(padx=(0, 4), pady=2,
+                                              side='left')
+
+        self.zip_compression_label.pack(padx=(4, 0), pady=2, side='left')
+        self.zip_compression_menu.pack(padx=(4, 0), pady=2, side='left')
+        self.prev_manifest_frame.pack(fill='x', expand=True, side='left')
+
         self.filepath_frame.pack(fill='x', padx=1)
         self.button_frame.pack(fill='x', padx=1)
+        self.zip_settings_frame.pack(fill='x', padx=1)
         self.dependency_frame.pack(fill='both', padx=1, expand=True)
 
         self.transient(app_root)
@@ -106,6 +177,18 @@ def browse(self):
         self.app_root.last_load_dir = Path(fp).parent
         self.tag_filepath.set(fp)
 
+    def browse_prev_manifest(self):
+        if self._zipping:
+            return
+
+        fp = askopenfilename(
+            title="Select the manifest of a previous zip", parent=self,
+            filetypes=(("zip manifest", "*_manifest.json"), ('All', '*')),
+            initialdir=self.app_root.last_load_dir)
+
+        if fp:
+            self.prev_manifest_path.set(fp)
+
     def destroy(self):
         try:
             self.app_root.tool_windows.pop(self.window_name, None)
@@ -121,64 +204,308 @@ def get_tag(self, tag_path):
             print(format_exc())
             return None
 
-    def get_dependencies(self, tag):
-        def_id = tag.def_id
-        dependency_cache = self.handler.tag_ref_cache.get(def_id)
-
-        if not dependency_cache:
-            return ()
+    def get_tag_refs(self, tag_path):
+        '''
+        Returns the TagRefInfos of the tag at tag_path. Only the
+        references are read from the tag unless it is already loaded
+        or can't be read that way. If the tags directory is being watched,
+        the references are taken from the live reference index instead.
+        The references are cached until the tag changes on disk.
+        Returns None if it can't be loaded.
+        '''
+        return tag_refs.get_cached_tag_refs(
+            self.handler, tag_path, self.get_tag,
+            tag_ref_index.get_live_index(self.handler))
 
-        nodes = self.handler.get_nodes_by_paths(
-            self.handler.tag_ref_cache[def_id], tag.data)
+    def get_dependencies(self, tag):
+        return self.get_dependency_paths(
+            tag_refs.get_tag_refs(self.handler, tag))
 
+    def get_dependency_paths(self, refs):
         dependencies = []
 
-        for node in nodes:
+        for ref in refs:
             # if the node's filepath is empty, just skip it
-            if not node.filepath:
+            if not ref.filepath:
                 continue
 
-            ext = '.' + node.tag_class.enum_name
+            ext = '.' + ref.tag_class_name
 
             if tagpath_to_fullpath(
-                self.handler.tagsdir, PureWindowsPath(node.filepath), extension=ext
+                self.handler.tagsdir, PureWindowsPath(ref.filepath), extension=ext
             ) is not None and (self.handler.treat_mode_as_mod2 and ext == '.model'):
                 ext = '.gbxmodel'
 
-            dependencies.append(node.filepath + ext)
+            dependencies.append(ref.filepath + ext)
         return dependencies
 
-    def populate_dependency_tree(self):
+    def get_selected_rel_filepath(self):
+        '''
+        Returns the tags directory relative path of the selected tag,
+        or None if no tag is selected or it can't be used.
+        '''
         filepath = self.tag_filepath.get()
         if not filepath:
-            return
+            return None
 
         app = self.app_root
-        handler = self.handler = app.handler
+        self.handler = app.handler
         handler_name = app.handler_names[app._curr_handler_index]
         if handler_name not in app.tags_dir_relative:
             print("Change the current tag set.")
-            return
+            return None
 
         filepath = path_normalize(filepath)
 
         if not is_in_dir(filepath, self.handler.tagsdir):
             print("%s\nis not in tagsdir\n%s" %
                   (filepath, self.handler.tagsdir))
+            return None
+
+        return Path(filepath).relative_to(self.handler.tagsdir)
+
+    def show_tree_frame(self, tree_frame, rel_filepath):
+        for frame in (self.dependency_frame, self.referrer_frame):
+            if frame is not tree_frame:
+                frame.pack_forget()
+
+        tree_frame.handler = self.handler
+        tree_frame.tags_dir = self.handler.tagsdir
+        tree_frame.root_tag_path = self.handler.tagsdir.joinpath(rel_filepath)
+        tree_frame.root_tag_text = rel_filepath
+        tree_frame.pack(fill='both', padx=1, expand=True)
+        tree_frame.reload()
+
+    def populate_dependency_tree(self):
+        rel_filepath = self.get_selected_rel_filepath()
+        if rel_filepath is None:
+            return
+        elif self.get_tag_refs(rel_filepath) is None:
+            print("Could not load tag:\n    %s" %
+                  self.handler.tagsdir.joinpath(rel_filepath))
+            return
+
+        self.show_tree_frame(self.dependency_frame, rel_filepath)
+
+    def zip_dependencies(self, rel_filepath, write_queue, pool=None):
+        '''
+        Walks the dependencies of the tag at rel_filepath breadth first,
+        putting (tag_path, rel_filepath) pairs for each tag to zip in
+        the write_queue. If a process pool is given, the references of
+        each breadth of tags are read by it in parallel.
+        '''
+        app = self.app_root
+        handler = self.handler
+        tags_to_zip = [rel_filepath]
+        seen_tags = set()
+
+        while tags_to_zip:
+            frontier = []
+            for rel_filepath in tags_to_zip:
+                if rel_filepath not in seen_tags:
+                    seen_tags.add(rel_filepath)
+                    frontier.append((rel_filepath, tagpath_to_fullpath(
+                        handler.tagsdir, PureWindowsPath(rel_filepath))))
+
+            tags_to_zip = []
+            for (rel_filepath, tag_path), refs in zip(
+                    frontier, self.get_frontier_refs(frontier, pool)):
+                if self.stop_zipping:
+                    print('Recursive zip operation cancelled.\n')
+                    return
+
+                print("Adding '%s' to zipfile" % rel_filepath)
+                app.update_idletasks()
+                if refs is None:
+                    print("    Could not load tag.")
+                    print("    Could not add '%s' to zipfile." %
+                          rel_filepath)
+                    continue
+
+                tags_to_zip.extend(self.get_dependency_paths(refs))
+                write_queue.put((tag_path, rel_filepath))
+
+    def get_frontier_refs(self, frontier, pool=None):
+        '''
+        Yields the TagRefInfos of each (rel_filepath, tag_path) pair in
+        the frontier, in order, or None for tags that can't be read.
+        Tags loaded in the editor may have unsaved edits, so they're
+        always read in this process, same as without a pool. So are tags
+        whose references are already in the shared cache.
+        '''
+        handler = self.handler
+        refs_cache = tag_refs.tag_refs_cache
+        local_tags = set()
+        pool_jobs = []
+        if pool is not None:
+            chunk = []
+            for rel_filepath, tag_path in frontier:
+                if tag_path is None:
+                    continue
+                elif (refs_cache.get_cached(handler, tag_path) is not None or
+                      tag_scanning.get_loaded_tag(
+                          handler, handler.get_def_id(tag_path),
+                          tag_path) is not None):
+                    local_tags.add(tag_path)
+                    continue
+
+                chunk.append(tag_path)
+                if len(chunk) >= max(1, self.zip_chunk_size):
+                    pool_jobs.append(chunk)
+                    chunk = []
+
+            if chunk:
+                pool_jobs.append(chunk)
+
+        pool_results = chain.from_iterable(
+            pool.imap(tag_scanning.load_tag_refs_paths, pool_jobs)
+            if pool_jobs else ())
+
+        for rel_filepath, tag_path in frontier:
+            if tag_path is None:
+                yield None
+            elif pool is None or tag_path in local_tags:
+                yield self.get_tag_refs(tag_path)
+            else:
+                refs = next(pool_results)
+                refs_cache.set_cached(handler, tag_path, refs)
+                yield refs
+
+    def write_zipped_tags(self, tagzip, write_queue, manifest,
+                          prev_manifest=None, level=None, counts=None):
+        '''
+        Writes the (tag_path, rel_filepath) pairs put in write_queue to
+        the zipfile until None is put in it. Meant to run in its own thread.
+        Every tag is recorded in the manifest, but tags whose size and
+        hash match their entry in prev_manifest aren't written. The number
+        of tags written and skipped are added to the counts dict.
+        '''
+        if counts is None:
+            counts = {}
+        counts.setdefault("written", 0)
+        counts.setdefault("unchanged", 0)
+        while True:
+            item = write_queue.get()
+            if item is None:
+                return
+            elif self.stop_zipping:
+                # keep emptying the queue so the producer isn't blocked
+                continue
+
+            tag_path, rel_filepath = item
+            arcname = str(rel_filepath)
+            try:
+                with open(str(tag_path), 'rb') as f:
+                    data = f.read()
+                size, sha1 = tag_zip_manifest.hash_tag_data(data)
+                manifest.set_entry(arcname, size, sha1)
+                if (prev_manifest is not None and
+                        prev_manifest.is_unchanged(arcname, size, sha1)):
+                    counts["unchanged"] += 1
+                    continue
+
+                # zip can't store dates before 1980
+                date_time = max(
+                    localtime(os.stat(str(tag_path)).st_mtime)[:6],
+                    (1980, 1, 1, 0, 0, 0))
+                tag_zip_manifest.write_tag_data(
+                    tagzip, arcname, data, date_time, level)
+                counts["written"] += 1
+            except Exception:
+                manifest.entries.pop(arcname, None)
+                print(format_exc())
+                print("    Could not add '%s' to zipfile." % rel_filepath)
+
+    def populate_referrer_tree(self):
+        if self._indexing:
             return
 
-        rel_filepath = Path(filepath).relative_to(self.handler.tagsdir)
-        tag = self.get_tag(rel_filepath)
-        if tag is None:
-            print("Could not load tag:\n    %s" % filepath)
+        rel_filepath = self.get_selected_rel_filepath()
+        if rel_filepath is None:
             return
 
-        self.dependency_frame.handler = handler
-        self.dependency_frame.tags_dir = self.handler.tagsdir
-        self.dependency_frame.root_tag_path = tag.filepath
-        self.dependency_frame.root_tag_text = rel_filepath
+        try: self.index_thread.join()
+        except Exception: pass
+        self.index_thread = Thread(
+            target=self._populate_referrer_tree, args=(rel_filepath, ))
+        self.index_thread.daemon = True
+        self.index_thread.start()
+
+    def _populate_referrer_tree(self, rel_filepath):
+        # the index is saved between sessions, so only the tags
+        # that changed since it was last used need to be read.
+        self._indexing = True
+        try:
+            print("Updating tag reference index...")
+            self.referrer_frame.ref_index = tag_ref_index.get_ref_index(
+                self.handler, e_c.TAG_REF_INDEX_DIR)
+            self.show_tree_frame(self.referrer_frame, rel_filepath)
+        except Exception:
+            print(format_exc())
+            print("Could not index tag references.")
+        self._indexing = False
+
+    def preflight_report(self):
+        if self._preflighting or self._zipping:
+            return
+
+        rel_filepath = self.get_selected_rel_filepath()
+        if rel_filepath is None:
+            return
 
-        self.dependency_frame.reload()
+        try: self.preflight_thread.join()
+        except Exception: pass
+        self.preflight_thread = Thread(
+            target=self._preflight_report, args=(rel_filepath, ))
+        self.preflight_thread.daemon = True
+        self.preflight_thread.start()
+
+    def _preflight_report(self, rel_filepath):
+        self._preflighting = True
+        try:
+            self.do_preflight_report(rel_filepath)
+        except Exception:
+            print(format_exc())
+        self._preflighting = False
+
+    def do_preflight_report(self, rel_filepath):
+        '''
+        Prints the tag count, bytes per tag type, largest tags and
+        missing references of the dependency closure of the tag.
+        Each tag in it is scanned once, using the same checks as
+        the tag scanner, and in parallel if using multiple processes.
+        '''
+        app = self.app_root
+        handler = self.handler
+        self.stop_zipping = False
+        live_index = tag_ref_index.get_live_index(handler)
+
+        pool = None
+        if self.use_processes.get() and live_index is None:
+            print("Starting worker processes...")
+            app.update_idletasks()
+            pool = tag_scanning.make_worker_pool(handler, self.max_processes)
+
+        print("Checking dependencies of '%s'..." % rel_filepath)
+        report = tag_closure.TagClosureReport(rel_filepath)
+        try:
+            for tag_rel_filepath, result in tag_closure.iter_closure_results(
+                    handler, rel_filepath, pool, self.zip_chunk_size,
+                    live_index):
+                if self.stop_zipping:
+                    print('Preflight report cancelled.\n')
+                    return
+
+                report.add_result(tag_rel_filepath, result)
+                if result.scan_error:
+                    print(result.scan_error)
+                    print("    Could not scan '%s'" % tag_rel_filepath)
+        finally:
+            if pool is not None:
+                pool.terminate()
+
+        print()
+        print(tag_closure.format_closure_report(report))
 
     def recursive_zip(self):
         if self._zipping:
@@ -223,52 +550,84 @@ def do_recursive_zip(self):
 
         try:
             rel_filepath = tag_path.relative_to(self.handler.tagsdir)
-            tag = self.get_tag(rel_filepath)
+            refs = self.get_tag_refs(rel_filepath)
         except ValueError:
-            tag = None
+            refs = None
 
-        if tag is None:
+        if refs is None:
             print("Could not load tag:\n    %s" % tag_path)
             return
 
         # make the zipfile to put everything in
         tagzip_path = os.path.splitext(tagzip_path)[0] + ".zip"
 
-        tags_to_zip = [rel_filepath]
-        new_tags_to_zip = []
-        seen_tags = set()
-
-        with zipfile.ZipFile(str(tagzip_path), mode='w') as tagzip:
-            # loop over all the tags and add them to the zipfile
-            while tags_to_zip:
-                for rel_filepath in tags_to_zip:
-                    tag_path = tagpath_to_fullpath(
-                        self.handler.tagsdir, PureWindowsPath(rel_filepath))
-                    if self.stop_zipping:
-                        print('Recursive zip operation cancelled.\n')
-                        return
-
-                    if rel_filepath in seen_tags:
-                        continue
-                    seen_tags.add(rel_filepath)
-
-                    try:
-                        print("Adding '%s' to zipfile" % rel_filepath)
-                        app.update_idletasks()
-                        tag = self.get_tag(rel_filepath)
-                        new_tags_to_zip.extend(self.get_dependencies(tag))
-
-                        # try to conserve memory a bit
-                        del tag
-
-                        tagzip.write(str(tag_path), arcname=str(rel_filepath))
-                    except Exception:
-                        print(format_exc())
-                        print("    Could not add '%s' to zipfile." %
-                              rel_filepath)
+        prev_manifest = None
+        if self.prev_manifest_path.get():
+            prev_manifest = tag_zip_manifest.TagZipManifest(
+                self.prev_manifest_path.get())
+            try:
+                prev_manifest.load()
+            except Exception:
+                print(format_exc())
+                print("Could not load the previous zip manifest.")
+                return
+
+        manifest = tag_zip_manifest.TagZipManifest(
+            tag_zip_manifest.get_zip_manifest_path(tagzip_path))
+        level = tag_zip_manifest.ZIP_COMPRESSION_LEVELS[
+            max(0, self.zip_compression.get())]
+        counts = {}
+
+        pool = None
+        if (self.use_processes.get() and
+                tag_ref_index.get_live_index(handler) is None):
+            # not worth it if the references are already indexed
+            print("Starting worker processes...")
+            app.update_idletasks()
+            pool = tag_scanning.make_worker_pool(handler, self.max_processes)
+
+        # tags are written by their own thread so reading the
+        # references of the next tags isn't held up by compression.
+        write_queue = queue.Queue(max(1, self.zip_write_queue_size))
+        write_thread = None
+        try:
+            with zipfile.ZipFile(str(tagzip_path), mode='w') as tagzip:
+                write_thread = Thread(
+                    target=self.write_zipped_tags,
+                    args=(tagzip, write_queue, manifest,
+                          prev_manifest, level, counts))
+                write_thread.daemon = True
+                write_thread.start()
+                self.zip_dependencies(rel_filepath, write_queue, pool)
+                write_queue.put(None)
+                write_thread.join()
+        finally:
+            if write_thread is not None and write_thread.is_alive():
+                write_queue.put(None)
+                write_thread.join()
+
+            if pool is not None:
+                pool.terminate()
+
+        if self.stop_zipping:
+            return
 
-                # replace the tags to zip with the newly collected ones
-                tags_to_zip[:] = new_tags_to_zip
-                del new_tags_to_zip[:]
+        # the manifest covers every tag in the closure, not just the
+        # ones written, so it can be diffed against by the next zip.
+        try:
+            manifest.save()
+        except Exception:
+            print(format_exc())
+            print("Could not save zip manifest to:\n    %s" % manifest.filepath)
+
+        if prev_manifest is not None:
+            removed = set(prev_manifest.entries).difference(manifest.entries)
+            print("\n%s changed or new tags added. %s unchanged tags skipped."
+                  % (counts.get("written", 0), counts.get("unchanged", 0)))
+            if removed:
+                print("%s tags in the previous zip are no longer needed:" %
+                      len(removed))
+                for arcname in sorted(removed):
+                    print("    %s" % arcname)
 
         print("\nRecursive zip completed.\n")
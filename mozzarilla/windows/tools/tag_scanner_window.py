@@ -9,9 +9,12 @@
 
 import ctypes
 import os
+import shutil
 import sys
+import tempfile
 import tkinter as tk
 
+from itertools import chain
 from pathlib import Path
 from time import time
 from threading import Thread
@@ -19,11 +22,14 @@
 
 from binilla.util import ProcController, open_in_default_program
 from binilla.widgets.binilla_widget import BinillaWidget
-from binilla.windows.filedialog import askdirectory, asksaveasfilename
+from binilla.windows.filedialog import askdirectory, askopenfilename,\
+     asksaveasfilename
 
 from supyr_struct.util import path_normalize, is_in_dir
 
 from mozzarilla import editor_constants as e_c
+from mozzarilla import tag_closure, tag_header, tag_ref_index, tag_scanning
+from mozzarilla.tags_dir_index import get_tags_dir_index
 
 
 platform = sys.platform.lower()
@@ -36,6 +42,30 @@
     SetFileAttributesW = ctypes.windll.kernel32.SetFileAttributesW
 
 
+class ConsoleLog:
+    '''
+    File-like stand-in for the log file, used when the log can't be
+    created. Prints each complete line written to it to the console.
+    '''
+    _partial = ""
+
+    def write(self, text):
+        lines = (self._partial + text).split('\n')
+        self._partial = lines.pop()
+        for line in lines:
+            self.print_line(line)
+
+    def print_line(self, line):
+        try:
+            print(line)
+        except Exception:
+            print("<COULD NOT PRINT THIS LINE>")
+
+    def close(self):
+        self.print_line(self._partial)
+        self._partial = ""
+
+
 class TagScannerWindow(tk.Toplevel, BinillaWidget):
     app_root = None
     handler = None
@@ -44,6 +74,11 @@ class TagScannerWindow(tk.Toplevel, BinillaWidget):
     stop_scanning = False
     print_interval = 5
 
+    # number of tags handed to a worker process at a time, and the max
+    # number of worker processes to use(None means one per cpu core)
+    scan_chunk_size = 32
+    max_processes = None
+
     listbox_index_to_def_id = ()
 
     def __init__(self, app_root, *args, **kwargs):
@@ -68,11 +103,17 @@ def __init__(self, app_root, *args, **kwargs):
 
         # make the tkinter variables
         self.open_logfile = tk.BooleanVar(self, True)
+        self.use_processes = tk.BooleanVar(self, False)
+        self.only_scan_changed = tk.BooleanVar(self, True)
+        self.write_jsonl = tk.BooleanVar(self, False)
         self.directory_path = tk.StringVar(self)
+        self.root_tag_path = tk.StringVar(self)
         self.logfile_path = tk.StringVar(self)
 
         # make the frames
         self.directory_frame = tk.LabelFrame(self, text="Directory to scan")
+        self.root_tag_frame = tk.LabelFrame(
+            self, text="Only scan the dependencies of this tag(optional)")
         self.logfile_frame   = tk.LabelFrame(self, text="Output log filepath")
         self.def_ids_frame = tk.LabelFrame(
             self, text="Select which tag types to scan")
@@ -97,6 +138,14 @@ def __init__(self, app_root, *args, **kwargs):
         self.dir_browse_button = tk.Button(
             self.directory_frame, text="Browse", command=self.dir_browse)
 
+        self.root_tag_entry = tk.Entry(
+            self.root_tag_frame, textvariable=self.root_tag_path)
+        self.root_tag_browse_button = tk.Button(
+            self.root_tag_frame, text="Browse", command=self.root_tag_browse)
+        self.root_tag_entry.tooltip_string = (
+            "If a tag is selected, only it and the tags it depends on\n"
+            "are scanned, rather than every tag in the directory.")
+
         self.logfile_entry = tk.Entry(
             self.logfile_dir_frame, textvariable=self.logfile_path,)
         self.log_browse_button = tk.Button(
@@ -104,6 +153,15 @@ def __init__(self, app_root, *args, **kwargs):
         self.open_logfile_cbtn = tk.Checkbutton(
             self.logfile_frame, text="Open log when done scanning",
             variable=self.open_logfile)
+        self.use_processes_cbtn = tk.Checkbutton(
+            self.logfile_frame, text="Scan using multiple processes",
+            variable=self.use_processes)
+        self.only_scan_changed_cbtn = tk.Checkbutton(
+            self.logfile_frame, text="Only rescan changed tags",
+            variable=self.only_scan_changed)
+        self.write_jsonl_cbtn = tk.Checkbutton(
+            self.logfile_frame, text="Also write JSON Lines report",
+            variable=self.write_jsonl)
 
         self.def_ids_scrollbar = tk.Scrollbar(
             self.def_ids_frame, orient="vertical")
@@ -112,20 +170,20 @@ def __init__(self, app_root, *args, **kwargs):
             yscrollcommand=self.def_ids_scrollbar.set, exportselection=False)
         self.def_ids_scrollbar.config(command=self.def_ids_listbox.yview)
 
+        # only the references are read from tag types that don't have
+        # tag specific checks, so even massive sbsp and scnr tags are
+        # cheap enough to scan by default.
         for def_id in self.listbox_index_to_def_id:
             tag_ext = handler.id_ext_map[def_id].split('.')[-1]
             self.def_ids_listbox.insert('end', tag_ext)
-
-            # these tag types are massive, so by
-            # default dont set them to be scanned
-            if def_id in ("sbsp", "scnr"):
-                continue
             self.def_ids_listbox.select_set('end')
 
-        for w in (self.directory_entry, self.logfile_entry):
+        for w in (self.directory_entry, self.root_tag_entry,
+                  self.logfile_entry):
             w.pack(padx=(4, 0), pady=2, side='left', expand=True, fill='x')
 
-        for w in (self.dir_browse_button, self.log_browse_button):
+        for w in (self.dir_browse_button, self.root_tag_browse_button,
+                  self.log_browse_button):
             w.pack(padx=(0, 4), pady=2, side='left')
 
         for w in (self.scan_button, self.cancel_button):
@@ -139,9 +197,13 @@ def __init__(self, app_root, *args, **kwargs):
         self.button_frame.pack(side='left', fill="y")
 
         self.directory_frame.pack(fill='x', padx=1)
+        self.root_tag_frame.pack(fill='x', padx=1)
         self.logfile_frame.pack(fill='x', padx=1)
         self.logfile_dir_frame.pack(fill='x')
         self.open_logfile_cbtn.pack(fill='x', side=tk.LEFT)
+        self.use_processes_cbtn.pack(fill='x', side=tk.LEFT)
+        self.only_scan_changed_cbtn.pack(fill='x', side=tk.LEFT)
+        self.write_jsonl_cbtn.pack(fill='x', side=tk.LEFT)
         self.def_ids_frame.pack(fill='both', padx=1, expand=True)
 
         self.transient(app_root)
@@ -166,21 +228,7 @@ def select_all(self):
             self.def_ids_listbox.select_set(i)
 
     def get_tag(self, filepath):
-        handler = self.handler
-        def_id = handler.get_def_id(filepath)
-
-        try:
-            tag = handler.get_tag(filepath, def_id)
-        except (KeyError, LookupError):
-            tag = None
-        try:
-            if tag is None:
-                return handler.build_tag(
-                    filepath=self.handler.tagsdir.joinpath(filepath)
-                    )
-        except Exception:
-            pass
-        return tag
+        return tag_scanning.get_tag(self.handler, filepath)
 
     def dir_browse(self):
         if self._scanning:
@@ -198,6 +246,29 @@ def dir_browse(self):
 
         self.directory_path.set(dirpath)
 
+    def root_tag_browse(self):
+        if self._scanning:
+            return
+
+        filetypes = [('All', '*')]
+        defs = self.handler.defs
+        for def_id in sorted(defs.keys()):
+            filetypes.append((def_id, defs[def_id].ext))
+
+        filepath = askopenfilename(
+            initialdir=self.app_root.last_load_dir, filetypes=filetypes,
+            parent=self, title="Select the tag to scan the dependencies of")
+
+        if not filepath:
+            return
+
+        self.app_root.last_load_dir = Path(filepath).parent
+        if not is_in_dir(filepath, self.handler.tagsdir):
+            print("Specified tag is not located within the tags directory")
+            return
+
+        self.root_tag_path.set(filepath)
+
     def log_browse(self):
         if self._scanning:
             return
@@ -247,23 +318,20 @@ def scan(self):
 
         logpath = path_normalize(self.logfile_path.get())
         dirpath = path_normalize(self.directory_path.get())
-
-        if not is_in_dir(dirpath, self.handler.tagsdir):
+        root_tag_path = self.root_tag_path.get()
+        if root_tag_path:
+            root_tag_path = path_normalize(root_tag_path)
+            if not is_in_dir(root_tag_path, self.handler.tagsdir):
+                print("Specified tag is not located within the tags directory")
+                return
+        elif not is_in_dir(dirpath, self.handler.tagsdir):
             print("Specified directory is not located within the tags directory")
             return
 
-        #this is the string to store the entire debug log
-        log_name = "HEK Tag Scanner log"
-        debuglog = "\n%s%s%s\n\n" % (
-            "-"*30, log_name, "-" * (50-len(log_name)))
-        debuglog += "tags directory = %s\nscan directory = %s\n\n" % (
-            self.handler.tagsdir, dirpath)
-        debuglog += "Broken dependencies are listed below.\n"
+        # tag specific errors are logged after all the broken dependencies,
+        # so they're spooled to a temp file per tag type until then.
         tag_specific_errors = {}
 
-        get_nodes = handler.get_nodes_by_paths
-        get_tagref_invalid = handler.get_tagref_invalid
-
         s_time = time()
         c_time = s_time
         p_int = self.print_interval
@@ -273,206 +341,313 @@ def scan(self):
         ext_id_map = handler.ext_id_map
         id_ext_map = handler.id_ext_map
 
-        print("Locating tags...")
-
-        for root, directories, files in os.walk(dirpath):
-            root = path_normalize(os.path.join(root, ""))
+        # results of the tags scanned while finding the dependency closure
+        closure_results = {}
+        if not root_tag_path:
+            print("Locating tags...")
+        elif not self.scan_closure(root_tag_path, all_tag_paths,
+                                   closure_results):
+            return
 
-            rel_root = Path(root).relative_to(self.handler.tagsdir)
+        tags_dir_index = get_tags_dir_index(handler.tagsdir)
+        tagsdir = str(handler.tagsdir)
+        # the directory isn't walked when only scanning a closure
+        for entry in (() if root_tag_path else
+                      tags_dir_index.iter_files(dirpath)):
+            filepath = tags_dir_index.root.joinpath(
+                entry.rel_path).relative_to(handler.tagsdir)
 
-            for filename in files:
-                filepath = rel_root.joinpath(filename)
+            if time() - c_time > p_int:
+                c_time = time()
+                print(' '*4, filepath, sep="")
+                self.app_root.update_idletasks()
 
-                if time() - c_time > p_int:
-                    c_time = time()
-                    print(' '*4, filepath, sep="")
-                    self.app_root.update_idletasks()
+            if self.stop_scanning:
+                print('Tag scanning operation cancelled.\n')
+                return
+
+            # classify by the tag header rather than the extension,
+            # so misnamed tags are still found and files that aren't
+            # tags are rejected before anything tries to build them.
+            def_id = tag_header.get_handler_tag_class(
+                handler, os.path.join(tagsdir, str(filepath)))
+            if def_id is None:
+                if ext_id_map.get(entry.ext) in all_tag_paths:
+                    print("    Skipping '%s'. Not a valid tag." % filepath)
+                continue
 
-                if self.stop_scanning:
-                    print('Tag scanning operation cancelled.\n')
-                    return
+            tag_paths = all_tag_paths.get(def_id)
+            if tag_paths is not None:
+                tag_paths.append(filepath)
 
-                tag_paths = all_tag_paths.get(
-                    ext_id_map.get(os.path.splitext(filename)[-1].lower()))
+        logfile = self.open_log(logpath)
+        jsonl_file = None
+        if self.write_jsonl.get():
+            jsonl_path = tag_scanning.get_jsonl_path(logpath)
+            try:
+                jsonl_file = jsonl_path.open('w')
+            except Exception:
+                print(format_exc())
+                print("Could not create JSON Lines report '%s'" % jsonl_path)
 
-                if tag_paths is not None:
-                    tag_paths.append(filepath)
+        log_name = "HEK Tag Scanner log"
+        logfile.write("\n%s%s%s\n\n" % (
+            "-"*30, log_name, "-" * (50-len(log_name))))
+        if root_tag_path:
+            logfile.write("tags directory = %s\nroot tag = %s\n\n" % (
+                self.handler.tagsdir, root_tag_path))
+        else:
+            logfile.write("tags directory = %s\nscan directory = %s\n\n" % (
+                self.handler.tagsdir, dirpath))
+        logfile.write("Broken dependencies are listed below.\n")
+
+        pool = None
+        worker_results = ()
+        # tags loaded in the editor may have unsaved edits, so they're
+        # always scanned in this process, same as when scanning serially.
+        loaded_tag_paths = set(
+            (def_id, filepath) for def_id in all_tag_paths
+            for filepath in all_tag_paths[def_id]
+            if self.get_loaded_tag(def_id, filepath) is not None)
+
+        # the manifest is always updated, but cached results from it
+        # are only reused if we're only rescanning changed tags.
+        manifest = tag_scanning.TagScanManifest(
+            tag_scanning.get_manifest_path(logpath), handler)
+        manifest.load()
+        tag_stats = {}
+        cached_results = {}
+        only_scan_changed = self.only_scan_changed.get()
+        # if the tags directory is being watched, the live index already
+        # has up to date results for every tag that hasn't been edited.
+        live_index = tag_ref_index.get_live_index(handler)
+        if only_scan_changed:
+            print("Checking for changed tags...")
+            self.app_root.update_idletasks()
 
-        # make the debug string by scanning the tags directory
-        for def_id in sorted(all_tag_paths.keys()):
-            tag_ref_paths = handler.tag_ref_cache.get(def_id)
+        for def_id in all_tag_paths:
+            for filepath in all_tag_paths[def_id]:
+                if (def_id, filepath) in loaded_tag_paths:
+                    continue
 
-            self.app_root.update_idletasks()
-            print("Scanning '%s' tags..." % id_ext_map[def_id][1:])
-            tags_coll = all_tag_paths[def_id]
+                try:
+                    stat = manifest.get_tag_stat(filepath)
+                except OSError:
+                    continue
 
-            # always display the first tag's filepath
-            c_time = time() - (p_int + 100)
+                tag_stats[(def_id, filepath)] = stat
+                result = closure_results.get((def_id, filepath))
+                if result is not None:
+                    cached_results[(def_id, filepath)] = result
+                    continue
 
-            for filepath in sorted(tags_coll):
-                if self.stop_scanning:
-                    print('Tag scanning operation cancelled.\n')
-                    break
+                if live_index is not None:
+                    result = live_index.get_result(filepath, stat)
+                if result is None and only_scan_changed:
+                    result = manifest.get_result(filepath, stat)
 
-                if time() - c_time > p_int:
-                    c_time = time()
-                    print(' '*4, filepath, sep="")
-                    self.app_root.update_idletasks()
+                if result is not None:
+                    cached_results[(def_id, filepath)] = result
 
-                tag = self.get_tag(self.handler.tagsdir.joinpath(filepath))
-                if tag is None:
-                    print("    Could not load '%s'" % filepath)
-                    continue
+        if len(cached_results) > len(closure_results):
+            print("Reusing results of %s unchanged tags." %
+                  (len(cached_results) - len(closure_results)))
+        # tags loaded in the editor were scanned with the closure too
+        cached_results.update(closure_results)
 
-                # find tag specific errors
-                self.tag_specific_scan(tag, tag_specific_errors)
+        skip_tag_paths = loaded_tag_paths.union(cached_results)
+        tag_count = sum(len(paths) for paths in all_tag_paths.values())
+        if self.use_processes.get() and tag_count > len(skip_tag_paths):
+            print("Starting worker processes...")
+            self.app_root.update_idletasks()
+            pool = self.make_scan_pool()
+            worker_results = chain.from_iterable(pool.imap(
+                tag_scanning.scan_tag_paths,
+                self.get_scan_jobs(all_tag_paths, skip_tag_paths)))
 
-                try:
-                    if tag_ref_paths is None:
-                        # no dependencies for this tag. continue on
+        try:
+            # scan the tags directory, writing to the log as we go
+            for def_id in sorted(all_tag_paths.keys()):
+                self.app_root.update_idletasks()
+                print("Scanning '%s' tags..." % id_ext_map[def_id][1:])
+                tags_coll = all_tag_paths[def_id]
+
+                # always display the first tag's filepath
+                c_time = time() - (p_int + 100)
+
+                for filepath in sorted(tags_coll):
+                    if self.stop_scanning:
+                        print('Tag scanning operation cancelled.\n')
+                        break
+
+                    if time() - c_time > p_int:
+                        c_time = time()
+                        print(' '*4, filepath, sep="")
+                        self.app_root.update_idletasks()
+
+                    key = (def_id, filepath)
+                    if key in cached_results:
+                        result = cached_results[key]
+                    elif pool is None or key in loaded_tag_paths:
+                        result = tag_scanning.scan_tag_path(
+                            handler, def_id, filepath,
+                            self.get_loaded_tag(def_id, filepath))
+                    else:
+                        result = next(worker_results)
+
+                    if key in tag_stats:
+                        manifest.set_result(filepath, tag_stats[key], result)
+
+                    if not result.loaded:
+                        print("    Could not load '%s'" % filepath)
                         continue
 
-                    missed = get_nodes(tag_ref_paths, tag.data,
-                                       get_tagref_invalid)
+                    if result.specific_error:
+                        if result.def_id not in tag_specific_errors:
+                            tag_specific_errors[result.def_id] = \
+                                tempfile.TemporaryFile('w+')
+                        tag_specific_errors[result.def_id].write(
+                            result.specific_error)
+
+                    logfile.write(tag_scanning.format_broken_refs(result))
+                    if jsonl_file is not None:
+                        jsonl_file.write(
+                            tag_scanning.format_broken_refs_jsonl(result))
+                    if result.scan_error:
+                        print(result.scan_error)
+                        print("    Could not scan '%s'" % result.tag_filepath)
 
-                    if not missed:
-                        continue
+                if self.stop_scanning:
+                    break
 
-                    debuglog += "\n\n%s\n" % filepath
-                    block_name = None
-
-                    for block in missed:
-                        if block.NAME != block_name:
-                            debuglog += '%s%s\n' % (' '*4, block.NAME)
-                            block_name = block.NAME
-                        try:
-                            ext = '.' + block.tag_class.enum_name
-                        except Exception:
-                            ext = ''
-                        debuglog += '%s%s\n' % (' '*8, block.STEPTREE + ext)
-
-                except Exception:
-                    print(format_exc())
-                    print("    Could not scan '%s'" % tag.filepath)
-                    continue
+            if tag_specific_errors:
+                logfile.write("\nTag specific errors are listed below.\n")
 
-            if self.stop_scanning:
-                break
+            for def_id in sorted(tag_specific_errors.keys()):
+                errors_file = tag_specific_errors[def_id]
+                errors_file.seek(0)
+                logfile.write("\n\n%s specific errors:\n" % def_id)
+                shutil.copyfileobj(errors_file, logfile)
+        finally:
+            if pool is not None:
+                pool.terminate()
+
+            for errors_file in tag_specific_errors.values():
+                errors_file.close()
 
-        if tag_specific_errors:
-            debuglog += "\nTag specific errors are listed below.\n"
+            logfile.close()
+            if jsonl_file is not None:
+                jsonl_file.close()
 
-        for def_id in sorted(tag_specific_errors.keys()):
-            debuglog += "\n\n%s specific errors:\n%s" % (
-                def_id, tag_specific_errors[def_id])
+        try:
+            manifest.prune()
+            manifest.save()
+        except Exception:
+            print(format_exc())
+            print("Could not save scan manifest.")
 
         print("\nScanning took %s seconds." % int(time() - s_time))
-        print("Writing logfile to %s..." % logpath)
-        self.app_root.update_idletasks()
+        print("Scan completed.\n")
+        if isinstance(logfile, ConsoleLog):
+            return
 
-        # make and write to the logfile
         try:
-            handler.make_log_file(debuglog, logpath)
-            try:
-                print("Scan completed.\n")
-                if self.open_logfile.get():
-                    open_in_default_program(logpath)
+            if self.open_logfile.get():
+                open_in_default_program(logpath)
+        except Exception:
+            print("Could not open written log.")
+
+    def scan_closure(self, root_tag_path, all_tag_paths, closure_results):
+        '''
+        Scans the tag at root_tag_path and every tag it depends on, the
+        same way the dependency zipper finds them. The tags of the selected
+        types are added to all_tag_paths, and their results are stored in
+        closure_results by (def_id, filepath), so they aren't scanned again.
+        Returns False if the scan was cancelled.
+        '''
+        handler = self.handler
+        rel_filepath = Path(root_tag_path).relative_to(handler.tagsdir)
+        live_index = tag_ref_index.get_live_index(handler)
+        c_time = time()
+
+        print("Locating dependencies of '%s'..." % rel_filepath)
+        pool = None
+        if self.use_processes.get() and live_index is None:
+            print("Starting worker processes...")
+            self.app_root.update_idletasks()
+            pool = self.make_scan_pool()
 
-            except Exception:
-                print("Could not open written log.")
-            return
+        try:
+            for filepath, result in tag_closure.iter_closure_results(
+                    handler, rel_filepath, pool, self.scan_chunk_size,
+                    live_index):
+                if self.stop_scanning:
+                    print('Tag scanning operation cancelled.\n')
+                    return False
+
+                if time() - c_time > self.print_interval:
+                    c_time = time()
+                    print(' '*4, filepath, sep="")
+                    self.app_root.update_idletasks()
+
+                def_id = handler.get_def_id(handler.tagsdir.joinpath(filepath))
+                tag_paths = all_tag_paths.get(def_id)
+                if tag_paths is not None:
+                    tag_paths.append(filepath)
+                    closure_results[(def_id, filepath)] = result
+        finally:
+            if pool is not None:
+                pool.terminate()
+
+        print("Found %s tags to scan." % len(closure_results))
+        return True
+
+    def open_log(self, logpath):
+        '''
+        Opens the log for appending to, same as the handlers make_log_file.
+        If the log can't be created, a ConsoleLog is returned instead.
+        '''
+        print("Writing logfile to %s..." % logpath)
+        try:
+            return Path(logpath).open('a')
         except Exception:
             print("Could not create log. Printing log to console instead.\n\n")
-            for line in debuglog.split('\n'):
-                try:
-                    print(line)
-                except Exception:
-                    print("<COULD NOT PRINT THIS LINE>")
+            return ConsoleLog()
+
+    def get_loaded_tag(self, def_id, filepath):
+        return tag_scanning.get_loaded_tag(
+            self.handler, def_id, self.handler.tagsdir.joinpath(filepath))
+
+    def get_scan_jobs(self, all_tag_paths, skip_tag_paths=()):
+        '''
+        Splits the tags to scan into (def_id, filepaths) jobs for the
+        worker processes. Jobs are yielded in the same order the tags
+        are logged in, so results can be consumed in order. Any
+        (def_id, filepath) pairs in skip_tag_paths are left out.
+        '''
+        chunk_size = max(1, self.scan_chunk_size)
+        for def_id in sorted(all_tag_paths.keys()):
+            chunk = []
+            for filepath in sorted(all_tag_paths[def_id]):
+                if (def_id, filepath) in skip_tag_paths:
+                    continue
+
+                chunk.append(filepath)
+                if len(chunk) >= chunk_size:
+                    yield def_id, chunk
+                    chunk = []
 
-            print("Scan completed.\n")
+            if chunk:
+                yield def_id, chunk
+
+    def make_scan_pool(self):
+        return tag_scanning.make_worker_pool(self.handler, self.max_processes)
 
     def tag_specific_scan(self, tag, errors):
         assert isinstance(errors, dict)
-        cls = tag.def_id
-        err = ""
-
-        if cls == "snd!":
-            bad_ogg = []
-            for pr in tag.data.tagdata.pitch_ranges.STEPTREE:
-                for perm in pr.permutations.STEPTREE:
-                    if perm.compression.enum_name != "ogg":
-                        continue
-                    elif perm.ogg_sample_count == 0 and perm.samples.data:
-                        bad_ogg.append((pr.name, perm.name))
-
-            if bad_ogg:
-                err += ("    Bad PCM buffer size. " +
-                        "Fix by recompiling this sound.")
-        elif cls == "coll":
-            bad_nodes = {}
-            tagdata = tag.data.tagdata
-            nodes = tagdata.nodes.STEPTREE
-            mat_ct = len(tagdata.materials.STEPTREE)
-            highest_mat_num = lowest_mat_num = 0
-
-            for i in range(len(nodes)):
-                node = nodes[i]
-                bad_bsps = {}
-                for j in range(len(node.bsps.STEPTREE)):
-                    bsp = node.bsps.STEPTREE[j]
-                    bad_surfaces = []
-                    for k in range(len(bsp.surfaces.STEPTREE)):
-                        mat = bsp.surfaces.STEPTREE[k].material
-                        if mat > -1 and mat < mat_ct:
-                            continue
-
-                        highest_mat_num = max(highest_mat_num, mat)
-                        lowest_mat_num  = min(lowest_mat_num, mat)
-                        bad_surfaces.append(k)
-
-                    if bad_surfaces:
-                        bad_bsps[j] = bad_surfaces
-
-                if bad_bsps:
-                    bad_nodes[i] = bad_bsps
-
-            if bad_nodes:
-                err += "    Bad collision material numbers.\n"
-                if lowest_mat_num > -1:
-                    # none of the material numbers are below zero, so
-                    # it's possible to fix this by adding more materials.
-                    err += (("    Change the material numbers of these " +
-                             "surfaces to be <= %s or add %s materials.\n")
-                            % (mat_ct - 1, (highest_mat_num + 1) - mat_ct))
-                else:
-                    err += (("    Change the material numbers of these " +
-                             "surfaces to be >= 0 and <= %s\n") % (mat_ct - 1))
-
-                for i in sorted(bad_nodes.keys()):
-                    bad_bsps = bad_nodes[i]
-                    err += "    %s(node #%s)\n" % (nodes[i].name, i)
-                    for j in sorted(bad_bsps.keys()):
-                        bad_surfaces = bad_bsps[j]
-                        err += "        bsp #%s\n" % j
-                        err += "            surfaces = %s\n" % bad_surfaces
-                    err += "\n"
-                err = err[:-1]
-
-        elif cls == "effe":
-            i = 0
-            events = tag.data.tagdata.events.STEPTREE
-            for i in range(len(events)):
-                # tool exceptions if any parts reference a damage effect
-                # tag type, but have an empty filepath for the reference
-                parts = events[i].parts.STEPTREE
-                for j in range(len(parts)):
-                    part = parts[j]
-                    if (part.type.tag_class.enum_name == "damage_effect" and
-                        not part.type.filepath):
-                        err += ("     Missing filepath in damage_effect "
-                                "reference in part %s of event %s\n." % (j, i))
-
+        err = tag_scanning.tag_specific_scan(tag)
         if err:
+            cls = tag.def_id
             rel_tag_path = str(tag.filepath.relative_to(self.handler.tagsdir))
             errors[cls] = "%s\n%s\n%s\n" % (
                 errors.get(cls, ""), rel_tag_path, err)